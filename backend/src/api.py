@@ -1,13 +1,14 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 
 from aiohttp import web
 
-from helpers.utils import error_guard
+from helpers.utils import error_guard, SingleFlight
 from jobs.tx.storage import TxStorage
 from jobs.value_filler import ValueFiller
-from leaderboard import leaderboard, total_volume
-from models.tx import ThorTx
+from leaderboard import leaderboard_bundle, decode_cursor, encode_cursor, public_row
+from leaderboard_cache import RankingCache
+from models.counters import TxCounter, FillerShard
 
 BOARD_LIMIT = 100
 MAX_TS = 2_147_483_647
@@ -18,6 +19,17 @@ class API:
     network_id: str
     tx_storage: Optional[TxStorage] = None
     value_filler: Optional[ValueFiller] = None
+    use_rollup: bool = False  # sum the daily volumes (UserVolumeDay) instead of the raw txs
+    ranking_cache: Optional[RankingCache] = None  # pages are sliced from the cached whole ranking if set
+    leaderboard_requests: SingleFlight = field(default_factory=SingleFlight)  # identical concurrent requests
+    shard_max_age: float = 30.0  # sec; older heartbeats of the fillers are not shown
+
+    async def load_ranking(self, network_id, since, to, currency):
+        """
+        The whole ranking of the window with its total volume and number of participants (for RankingCache).
+        """
+        return await leaderboard_bundle(network_id, since, to, limit=None, currency=currency,
+                                        use_rollup=self.use_rollup)
 
     @error_guard
     async def handler_leaderboard(self, request):
@@ -36,14 +48,31 @@ class API:
 
         limit = min(limit, BOARD_LIMIT)
 
-        lb = await leaderboard(self.network_id, start_timestamp, final_timestamp, offset, limit, currency)
-        tv = await total_volume(self.network_id, from_date=start_timestamp, to_date=final_timestamp, currency=currency)
-        pt = await ThorTx.total_distinct_users_count(self.network_id,
-                                                     from_date=start_timestamp,
-                                                     to_date=final_timestamp)
+        # keyset pagination: the page after the row of the cursor (next_cursor of the previous page)
+        cursor = request.rel_url.query.get('cursor')
+        after = decode_cursor(cursor) if cursor else None
+        if after is not None:
+            offset = 0
 
-        return web.json_response({
-            'leaderboard': lb,
+        if self.ranking_cache is not None:
+            start_timestamp, final_timestamp = self.ranking_cache.quantize(start_timestamp, final_timestamp)
+
+        # the requests with the same parameters at the same time share one response (and its error)
+        params = (start_timestamp, final_timestamp, offset, limit, currency, after)
+        data = await self.leaderboard_requests.run(params, self.leaderboard_data, *params)
+        return web.json_response(data)
+
+    async def leaderboard_data(self, start_timestamp, final_timestamp, offset, limit, currency, after=None):
+        if self.ranking_cache is not None:
+            window = await self.ranking_cache.get(self.network_id, start_timestamp, final_timestamp, currency)
+            lb = window.page_after(after, limit) if after is not None else window.page(offset, limit)
+            tv, pt = window.total_volume, window.participants
+        else:
+            lb, tv, pt = await leaderboard_bundle(self.network_id, start_timestamp, final_timestamp, offset, limit,
+                                                  currency, use_rollup=self.use_rollup, after=after)
+
+        return {
+            'leaderboard': [public_row(row) for row in lb],
             'since': start_timestamp,
             'to': final_timestamp,
             'limit': limit,
@@ -51,21 +80,43 @@ class API:
             'participants': pt,
             'offset': offset,
             'currency': currency,
-        })
+            'next_cursor': encode_cursor(lb[-1]) if lb and len(lb) == limit else None,
+        }
 
     @error_guard
     async def handler_sync_progress(self, request):
         scan_n_local, scan_n_remote, scan_progress = await self.tx_storage.get_scan_progress()
-        fill_n_done, fill_total, fill_progress = await self.value_filler.get_progress()
+        if self.value_filler:
+            fill_n_done, fill_total, fill_progress = await self.value_filler.get_progress()
+            value_filler_stats = {
+                'concurrency': self.value_filler.concurrency.stats,
+                'pool_cache': self.value_filler.pool_cache.stats,
+                'pool_requests': self.value_filler.pool_requests.stats,
+                'prefetch': self.value_filler.prefetcher.stats if self.value_filler.prefetcher else None,
+                'verifier': self.value_filler.verifier.stats if self.value_filler.verifier else None,
+                'coingecko': self.value_filler.price_provider.stats if self.value_filler.price_provider else None,
+            }
+        else:
+            # the filler runs in other processes (filler.py)
+            counter = await TxCounter.get_for_network(self.network_id)
+            fill_n_done, fill_total = counter.done, max(1, counter.total)
+            fill_progress = 100 * fill_n_done / fill_total
+            value_filler_stats = {}
+
         return web.json_response({
             'tx_sync': {
                 'progress': scan_progress,
                 'local_tx_count': scan_n_local,
-                'remote_tx_count': scan_n_remote
+                'remote_tx_count': scan_n_remote,
+                'ingest': self.tx_storage.ingest.stats,
             },
             'value_fill': {
                 'progress': fill_progress,
                 'filled_tx': fill_n_done,
-                'total_tx': fill_total
-            }
+                'total_tx': fill_total,
+                'shards': await FillerShard.all_of_network(self.network_id, self.shard_max_age),
+                **value_filler_stats,
+            },
+            'leaderboard_cache': self.ranking_cache.stats if self.ranking_cache else None,
+            'leaderboard_requests': self.leaderboard_requests.stats,
         })
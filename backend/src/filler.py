@@ -0,0 +1,41 @@
+import logging
+import multiprocessing
+import time
+
+from helpers.config import Config
+from main import App
+
+# Standalone value filler: python filler.py [config.yaml]
+# Runs thorchain.value_filler.processes processes; each one fills its own shard of blocks (block_height % N).
+# Set thorchain.value_filler.enabled to false for the API process (main.py) with the same config then.
+
+RESTART_DELAY = 10.0  # sec
+
+
+def run_shard(shard, shards):
+    App().run_fill_shard(shard, shards)
+
+
+def main():
+    cfg = Config()
+    processes = max(1, cfg.as_int('thorchain.value_filler.processes', 1))
+    if processes == 1:
+        run_shard(0, 1)
+        return
+
+    workers = {}
+    while True:
+        for shard in range(processes):
+            worker = workers.get(shard)
+            if worker is None or not worker.is_alive():
+                if worker is not None:
+                    logging.error(f'Filler of shard {shard} has exited with code {worker.exitcode}, restarting.')
+                worker = multiprocessing.Process(target=run_shard, args=(shard, processes),
+                                                 name=f'filler-{shard}', daemon=True)
+                worker.start()
+                workers[shard] = worker
+        time.sleep(RESTART_DELAY)
+
+
+if __name__ == '__main__':
+    main()
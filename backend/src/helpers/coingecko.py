@@ -1,6 +1,13 @@
+import bisect
+import logging
+import time
+from array import array
+from typing import Dict, List, Tuple
+
 from aiohttp import ClientSession
 
-from helpers.datetime import HOUR, TemporalCache
+from helpers.datetime import HOUR, DAY
+from helpers.utils import SingleFlight
 
 COIN_GECKO_PRICE_HISTORY = "https://api.coingecko.com/api/v3/coins/{coin}/market_chart/range?" \
                            "vs_currency=usd&from={t_from}&to={t_to}"
@@ -8,29 +15,120 @@ COIN_GECKO_PRICE_HISTORY = "https://api.coingecko.com/api/v3/coins/{coin}/market
 COIN_GECKO_RUNE_SYMBOL = 'thorchain'
 COIN_GECKO_TIME_RANGE_SEC = 2400  # experimentally chosen
 
+COIN_GECKO_SPAN = 30 * DAY  # CoinGecko gives hourly points for the ranges up to 90 days
+COIN_GECKO_MAX_GAP = 3 * HOUR  # no price if the closest point is farther
+
+PricePoint = Tuple[int, float]  # timestamp, price
+
 
 class CoinGeckoPriceProvider:
-    def __init__(self, session: ClientSession, cache_precision=HOUR):
+    """
+    Historical Rune price. The series is requested by whole spans (one request per span)
+    and interpolated locally. The spans may be persisted with the store (see models.coingecko.CoinGeckoPriceStore).
+    Share one instance in the process.
+    """
+
+    def __init__(self, session: ClientSession, span=COIN_GECKO_SPAN, store=None, coin=COIN_GECKO_RUNE_SYMBOL,
+                 max_gap=COIN_GECKO_MAX_GAP):
         self.session = session
-        self.cache = TemporalCache(cache_precision)
+        self.span = span
+        self.store = store
+        self.coin = coin
+        self.max_gap = max_gap
+        self.logger = logging.getLogger('CoinGeckoPriceProvider')
+
+        self.timestamps = array('q')
+        self.prices = array('d')
+        self._covered_until: Dict[int, int] = {}  # span number => the span is known up to this timestamp
+        self._requests = SingleFlight()
+
+        self.n_lookups = 0
+        self.n_requests = 0
+
+    async def load(self):
+        """
+        Loads the spans requested before from the store.
+        """
+        if self.store is None:
+            return
+        ranges, points = await self.store.load(self.coin)
+        self._add_points(points)
+        for t_from, t_to in ranges:
+            self._cover(t_from, t_to)
+        self.logger.info(f'{len(points)} prices of {len(self._covered_until)} spans are loaded.')
+
+    def _cover(self, t_from, t_to):
+        for k in range(-(-t_from // self.span), t_to // self.span + 1):
+            if k * self.span >= t_from:
+                covered_until = min(t_to, (k + 1) * self.span)
+                self._covered_until[k] = max(self._covered_until.get(k, 0), covered_until)
 
-    async def _get_historical_rune_price(self, timestamp: int):
-        url = COIN_GECKO_PRICE_HISTORY.format(coin=COIN_GECKO_RUNE_SYMBOL,
-                                              t_from=timestamp - COIN_GECKO_TIME_RANGE_SEC,
-                                              t_to=timestamp + COIN_GECKO_TIME_RANGE_SEC)
+    def _is_covered(self, timestamp):
+        covered_until = self._covered_until.get(timestamp // self.span)
+        return covered_until is not None and timestamp <= covered_until
+
+    def _add_points(self, points: List[PricePoint]):
+        for timestamp, price in points:
+            i = bisect.bisect_left(self.timestamps, timestamp)
+            if i < len(self.timestamps) and self.timestamps[i] == timestamp:
+                self.prices[i] = price
+            else:
+                self.timestamps.insert(i, timestamp)
+                self.prices.insert(i, price)
+
+    async def _request_range(self, t_from, t_to) -> List[PricePoint]:
+        self.n_requests += 1
+        url = COIN_GECKO_PRICE_HISTORY.format(coin=self.coin, t_from=t_from, t_to=t_to)
         async with self.session.get(url) as resp:
+            if resp.status != 200:
+                raise ConnectionError(f'CoinGecko responded with HTTP {resp.status}')
             response_json = await resp.json()
-            prices = response_json.get('prices', [])
-            if prices:
-                return float(prices[0][1])
-            else:
-                return 0.0
+            return [(int(ms) // 1000, float(price)) for ms, price in response_json.get('prices', [])]
+
+    async def _fetch_span(self, k):
+        # a margin to have points on both sides of the span borders
+        t_from = k * self.span - COIN_GECKO_TIME_RANGE_SEC
+        t_to = min((k + 1) * self.span + COIN_GECKO_TIME_RANGE_SEC, int(time.time()))
+        points = await self._request_range(t_from, t_to)
+        self._add_points(points)
+        self._cover(k * self.span, t_to)
+        if self.store is not None:
+            await self.store.save(self.coin, k * self.span, t_to, points)
+
+    def price_at(self, timestamp) -> float:
+        """
+        :return: price interpolated from the known points, 0.0 if there is no point close enough
+        """
+        i = bisect.bisect_left(self.timestamps, timestamp)
+        n = len(self.timestamps)
+        if i < n and self.timestamps[i] == timestamp:
+            return self.prices[i]
+
+        before = i - 1 if i > 0 and timestamp - self.timestamps[i - 1] <= self.max_gap else None
+        after = i if i < n and self.timestamps[i] - timestamp <= self.max_gap else None
+        if before is not None and after is not None:
+            t0, t1 = self.timestamps[before], self.timestamps[after]
+            p0, p1 = self.prices[before], self.prices[after]
+            return p0 + (p1 - p0) * (timestamp - t0) / (t1 - t0)
+        elif before is not None:
+            return self.prices[before]
+        elif after is not None:
+            return self.prices[after]
+        return 0.0
 
     async def get_historical_rune_price(self, timestamp: int, cached=True):
-        old_value = self.cache[timestamp] if cached else None
-        if old_value:
-            return old_value
-        else:
-            value = await self._get_historical_rune_price(timestamp)
-            self.cache[timestamp] = value
-            return value
+        self.n_lookups += 1
+        timestamp = int(timestamp)
+        if not cached or not self._is_covered(timestamp):
+            k = timestamp // self.span
+            await self._requests.run(k, self._fetch_span, k)
+        return self.price_at(timestamp)
+
+    @property
+    def stats(self):
+        return {
+            'points': len(self.timestamps),
+            'spans': len(self._covered_until),
+            'lookups': self.n_lookups,
+            'requests': self.n_requests,
+        }
@@ -2,6 +2,50 @@ import os
 
 from tortoise import Tortoise
 
+# generate_schemas only creates missing tables, so new columns and indices of the existing ones go here
+POSTGRES_MIGRATIONS = [
+    'ALTER TABLE "thortx" ADD COLUMN IF NOT EXISTS "lease_until" BIGINT',
+    'ALTER TABLE "thortx" ADD COLUMN IF NOT EXISTS "lease_owner" VARCHAR(64)',
+    'ALTER TABLE "thortx" ADD COLUMN IF NOT EXISTS "priced_height" BIGINT',
+    # ThorTx.claim_unfilled: the fresh txs and the leased ones
+    'DROP INDEX IF EXISTS "idx_thortx_unfilled"',
+    'CREATE INDEX IF NOT EXISTS "idx_thortx_fresh" ON "thortx" ("network", "block_height") '
+    'WHERE "process_flags" = 0 AND "lease_until" IS NULL',
+    'CREATE INDEX IF NOT EXISTS "idx_thortx_leased" ON "thortx" ("network", "lease_until") '
+    'WHERE "process_flags" <= 0 AND "lease_until" IS NOT NULL',
+    # pools of a block used to be saved more than once by concurrent fill jobs: drop the copies, then forbid them.
+    # The index is named as the constraint generate_schemas makes for unique_together of a new table.
+    '''DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'uid_thorpoolmod_network_e68b95') THEN
+            DELETE FROM "thorpoolmodel" a USING "thorpoolmodel" b
+                WHERE a."network" = b."network" AND a."block_height" = b."block_height" AND a."pool" = b."pool"
+                AND a."id" > b."id";
+            CREATE UNIQUE INDEX "uid_thorpoolmod_network_e68b95"
+                ON "thorpoolmodel" ("network", "block_height", "pool");
+        END IF;
+    END $$''',
+    # the current CoinGecko span used to be saved as a new range every time it was requested again
+    '''DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE indexname = 'uid_coingeckora_coin_3a426e') THEN
+            DELETE FROM "coingeckorange" a USING "coingeckorange" b
+                WHERE a."coin" = b."coin" AND a."t_from" = b."t_from"
+                AND (a."t_to" < b."t_to" OR (a."t_to" = b."t_to" AND a."id" < b."id"));
+            CREATE UNIQUE INDEX "uid_coingeckora_coin_3a426e" ON "coingeckorange" ("coin", "t_from");
+        END IF;
+    END $$''',
+]
+
+
+MODELS = [
+    'models.tx',
+    'models.poolcache',
+    'models.scan',
+    'models.counters',
+    'models.rune_price',
+    'models.coingecko',
+    'models.user_volume',
+]
+
 
 class DB:
     @property
@@ -17,10 +61,13 @@ class DB:
         return connect_string
 
     async def start(self):
-        await Tortoise.init(db_url=self.connect_url, modules={
-            "models": [
-                "models.tx",
-                'models.poolcache'
-            ]
-        })
+        await Tortoise.init(db_url=self.connect_url, modules={"models": MODELS})
         await Tortoise.generate_schemas()
+        await self.migrate()
+
+    @staticmethod
+    async def migrate():
+        conn = Tortoise.get_connection('default')
+        if conn.capabilities.dialect == 'postgres':
+            for sql in POSTGRES_MIGRATIONS:
+                await conn.execute_script(sql)
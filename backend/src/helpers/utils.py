@@ -87,6 +87,41 @@ def a_result_cached(ttl=60):
     return decorator
 
 
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the coroutine,
+    the others await the same result (or exception) instead of running their own.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.n_calls = 0
+        self.n_shared = 0
+
+    async def run(self, key, func, *args, **kwargs):
+        self.n_calls += 1
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.n_shared += 1
+        # a cancelled caller must not cancel the call shared with the others
+        return await asyncio.shield(future)
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    @property
+    def stats(self):
+        return {
+            'in_flight': len(self._in_flight),
+            'calls': self.n_calls,
+            'shared': self.n_shared,
+        }
+
+
 def progressbar(x, total, symbol_width=10):
     if total <= 0:
         s = 0
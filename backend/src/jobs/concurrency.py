@@ -0,0 +1,112 @@
+import time
+from collections import deque
+from typing import Optional
+
+
+class AIMDController:
+    """
+    Number of concurrent workers: additive increase while THORNode answers fast and there is work to do,
+    multiplicative decrease on errors or slow answers.
+    With min_level == max_level the level is fixed.
+    """
+
+    def __init__(self, level: int, min_level=1, max_level: Optional[int] = None,
+                 target_latency=2.0, max_error_rate=0.1, increase_step=1, decrease_factor=0.5,
+                 work_per_worker=1, history_size=20):
+        self.min_level = max(1, min_level)
+        self.max_level = max(self.min_level, max_level if max_level is not None else level)
+        self.level = min(self.max_level, max(self.min_level, level))
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.work_per_worker = work_per_worker  # no more workers than backlog / work_per_worker
+        self.reason = 'initial'
+        self.history = deque(maxlen=history_size)
+        self.last_window = {}
+        self._reset_window()
+
+    @classmethod
+    def fixed(cls, level: int):
+        return cls(level, min_level=level, max_level=level)
+
+    @property
+    def is_fixed(self):
+        return self.min_level == self.max_level
+
+    def _reset_window(self):
+        self._n_ok = 0
+        self._n_errors = 0
+        self._latency_sum = 0.0
+
+    def observe(self, latency: float, ok: bool):
+        """
+        Records one THORNode request.
+        """
+        if ok:
+            self._n_ok += 1
+            self._latency_sum += latency
+        else:
+            self._n_errors += 1
+
+    @property
+    def error_rate(self):
+        n = self._n_ok + self._n_errors
+        return self._n_errors / n if n else 0.0
+
+    @property
+    def avg_latency(self):
+        return self._latency_sum / self._n_ok if self._n_ok else 0.0
+
+    def _decreased(self):
+        return max(self.min_level, int(self.level * self.decrease_factor))
+
+    def adjust(self, backlog: int) -> int:
+        """
+        Decides the new level from the requests observed since the last call.
+        :param backlog: number of txs waiting to be filled
+        :return: new level
+        """
+        error_rate, avg_latency = self.error_rate, self.avg_latency
+        self.last_window = {
+            'requests': self._n_ok + self._n_errors,
+            'error_rate': error_rate,
+            'avg_latency': avg_latency,
+            'backlog': backlog,
+        }
+        if self.is_fixed:
+            level, reason = self.level, 'fixed'
+        elif backlog <= 0:
+            level, reason = self.min_level, 'no backlog'
+        elif error_rate > self.max_error_rate:
+            level, reason = self._decreased(), f'error rate {error_rate:.0%} > {self.max_error_rate:.0%}'
+        elif avg_latency > self.target_latency:
+            level, reason = self._decreased(), f'latency {avg_latency:.2f}s > {self.target_latency:.2f}s'
+        elif backlog > self.level * self.work_per_worker:
+            level, reason = min(self.max_level, self.level + self.increase_step), \
+                            f'latency {avg_latency:.2f}s, backlog {backlog}'
+        else:
+            level, reason = min(self.level, max(self.min_level, -(-backlog // self.work_per_worker))), \
+                            f'backlog {backlog} is small'
+
+        if level != self.level:
+            self.history.append({
+                'ts': int(time.time()),
+                'from': self.level,
+                'to': level,
+                'reason': reason,
+            })
+        self.level, self.reason = level, reason
+        self._reset_window()
+        return level
+
+    @property
+    def stats(self):
+        return {
+            'level': self.level,
+            'min_level': self.min_level,
+            'max_level': self.max_level,
+            'reason': self.reason,
+            'last_window': self.last_window,
+            'history': list(self.history),
+        }
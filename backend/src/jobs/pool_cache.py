@@ -0,0 +1,126 @@
+import bisect
+from collections import OrderedDict, defaultdict
+from typing import NamedTuple, Dict, Optional, List, Tuple
+
+from helpers.coins import STABLE_COINS
+from helpers.utils import weighted_mean
+from models.poolcache import ThorPoolModel
+
+
+def usd_per_rune_from_pools(pools: List[ThorPoolModel]) -> Optional[float]:
+    """
+    Mean price of Rune in the stable coin pools weighted by their Rune depth. Empty pools are skipped.
+    """
+    rates, depths = [], []
+    for pool in pools:
+        if pool.pool in STABLE_COINS and int(pool.balance_rune) > 0:
+            rates.append(pool.assets_per_rune)
+            depths.append(int(pool.balance_rune))
+    if sum(depths) <= 0.0:
+        return None
+    return weighted_mean(rates, depths)
+
+
+class PoolSnapshot(NamedTuple):
+    """
+    Compact pool state at some block: only what valuation needs.
+    """
+    block_height: int
+    runes_per_asset: Dict[str, float]  # pools with zero depth are left out
+    usd_per_rune: Optional[float]  # from the stable coin pools, None if there are none
+
+    @classmethod
+    def from_pools(cls, block_height: int, pools: List[ThorPoolModel], usd_per_rune: Optional[float] = None):
+        if usd_per_rune is None:
+            usd_per_rune = usd_per_rune_from_pools(pools)
+        runes_per_asset = {}
+        for pool in pools:
+            if int(pool.balance_rune) != 0 and int(pool.balance_asset) != 0:
+                runes_per_asset[pool.pool] = pool.runes_per_asset
+        return cls(block_height, runes_per_asset, usd_per_rune)
+
+
+class PoolSnapshotCache:
+    """
+    LRU cache of PoolSnapshot by (network, block height).
+    Also keeps the cached heights sorted to find the nearest block.
+    """
+
+    def __init__(self, max_size=10_000):
+        assert max_size >= 1
+        self.max_size = max_size
+        self._cache: 'OrderedDict[Tuple[str, int], PoolSnapshot]' = OrderedDict()
+        self._heights: Dict[str, List[int]] = defaultdict(list)
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, network_id: str, block_height: int) -> Optional[PoolSnapshot]:
+        key = (network_id, block_height)
+        snapshot = self._cache.get(key)
+        if snapshot is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        return snapshot
+
+    def peek(self, network_id: str, block_height: int) -> Optional[PoolSnapshot]:
+        """
+        Like get but neither counts in the stats nor refreshes the entry.
+        """
+        return self._cache.get((network_id, block_height))
+
+    def nearest_height(self, network_id: str, block_height: int, tolerance: int) -> Optional[int]:
+        heights = self._heights.get(network_id)
+        if not heights:
+            return None
+
+        i = bisect.bisect_left(heights, block_height)
+        candidates = [h for h in heights[max(0, i - 1):i + 1] if abs(h - block_height) <= tolerance]
+        return min(candidates, key=lambda h: abs(h - block_height)) if candidates else None
+
+    def nearest(self, network_id: str, block_height: int, tolerance: int) -> Optional[PoolSnapshot]:
+        """
+        :return: snapshot of the closest cached block within the tolerance (the lower one of two equally close)
+        """
+        nearest_height = self.nearest_height(network_id, block_height, tolerance)
+        if nearest_height is None:
+            return None
+
+        self.near_hits += 1
+        key = (network_id, nearest_height)
+        self._cache.move_to_end(key)
+        return self._cache[key]
+
+    def put(self, network_id: str, snapshot: PoolSnapshot):
+        key = (network_id, snapshot.block_height)
+        if key not in self._cache:
+            bisect.insort(self._heights[network_id], snapshot.block_height)
+        self._cache[key] = snapshot
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            (evicted_network, evicted_height), _ = self._cache.popitem(last=False)
+            heights = self._heights[evicted_network]
+            del heights[bisect.bisect_left(heights, evicted_height)]
+            self.evictions += 1
+
+    def __contains__(self, key: Tuple[str, int]):
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
+
+    @property
+    def stats(self):
+        n = self.hits + self.misses
+        return {
+            'size': len(self._cache),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / n if n else 0.0,
+        }
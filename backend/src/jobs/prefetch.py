@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from typing import Set
+
+from tenacity import RetryError
+
+from models.poolcache import ThorPoolModel
+from models.tx import ThorTx
+
+
+class PoolPrefetcher:
+    """
+    Looks ahead at the next blocks of the unfilled backlog and puts their pool snapshots to the cache
+    of the ValueFiller before its jobs come for them.
+    A prefetched snapshot is a hit when a job takes it from the cache, and wasted if it's evicted before that.
+    """
+
+    def __init__(self, filler, lookahead=50, max_requests=4, period=1.0):
+        self.filler = filler  # ValueFiller
+        self.lookahead = lookahead  # blocks
+        self.max_requests = max_requests  # concurrent THORNode requests per round
+        self.period = period
+        self.logger = logging.getLogger('PoolPrefetcher')
+
+        self._pending: Set[int] = set()  # prefetched heights which have not been used yet
+
+        self.n_fetched = 0  # from THORNode
+        self.n_loaded = 0  # from the DB
+        self.n_failed = 0
+        self.n_hits = 0
+        self.n_wasted = 0
+
+    def on_use(self, block_height):
+        """
+        A job has taken the snapshot of the block from the cache.
+        """
+        if block_height in self._pending:
+            self._pending.discard(block_height)
+            self.n_hits += 1
+
+    def _is_cached(self, block_height):
+        filler = self.filler
+        if (filler.network_id, block_height) in filler.pool_cache:
+            return True
+        tolerance = filler.price_height_tolerance
+        if tolerance <= 0:
+            return False
+        return filler.pool_cache.nearest_height(filler.network_id, block_height, tolerance) is not None
+
+    def _count_wasted(self):
+        for block_height in list(self._pending):
+            if (self.filler.network_id, block_height) not in self.filler.pool_cache:
+                self._pending.discard(block_height)
+                self.n_wasted += 1
+
+    async def _fetch(self, block_height):
+        filler = self.filler
+        try:
+            pools = await filler.pool_requests.run((filler.network_id, block_height),
+                                                   filler.request_pools_and_cache_them, block_height)
+        except RetryError:
+            pools = None
+
+        if pools:
+            filler.cache_pool_snapshot(block_height, pools)
+            self._pending.add(block_height)
+            self.n_fetched += 1
+        else:
+            self.n_failed += 1
+
+    async def prefetch_once(self):
+        filler = self.filler
+        self._count_wasted()
+
+        heights = await ThorTx.next_unclaimed_heights(filler.network_id, self.lookahead,
+                                                      max_fails=filler.max_fails_of_tx,
+                                                      shard=filler.shard, shards=filler.shards)
+        tolerance = filler.price_height_tolerance
+        wanted = []
+        for block_height in heights:
+            if self._is_cached(block_height):
+                continue
+            if tolerance > 0 and wanted and block_height - wanted[-1] <= tolerance:
+                continue  # the snapshot of the previous one will do
+            wanted.append(block_height)
+        if not wanted:
+            return
+
+        in_db = await ThorPoolModel.heights_in_db(filler.network_id, wanted)
+        for block_height in sorted(in_db):
+            pools = await ThorPoolModel.find_pools(filler.network_id, block_height)
+            filler.cache_pool_snapshot(block_height, pools)
+            self._pending.add(block_height)
+            self.n_loaded += 1
+
+        to_fetch = [h for h in wanted if h not in in_db][:self.max_requests]
+        await asyncio.gather(*(self._fetch(h) for h in to_fetch))
+
+    async def run(self):
+        while True:
+            try:
+                await self.prefetch_once()
+            except Exception:
+                self.logger.exception('prefetch failed')
+            await asyncio.sleep(self.period)
+
+    @property
+    def stats(self):
+        n_done = self.n_hits + self.n_wasted
+        return {
+            'lookahead': self.lookahead,
+            'fetched': self.n_fetched,
+            'loaded': self.n_loaded,
+            'failed': self.n_failed,
+            'pending': len(self._pending),
+            'hits': self.n_hits,
+            'wasted': self.n_wasted,
+            'hit_rate': self.n_hits / n_done if n_done else 0.0,
+        }
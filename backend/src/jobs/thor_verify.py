@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from random import Random
+from typing import List, Optional, Dict, Tuple
+
+from aiothornode.connector import ThorConnector
+from aiothornode.types import ThorPool
+
+from helpers.coins import STABLE_COINS
+
+ANY_NODE = '*'  # the connector picks the node itself (no node list is known)
+
+
+def check_pools(pools: List[ThorPool], reference_usd_per_rune: Optional[float] = None,
+                max_price_deviation=0.25) -> List[str]:
+    """
+    Sanity checks of the pools at a block answered by a single node.
+    :param reference_usd_per_rune: Rune price at a neighbouring block; if given, the stable coin pools are expected
+        and their price must be within max_price_deviation (relative) of it
+    :return: problems found, empty if the answer looks fine
+    """
+    if not pools:
+        return ['no pools']
+
+    problems = []
+    for pool in pools:
+        if pool.status == ThorPool.STATUS_AVAILABLE and (pool.balance_rune_int <= 0 or pool.balance_asset_int <= 0):
+            problems.append(f'zero depth of {pool.asset}')
+
+    stable_pools = [p for p in pools if p.asset in STABLE_COINS and p.balance_rune_int > 0 and p.balance_asset_int > 0]
+    if reference_usd_per_rune:
+        if not stable_pools:
+            problems.append('no stable coin pools')
+        else:
+            rune_depth = sum(p.balance_rune_int for p in stable_pools)
+            usd_per_rune = sum(p.balance_asset_int for p in stable_pools) / rune_depth
+            deviation = abs(usd_per_rune / reference_usd_per_rune - 1.0)
+            if deviation > max_price_deviation:
+                problems.append(f'price {usd_per_rune:.4f} is {deviation:.0%} away from {reference_usd_per_rune:.4f}')
+    return problems
+
+
+def pools_fingerprint(pools: List[ThorPool]) -> Tuple:
+    return tuple(sorted((p.asset, p.balance_asset, p.balance_rune, p.status) for p in pools))
+
+
+class NodeStats:
+    def __init__(self, latency_smoothing=0.2):
+        self.requests = 0
+        self.errors = 0
+        self.agreements = 0
+        self.disagreements = 0
+        self.latency = 0.0  # exponential moving average of successful requests, sec
+        self._smoothing = latency_smoothing
+
+    def observe(self, latency: float, ok: bool):
+        self.requests += 1
+        if ok:
+            self.latency = latency if self.requests - self.errors == 1 else \
+                self.latency + self._smoothing * (latency - self.latency)
+        else:
+            self.errors += 1
+
+    @property
+    def error_rate(self):
+        return self.errors / self.requests if self.requests else 0.0
+
+    @property
+    def disagreement_rate(self):
+        n = self.agreements + self.disagreements
+        return self.disagreements / n if n else 0.0
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'agreements': self.agreements,
+            'disagreements': self.disagreements,
+            'latency': self.latency,
+        }
+
+
+class PoolVerifier:
+    """
+    Single-node-first pool requests: the pools are asked from one node, the fastest trustworthy one.
+    Consensus of several nodes is asked only when the answer fails the sanity checks (see check_pools)
+    or for a random sample of blocks. The nodes out of the consensus lose the trust.
+    """
+
+    def __init__(self, connector: ThorConnector, sample_rate=0.02, max_price_deviation=0.25,
+                 consensus_min=2, consensus_total=3, max_error_rate=0.2, max_disagreement_rate=0.05,
+                 min_requests=3, rng: Optional[Random] = None):
+        assert 1 <= consensus_min <= consensus_total
+        self.connector = connector
+        self.sample_rate = sample_rate
+        self.max_price_deviation = max_price_deviation
+        self.consensus_min = consensus_min
+        self.consensus_total = consensus_total
+        self.max_error_rate = max_error_rate
+        self.max_disagreement_rate = max_disagreement_rate
+        self.min_requests = min_requests  # every node is tried that many times before it's judged by its speed
+        self.rng = rng or Random()
+        self.logger = logging.getLogger('PoolVerifier')
+
+        self.nodes: Dict[str, NodeStats] = {}
+
+        self.n_single = 0
+        self.n_escalated_sanity = 0
+        self.n_escalated_sample = 0
+        self.n_no_consensus = 0
+
+    def _node_stats(self, client) -> NodeStats:
+        key = client.node_ip if client is not None else ANY_NODE
+        stats = self.nodes.get(key)
+        if stats is None:
+            stats = self.nodes[key] = NodeStats()
+        return stats
+
+    def is_trusted(self, stats: NodeStats):
+        return stats.error_rate <= self.max_error_rate and stats.disagreement_rate <= self.max_disagreement_rate
+
+    async def _clients(self) -> list:
+        await self.connector.get_random_clients()  # updates the node list from time to time
+        clients = self.connector.client_list_except_banned()
+        return clients or [None]
+
+    def rank_clients(self, clients: list) -> list:
+        """
+        :return: clients from the most preferred: untried ones first, then the trusted ones by latency,
+            then the rest by latency
+        """
+        def key(client):
+            stats = self._node_stats(client)
+            if stats.requests < self.min_requests:
+                return False, False, stats.requests
+            return True, not self.is_trusted(stats), stats.latency
+
+        return sorted(clients, key=key)
+
+    async def _query(self, block_height, client) -> Optional[List[ThorPool]]:
+        stats = self._node_stats(client)
+        t0 = time.monotonic()
+        try:
+            pools = await self.connector.query_pools(block_height,
+                                                     clients=[client] if client is not None else None,
+                                                     consensus=False)
+        except Exception as e:
+            self.logger.warning(f'{client} failed to answer pools at #{block_height}: {e!r}')
+            pools = None
+        stats.observe(time.monotonic() - t0, ok=bool(pools))
+        return pools
+
+    async def _consensus(self, block_height, clients: list, first_pools: List[ThorPool]) -> List[ThorPool]:
+        answers = [first_pools] + list(await asyncio.gather(*(self._query(block_height, c) for c in clients[1:])))
+        fingerprints = [pools_fingerprint(pools) if pools else None for pools in answers]
+        counter = Counter(f for f in fingerprints if f is not None)
+        best, n_agreed = counter.most_common(1)[0] if counter else (None, 0)
+
+        if n_agreed < min(self.consensus_min, len(clients)):
+            self.n_no_consensus += 1
+            raise ConnectionError(f'no consensus on pools at #{block_height}: '
+                                  f'{n_agreed} of {len(clients)} nodes agreed')
+
+        for client, fingerprint in zip(clients, fingerprints):
+            if fingerprint is not None:
+                stats = self._node_stats(client)
+                if fingerprint == best:
+                    stats.agreements += 1
+                else:
+                    stats.disagreements += 1
+                    self.logger.warning(f'{client} disagrees with the consensus on pools at #{block_height}')
+        return answers[fingerprints.index(best)]
+
+    async def query_pools(self, block_height, reference_usd_per_rune: Optional[float] = None) -> List[ThorPool]:
+        """
+        :param reference_usd_per_rune: Rune price at a neighbouring block if known (see check_pools)
+        :raises ConnectionError: if no node answered or the nodes didn't agree
+        """
+        clients = self.rank_clients(await self._clients())
+
+        pools, first = None, 0
+        while not pools and first < len(clients):  # the next one if the preferred node doesn't answer
+            pools = await self._query(block_height, clients[first])
+            first += 1
+        if not pools:
+            raise ConnectionError(f'no node answered pools at #{block_height}')
+        clients = clients[first - 1:]
+
+        problems = check_pools(pools, reference_usd_per_rune, self.max_price_deviation)
+        if problems:
+            self.n_escalated_sanity += 1
+            self.logger.warning(f'pools at #{block_height} from {clients[0]}: {"; ".join(problems)}. '
+                                f'Asking for consensus.')
+        elif self.rng.random() < self.sample_rate:
+            self.n_escalated_sample += 1
+        else:
+            self.n_single += 1
+            return pools
+
+        if clients == [None]:  # no node list: the connector asks its own consensus
+            return await self.connector.query_pools(block_height)
+        return await self._consensus(block_height, clients[:self.consensus_total], pools)
+
+    @property
+    def stats(self):
+        n = self.n_single + self.n_escalated_sanity + self.n_escalated_sample
+        return {
+            'single': self.n_single,
+            'escalated_sanity': self.n_escalated_sanity,
+            'escalated_sample': self.n_escalated_sample,
+            'no_consensus': self.n_no_consensus,
+            'escalation_rate': (n - self.n_single) / n if n else 0.0,
+            'nodes': {ip: stats.as_dict() for ip, stats in self.nodes.items()},
+        }
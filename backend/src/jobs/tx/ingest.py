@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import List, Optional, Callable, Awaitable
+
+from tortoise.transactions import in_transaction
+
+from models.counters import TxCounter
+from models.tx import ThorTx
+from models.user_volume import UserVolumeDay
+
+OnCommitted = Callable[[int], Awaitable]
+
+
+@dataclass
+class IngestPage:
+    network_id: str
+    txs: List[ThorTx]
+    on_committed: Optional[OnCommitted] = None
+    future: Optional[asyncio.Future] = None
+    queued_at: float = 0.0
+
+
+async def write_pages(pages: List[IngestPage]) -> List[int]:
+    """
+    Writes several pages with one insert in one transaction along with the counters and the volume rollup.
+    :return: number of new rows of each page
+    """
+    async with in_transaction():
+        new_hashes = await ThorTx.insert_unique([tx for page in pages for tx in page.txs])
+
+        new_counts, per_network, new_txs = [], defaultdict(int), []
+        for page in pages:
+            n = 0
+            for tx in page.txs:
+                if tx.hash in new_hashes:
+                    new_hashes.discard(tx.hash)  # the same tx may come twice in adjacent pages
+                    new_txs.append(tx)
+                    n += 1
+            new_counts.append(n)
+            per_network[page.network_id] += n
+
+        for network_id, n in per_network.items():
+            await TxCounter.add(network_id, total=n)
+        await UserVolumeDay.add_new_swaps(new_txs)
+
+    return new_counts
+
+
+class TxIngestQueue:
+    """
+    Write-behind stage between the scanner and the DB.
+    The writer task merges the pages waiting in the queue into one bulk write.
+    put() blocks while the queue is full, so a slow DB slows down the scanner, but no more than that.
+    """
+
+    def __init__(self, max_pages=16, max_pages_per_write=8):
+        assert max_pages >= 1 and max_pages_per_write >= 1
+        self.max_pages = max_pages
+        self.max_pages_per_write = max_pages_per_write
+        self.logger = logging.getLogger('TxIngestQueue')
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+
+        self.n_writes = 0
+        self.n_pages = 0
+        self.n_errors = 0
+        self.last_write_latency = 0.0
+        self.max_write_latency = 0.0
+        self._total_write_latency = 0.0
+        self.last_queue_wait = 0.0
+
+    def _ensure_writer(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_pages)
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._writer_loop())
+
+    async def put(self, network_id: str, txs: List[ThorTx], on_committed: Optional[OnCommitted] = None):
+        """
+        :param on_committed: coroutine function called with the number of new rows after the page is committed
+        :return: future with the number of new rows of the page
+        """
+        self._ensure_writer()
+        future = asyncio.get_event_loop().create_future()
+        page = IngestPage(network_id, txs, on_committed, future, time.monotonic())
+        await self._queue.put(page)
+        return future
+
+    async def join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _writer_loop(self):
+        while True:
+            pages = [await self._queue.get()]
+            while len(pages) < self.max_pages_per_write and not self._queue.empty():
+                pages.append(self._queue.get_nowait())
+            try:
+                await self._write(pages)
+            finally:
+                for _ in pages:
+                    self._queue.task_done()
+
+    async def _write(self, pages: List[IngestPage]):
+        t0 = time.monotonic()
+        self.last_queue_wait = t0 - pages[0].queued_at
+        try:
+            new_counts = await write_pages(pages)
+        except Exception as e:
+            self.n_errors += 1
+            self.logger.exception(f'failed to write {len(pages)} pages')
+            for page in pages:
+                page.future.set_exception(e)
+            return
+
+        latency = time.monotonic() - t0
+        self.n_writes += 1
+        self.n_pages += len(pages)
+        self.last_write_latency = latency
+        self.max_write_latency = max(self.max_write_latency, latency)
+        self._total_write_latency += latency
+
+        for page, new_count in zip(pages, new_counts):
+            if page.on_committed:
+                try:
+                    await page.on_committed(new_count)
+                except Exception:
+                    self.logger.exception('on_committed callback failed')
+            page.future.set_result(new_count)
+
+    @property
+    def depth(self):
+        return self._queue.qsize() if self._queue else 0
+
+    @property
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_pages,
+            'writes': self.n_writes,
+            'pages': self.n_pages,
+            'errors': self.n_errors,
+            'pages_per_write': self.n_pages / self.n_writes if self.n_writes else 0.0,
+            'last_write_latency': self.last_write_latency,
+            'avg_write_latency': self._total_write_latency / self.n_writes if self.n_writes else 0.0,
+            'max_write_latency': self.max_write_latency,
+            'last_queue_wait': self.last_queue_wait,
+        }
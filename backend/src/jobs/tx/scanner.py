@@ -2,7 +2,7 @@ import asyncio
 import logging
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Dict
 
 import aiohttp
 
@@ -68,6 +68,12 @@ class ITxDelegate(ABC):
     async def on_scan_start(self, scanner: 'TxScanner'):
         ...
 
+    async def on_scan_finish(self, scanner: 'TxScanner'):
+        """
+        Called once the scan is over. scanner.reached_end tells if the whole history has been walked.
+        """
+        ...
+
 
 @dataclass
 class TxScanner:
@@ -82,6 +88,9 @@ class TxScanner:
     stop_flag: bool = False
     offset: int = 0
     batch_size: int = 50
+    concurrent_pages: int = 1
+    reached_end: bool = False
+    _window: int = 1
 
     async def request_transaction_list(self, offset=0, limit=50):
         url = self.midgard_url_gen.url_for_tx(offset, limit)
@@ -90,6 +99,35 @@ class TxScanner:
             response_json = await resp.json()
             return self.parser.parse_tx_response(response_json)
 
+    def _fill_window(self, pending: Dict[int, asyncio.Task]):
+        """
+        Keeps up to "concurrent_pages" requests in flight starting from the current offset.
+        The window starts with one page and doubles with every delivered page,
+        so short head scans do not waste requests.
+        Requests that fell out of the window (e.g. after rewind) are cancelled.
+        A failed request is not repeated here: run_scan retries the page once it comes to it.
+        """
+        window = [self.offset + i * self.batch_size for i in range(self._window)]
+        for offset in list(pending.keys()):
+            if offset not in window:
+                self._discard(pending.pop(offset))
+        for offset in window:
+            if offset not in pending:
+                pending[offset] = asyncio.create_task(self.request_transaction_list(offset, self.batch_size))
+
+    @staticmethod
+    def _discard(task: asyncio.Task):
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception()  # it's not needed anymore, but must be retrieved
+
+    @classmethod
+    def _cancel_window(cls, pending: Dict[int, asyncio.Task]):
+        for task in pending.values():
+            cls._discard(task)
+        pending.clear()
+
     def stop_scan(self):
         self.working = False
 
@@ -106,44 +144,57 @@ class TxScanner:
             self.logger.warning("I'm still working")
             return
         self.working = True
+        self.reached_end = False
         self.offset = start
+        self._window = 1
 
         current_retry = 0
         total_tx_got = 0
+        pending: Dict[int, asyncio.Task] = {}
 
         await self.delegate.on_scan_start(self)
 
-        while self.working:
-            try:
-                tx_results = await self.request_transaction_list(self.offset, batch_size)
-
-                if not tx_results.tx_count_unfiltered:
-                    self.logger.warning(f'no more TX, retry once after {self.sleep_before_retry:.1f} sec...')
+        try:
+            while self.working:
+                try:
+                    self._fill_window(pending)
+                    # pages are handed to the delegate strictly in the offset order
+                    tx_results = await pending.pop(self.offset)
+
+                    if not tx_results.tx_count_unfiltered:
+                        self.logger.warning(f'no more TX, retry once after {self.sleep_before_retry:.1f} sec...')
+                        await asyncio.sleep(self.sleep_before_retry)
+                        tx_results = await self.request_transaction_list(self.offset, self.batch_size)
+
+                    if not tx_results.tx_count_unfiltered:
+                        self.logger.warning(f'scan stop. reason: no more tx; total tx = {total_tx_got}')
+                        self.reached_end = True
+                        break
+
+                    total_tx_got += tx_results.tx_count
+
+                    to_continue = await self.delegate.on_transactions(tx_results, self)
+                    if not to_continue:
+                        self.logger.info(f'scan stop. reason: delegate insists to stop; total tx = {total_tx_got}')
+                        break
+
+                except Exception as e:
+                    self.logger.exception(f'exception has been raised while tx scanning: {e!r}. '
+                                          f'retry after {self.sleep_before_retry:.1f} sec...')
+                    current_retry += 1
+                    if current_retry > self.retries:
+                        self.logger.error(f'retry limit reached; stopping scan! total tx = {total_tx_got}')
+                        break
                     await asyncio.sleep(self.sleep_before_retry)
-                    tx_results = await self.request_transaction_list(self.offset, batch_size)
-
-                if not tx_results.tx_count_unfiltered:
-                    self.logger.warning(f'scan stop. reason: no more tx; total tx = {total_tx_got}')
-                    break
-
-                total_tx_got += tx_results.tx_count
-
-                to_continue = await self.delegate.on_transactions(tx_results, self)
-                if not to_continue:
-                    self.logger.info(f'scan stop. reason: delegate insists to stop; total tx = {total_tx_got}')
-                    break
-
-            except Exception as e:
-                self.logger.exception(f'exception has been raised while tx scanning: {e!r}. '
-                                      f'retry after {self.sleep_before_retry:.1f} sec...')
-                current_retry += 1
-                if current_retry > self.retries:
-                    self.logger.error(f'retry limit reached; stopping scan! total tx = {total_tx_got}')
-                    break
-                await asyncio.sleep(self.sleep_before_retry)
-            else:
-                current_retry = 0
-                self.offset += self.batch_size
-
-        self.logger.info('finished')
-        self.working = False
+                else:
+                    current_retry = 0
+                    self.offset += self.batch_size
+                    self._window = min(self._window * 2, max(1, self.concurrent_pages))
+        finally:
+            self._cancel_window(pending)
+
+        try:
+            await self.delegate.on_scan_finish(self)
+        finally:
+            self.logger.info('finished')
+            self.working = False
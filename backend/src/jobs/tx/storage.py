@@ -1,10 +1,13 @@
+import asyncio
 import logging
-import random
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field
+from typing import Optional, List
 
+from jobs.tx.ingest import TxIngestQueue
 from jobs.tx.parser import TxParseResult
 from jobs.tx.scanner import ITxDelegate, TxScanner
+from models.counters import TxCounter
+from models.scan import ScanWatermark, ScanCheckpoint
 from models.tx import ThorTx
 
 
@@ -14,54 +17,158 @@ class TxStorage(ITxDelegate):
     last_page_counter: int = 0
     overscan_pages: int = 10
     logger = logging.getLogger('TxStorage')
-    jump_down_flag: bool = False
     last_tx_result: Optional[TxParseResult] = None
+    watermark: Optional[ScanWatermark] = None
+    _next_watermark: Optional[ThorTx] = None
+    has_backfill: bool = False
+    ingest: TxIngestQueue = field(default_factory=TxIngestQueue)
+    _pending_pages: List[asyncio.Future] = field(default_factory=list)
+    _ingest_failed: bool = False
 
     async def on_scan_start(self, scanner: TxScanner):
         self.last_page_counter = 0
-        self.jump_down_flag = False
+        self._next_watermark = None
+        self._pending_pages = []
+        self._ingest_failed = False
+        self.watermark = await ScanWatermark.load(scanner.parser.network_id)
+        if self.watermark and not self.full_scan:
+            self.logger.info(f'head scan down to {self.watermark}')
 
     async def on_transactions(self, tx_results: TxParseResult, scanner: TxScanner) -> bool:
-        new_count = 0
-        for tx in tx_results.txs:
-            if await tx.save_unique():
-                new_count += 1
+        txs = tx_results.txs
+        # the page is written behind; we wait for it only if the decision depends on the number of new rows
+        page_future = await self._submit(tx_results, txs, next_offset=scanner.offset + scanner.batch_size)
 
         # save last results for statistics
         if not self.last_tx_result or tx_results.total_count:
             self.last_tx_result = tx_results
 
+        if scanner.offset == 0 and tx_results.txs:
+            # the first page holds the newest tx; it becomes the next mark once we are done
+            self._next_watermark = max(tx_results.txs, key=lambda tx: tx.block_height or 0)
+
+        if self.full_scan:
+            return True
+
+        if self.watermark:
+            if any(self.watermark.is_reached_by(tx) for tx in tx_results.txs):
+                self.logger.info(f'scan has reached {self.watermark}')
+                await self._commit_watermark(scanner)
+                return False  # STOP SCANNING
+        elif self.has_backfill:
+            # the deep history is walked by TxBackfillStorage which also sets the first mark
+            self.logger.info('no watermark yet; waiting for back-fill to set it')
+            return False  # STOP SCANNING
+        elif await page_future == 0:
+            # no mark yet (e.g. the DB was filled by an older version) => fall back to over scan
+            self.last_page_counter += 1
+            if self.last_page_counter > self.overscan_pages:
+                await self._commit_watermark(scanner)
+                return False  # STOP SCANNING
+            self.logger.info(f'over scan: {self.last_page_counter} pages')
+        else:
+            self.last_page_counter = 0  # reset if found new tx
+
+        return True
+
+    async def _submit(self, tx_results: TxParseResult, txs: List[ThorTx], next_offset: int) -> asyncio.Future:
+        async def on_committed(new_count):
+            await self._on_page_committed(tx_results, txs, next_offset, new_count)
+
+        future = await self.ingest.put(tx_results.network_id, txs, on_committed)
+        future.add_done_callback(self._on_page_done)
+        self._pending_pages = [f for f in self._pending_pages if not f.done()] + [future]
+        return future
+
+    def _on_page_done(self, future: asyncio.Future):
+        if future.cancelled() or future.exception():
+            self._ingest_failed = True
+
+    async def _on_page_committed(self, tx_results: TxParseResult, txs: List[ThorTx], next_offset: int, new_count: int):
         n_local, n_remote, percent = await self.get_scan_progress()
         if n_remote:
             self.logger.info(f'Scan progress: {percent:.2f} % ({n_local} / {n_remote}) and '
                              f'{new_count} TXS added this iteration')
 
-        if not self.full_scan:
-            if new_count == 0:  # all tx are already in out DB
-                self.last_page_counter += 1
-                if self.last_page_counter > self.overscan_pages:
-                    # overscan has failed => try jump to a random location and scan there
-                    if not self.jump_down_flag:
-                        jump_location = random.randint(0, self.last_tx_result.total_count)
-                        self.logger.warning(f'jumping to {jump_location} offset to discover any new tx')
-                        scanner.rewind(jump_location)
-                        self.last_page_counter = 0
-                        self.jump_down_flag = True
-                    else:
-                        return False  # STOP SCANNING
-                self.logger.info(f'over scan: {self.last_page_counter} pages')
-            else:
-                self.last_page_counter = 0  # reset if found new tx
+    async def _wait_pending_pages(self):
+        """
+        :return: True if all pages of this scan have been committed
+        """
+        await asyncio.gather(*self._pending_pages, return_exceptions=True)
+        self._pending_pages = []
+        return not self._ingest_failed
 
-        return True
+    async def on_scan_finish(self, scanner: TxScanner):
+        if scanner.reached_end:
+            # the whole history has been walked
+            await self._commit_watermark(scanner)
+
+    async def _commit_watermark(self, scanner: TxScanner):
+        if not await self._wait_pending_pages():
+            self.logger.error('some pages have not been written; the watermark is kept')
+            return
+        if self._next_watermark:
+            self.watermark = await ScanWatermark.put(scanner.parser.network_id, self._next_watermark)
+            self._next_watermark = None
+            self.logger.info(f'new {self.watermark}')
 
     async def get_scan_progress(self):
-        n_local = await ThorTx.count_of_transactions_for_network(self.last_tx_result.network_id)
+        n_local = (await TxCounter.get_for_network(self.last_tx_result.network_id)).total
         n_remote = self.last_tx_result.total_count
         percent = 100 * n_local / n_remote if n_remote else 0.0
         return n_local, n_remote, percent
 
 
+@dataclass
+class TxBackfillStorage(TxStorage):
+    """
+    Walks the entire history down to the very first tx and saves its progress after each page,
+    so the walk resumes from the same place after restart.
+    """
+    full_scan: bool = True
+    logger = logging.getLogger('TxBackfill')
+    checkpoint: Optional[ScanCheckpoint] = None
+
+    async def on_scan_start(self, scanner: TxScanner):
+        await super().on_scan_start(scanner)
+        self.checkpoint = await ScanCheckpoint.load(scanner.parser.network_id)
+
+    async def on_transactions(self, tx_results: TxParseResult, scanner: TxScanner) -> bool:
+        if self._ingest_failed:
+            self.logger.error('stop: some pages have not been written; will resume from the checkpoint')
+            return False
+
+        to_continue = await super().on_transactions(tx_results, scanner)
+
+        if scanner.offset == 0 and not self.watermark:
+            # everything below the first page is going to be walked by us, so the head scan may start from here
+            await self._commit_watermark(scanner)
+
+        return to_continue
+
+    async def _on_page_committed(self, tx_results: TxParseResult, txs: List[ThorTx], next_offset: int, new_count: int):
+        await super()._on_page_committed(tx_results, txs, next_offset, new_count)
+
+        if self._ingest_failed:
+            return  # an earlier page is lost; the checkpoint must not go past it
+
+        heights = [tx.block_height for tx in tx_results.txs if tx.block_height]
+        if self.checkpoint and self.checkpoint.last_height:
+            heights.append(self.checkpoint.last_height)
+        self.checkpoint = await ScanCheckpoint.put(tx_results.network_id,
+                                                   offset=next_offset,
+                                                   last_height=min(heights, default=0),
+                                                   total_count=tx_results.total_count)
+
+    async def on_scan_finish(self, scanner: TxScanner):
+        if not await self._wait_pending_pages():
+            return
+        if scanner.reached_end and self.checkpoint:
+            self.checkpoint.finished = True
+            await self.checkpoint.save()
+            self.logger.info(f'back-fill is done: {self.checkpoint}')
+
+
 @dataclass
 class TxStorageMock(ITxDelegate):
     full_scan: bool = False
@@ -1,21 +1,31 @@
 import asyncio
 import datetime
 import logging
+import os
+import socket
 import time
-from dataclasses import dataclass
-from typing import List
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
 
 import names
 from aiothornode.connector import ThorConnector, ThorEnvironment
 from aiothornode.env import TEST_NET_ENVIRONMENT_MULTI_1, CHAOS_NET_BNB_ENVIRONMENT, MULTICHAIN_CHAOSNET_ENVIRONMENT
 from tenacity import retry, stop_after_attempt, RetryError
+from tortoise.transactions import in_transaction
 
 from helpers.coingecko import CoinGeckoPriceProvider
-from helpers.coins import STABLE_COINS
 from helpers.constants import NetworkIdents
-from helpers.utils import weighted_mean, progressbar
+from helpers.utils import progressbar, SingleFlight
+from jobs.concurrency import AIMDController
+from jobs.pool_cache import PoolSnapshotCache, PoolSnapshot
+from jobs.prefetch import PoolPrefetcher
+from jobs.thor_verify import PoolVerifier
+from models.counters import TxCounter, FillerShard
 from models.poolcache import ThorPoolModel
+from models.rune_price import RunePrice, RunePriceIndex
 from models.tx import ThorTx
+from models.user_volume import UserVolumeDay
 
 
 def get_thor_env_by_network_id(network_id) -> ThorEnvironment:
@@ -44,61 +54,218 @@ class ValueFiller:
     progress_every_n_iter: int = 30
     _last_time: float = 0.0
     sleep_on_error: float = 0.5
+    batch_size: int = 1
+    lease_sec: int = 300
+    retry_delay_sec: int = 60  # a tx that failed n times is not taken again for n * retry_delay_sec
+    _n_processed: int = 0
+    pool_cache: PoolSnapshotCache = field(default_factory=PoolSnapshotCache)
+    pool_requests: SingleFlight = field(default_factory=SingleFlight)
+    rune_prices: RunePriceIndex = field(default_factory=RunePriceIndex)
+    price_provider: Optional[CoinGeckoPriceProvider] = None  # for the blocks without stable coin pools
+    price_height_tolerance: int = 0  # blocks; > 0: a tx may be priced with pools of a nearby block
+
+    concurrency: Optional[AIMDController] = None  # fixed at concurrent_jobs if not given
+    adjust_period: float = 10.0  # sec
+    shard: int = 0  # this filler takes only the blocks with block_height % shards == shard
+    shards: int = 1
+    _n_total_processed: int = 0
+    _last_report: Tuple[float, int] = (0.0, 0)
+    prefetcher: Optional[PoolPrefetcher] = None
+    verifier: Optional[PoolVerifier] = None  # single-node-first requests; thor_connector's own consensus if None
+    reference_distance: int = 100  # blocks; the verifier compares the price with a cached snapshot that close
 
     logger = logging.getLogger('ValueFiller')
 
-    @staticmethod
-    def calculate_usd_per_rune(pools: List[ThorPoolModel]):
-        rates, depths = [], []
-        for pool in pools:
-            if pool.pool in STABLE_COINS:
-                rates.append(pool.assets_per_rune)
-                depths.append(int(pool.balance_rune))
-        if sum(depths) <= 0.0:
-            return None
-        return weighted_mean(rates, depths)
+    def __post_init__(self):
+        if self.concurrency is None:
+            self.concurrency = AIMDController.fixed(self.concurrent_jobs)
+
+    async def load_pool_snapshot(self, block_height, name, exact=False) -> Optional[PoolSnapshot]:
+        """
+        Pool state at the block: from the memory cache, the DB or THORNode (in this order).
+        With price_height_tolerance > 0 a snapshot of the nearest block within it is taken if there is one
+        (unless exact).
+        """
+        snapshot = self.pool_cache.get(self.network_id, block_height)
+        if snapshot is not None:
+            self._on_snapshot_use(snapshot)
+            return snapshot
+
+        if self.price_height_tolerance > 0 and not exact:
+            snapshot = await self.load_nearest_pool_snapshot(block_height)
+            if snapshot is not None:
+                self._on_snapshot_use(snapshot)
+                return snapshot
+            pools = None
+        else:
+            pools = await ThorPoolModel.find_pools(self.network_id, block_height)
 
-    async def fill_one_tx(self, tx: ThorTx, name):
-        pools = await ThorPoolModel.find_pools(self.network_id, tx.block_height)
         if not pools:
             try:
-                pools = await self.request_pools_and_cache_them(tx.block_height)
+                # jobs that come for the same block at once share one request (and one DB write)
+                pools = await self.pool_requests.run((self.network_id, block_height),
+                                                     self.request_pools_and_cache_them, block_height)
             except RetryError:
                 pass
 
-        if pools:
+        if not pools:
+            self.logger.error(f'"{name}" no pools were loaded for block #{block_height}')
+            return None
+
+        return self.cache_pool_snapshot(block_height, pools)
+
+    def _on_snapshot_use(self, snapshot: PoolSnapshot):
+        if self.prefetcher is not None:
+            self.prefetcher.on_use(snapshot.block_height)
+
+    async def load_nearest_pool_snapshot(self, block_height) -> Optional[PoolSnapshot]:
+        tolerance = self.price_height_tolerance
+        snapshot = self.pool_cache.nearest(self.network_id, block_height, tolerance)
+        if snapshot is None:
+            nearest_height = await ThorPoolModel.nearest_height(self.network_id, block_height, tolerance)
+            if nearest_height is not None:
+                pools = await ThorPoolModel.find_pools(self.network_id, nearest_height)
+                snapshot = self.cache_pool_snapshot(nearest_height, pools)
+        return snapshot
+
+    def cache_pool_snapshot(self, block_height, pools: List[ThorPoolModel]) -> PoolSnapshot:
+        snapshot = PoolSnapshot.from_pools(block_height, pools)
+        self.pool_cache.put(self.network_id, snapshot)
+        return snapshot
+
+    async def get_usd_per_rune(self, snapshot: PoolSnapshot, timestamp, name):
+        """
+        :return: Rune price and its source (RunePrice.SOURCE_*)
+        """
+        if snapshot.usd_per_rune:
+            return snapshot.usd_per_rune, RunePrice.SOURCE_POOLS
+
+        # no stable coin pools: CoinGecko, unless it has already been asked about this block
+        usd_per_rune = self.rune_prices.at_height(snapshot.block_height, exact=True)
+        if not usd_per_rune:
             try:
-                usd_per_rune = self.calculate_usd_per_rune(pools)
-                if not usd_per_rune:
-                    cg_price_provider = CoinGeckoPriceProvider(self.thor_connector.session)
-                    usd_per_rune = await cg_price_provider.get_historical_rune_price(tx.date)
+                if self.price_provider is None:
+                    self.price_provider = CoinGeckoPriceProvider(self.thor_connector.session)
+                usd_per_rune = await self.price_provider.get_historical_rune_price(timestamp)
             except:
                 self.logger.exception(f'"{name}" usd/rune price error')
                 usd_per_rune = None
+        return usd_per_rune, RunePrice.SOURCE_COINGECKO
 
-            if not usd_per_rune:
-                self.logger.error(f'"{name}" no rune price for block #{tx.block_height}')
-                tx.increase_fail_count()
+    async def load_priced_snapshot(self, block_height, timestamp, name, exact=False) -> Optional[PoolSnapshot]:
+        """
+        :return: pools of the block along with the Rune price (from CoinGecko if there are no stable coin pools),
+            None if either of them is unknown
+        """
+        snapshot = await self.load_pool_snapshot(block_height, name, exact)
+        if snapshot is None:
+            return None
+
+        usd_per_rune, source = await self.get_usd_per_rune(snapshot, timestamp, name)
+        if not usd_per_rune:
+            self.logger.error(f'"{name}" no rune price for block #{block_height}')
+            return None
+
+        if snapshot.block_height == block_height:  # the timestamp belongs to this very block
+            await self.save_rune_price(block_height, timestamp, usd_per_rune, source)
+        return snapshot._replace(usd_per_rune=usd_per_rune)
+
+    async def save_rune_price(self, block_height, timestamp, usd_per_rune, source):
+        if self.rune_prices.at_height(block_height, exact=True) is None:
+            self.rune_prices.add(block_height, timestamp, usd_per_rune)
+            await RunePrice.put(self.network_id, block_height, timestamp, usd_per_rune, source)
+
+    async def fill_block_txs(self, txs: List[ThorTx], name):
+        """
+        Fills txs of the same block: pools and USD/Rune price are loaded once for all of them.
+        The txs which were priced with another block before (see refine_prices) get the pools of their own block.
+        """
+        exact = any(tx.priced_height is not None for tx in txs)
+        snapshot = await self.load_priced_snapshot(txs[0].block_height, txs[0].date, name, exact)
+        for tx in txs:
+            if snapshot is not None:
+                tx.fill_volumes(snapshot.runes_per_asset, snapshot.usd_per_rune)
+                if tx.process_flags > 0:
+                    tx.priced_height = snapshot.block_height
             else:
-                pool_map = {pool.pool: pool for pool in pools}
-                tx.fill_volumes(pool_map, usd_per_rune)
-        else:
-            self.logger.error(f'"{name}" no pools were loaded for block #{tx.block_height}')
-            tx.increase_fail_count()
+                tx.increase_fail_count()
+
+    async def fill_one_tx(self, tx: ThorTx, name):
+        await self.fill_block_txs([tx], name)
 
         if not self.dry_run:
             self.logger.info(f'Success fill {tx.type}, Block = {tx.block_height}, '
                              f'a1 = {tx.amount1:.4f} {tx.asset1}, a2 = {tx.amount2:.4f} {tx.asset2}')
-            await tx.save()
+            await self.save_filled([tx])
+
+    async def fill_batch(self, txs: List[ThorTx], name):
+        by_height = defaultdict(list)
+        for tx in txs:
+            by_height[tx.block_height].append(tx)
+
+        for block_txs in by_height.values():
+            await self.fill_block_txs(block_txs, name)
+
+        if not self.dry_run:
+            await self.save_filled(txs)
+            n_filled = sum(1 for tx in txs if tx.process_flags > 0)
+            self.logger.info(f'"{name}" has filled {n_filled} of {len(txs)} txs in {len(by_height)} blocks')
+
+    async def save_filled(self, txs: List[ThorTx]):
+        now = int(time.time())
+        for tx in txs:
+            if tx.process_flags > 0 or tx.process_flags <= -self.max_fails_of_tx:
+                tx.lease_until = None  # release (given up on: no lease keeps it out of the claims)
+            else:
+                # the lowest blocks are claimed first, so without a pause a short THORNode outage
+                # would use up all the attempts of a tx in a few seconds
+                tx.lease_until = now + int(self.retry_delay_sec * -tx.process_flags)
+
+        async with in_transaction():
+            updated = await ThorTx.save_filled_many(txs)
+            txs = [tx for tx in txs if tx.id in updated]
+            await TxCounter.add(self.network_id,
+                                filled=sum(1 for tx in txs if tx.process_flags > 0),
+                                failed=sum(1 for tx in txs if tx.process_flags <= -self.max_fails_of_tx))
+            await UserVolumeDay.add_filled(self.network_id, txs)
+
+    async def refine_prices(self, min_distance=1) -> int:
+        """
+        Makes the txs priced with pools of a block at least min_distance away from their own block be filled again.
+        They keep priced_height, so the fill jobs price them with the pools of their own block this time.
+        """
+        async with in_transaction():
+            await UserVolumeDay.subtract_filled(self.network_id,
+                                                ThorTx.priced_elsewhere_condition(self.network_id, min_distance))
+            n = await ThorTx.reset_priced_from_other_blocks(self.network_id, min_distance)
+            await TxCounter.add(self.network_id, filled=-n)
+        self.logger.info(f'{n} txs will be priced again.')
+        return n
+
+    def reference_usd_per_rune(self, block_height) -> Optional[float]:
+        """
+        Rune price of the nearest cached block (within reference_distance) to check a new snapshot against.
+        """
+        nearest_height = self.pool_cache.nearest_height(self.network_id, block_height, self.reference_distance)
+        if nearest_height is None:
+            return None
+        return self.pool_cache.peek(self.network_id, nearest_height).usd_per_rune
 
     @retry(stop=stop_after_attempt(3))
     async def request_pools_and_cache_them(self, block_height):
-        pool_info = await self.thor_connector.query_pools(block_height)
-        results = []
-        for pool in pool_info:
-            pool_model = ThorPoolModel.from_thor_pool(pool, self.network_id, block_height)
-            await pool_model.save()
-            results.append(pool_model)
+        t0 = time.monotonic()
+        try:
+            if self.verifier is not None:
+                pool_info = await self.verifier.query_pools(block_height, self.reference_usd_per_rune(block_height))
+            else:
+                pool_info = await self.thor_connector.query_pools(block_height)
+        except Exception:
+            self.concurrency.observe(time.monotonic() - t0, ok=False)
+            raise
+        self.concurrency.observe(time.monotonic() - t0, ok=True)
+
+        results = [ThorPoolModel.from_thor_pool(pool, self.network_id, block_height) for pool in pool_info]
+        await ThorPoolModel.save_snapshot(results)
         return results
 
     async def get_unfilled_tx_batch(self, n):
@@ -109,9 +276,15 @@ class ValueFiller:
                                                                   new_first=False)
         return tx_batch
 
-    async def get_one_unfilled(self):
-        tx = await ThorTx.select_random_unfilled_tx(self.network_id, max_fails=self.max_fails_of_tx)
-        return tx
+    def lease_owner(self, name):
+        return f'{socket.gethostname()}/{os.getpid()}/{name}'
+
+    async def claim_unfilled(self, name, n):
+        return await ThorTx.claim_unfilled(self.network_id, n,
+                                           owner=self.lease_owner(name),
+                                           lease_sec=self.lease_sec,
+                                           max_fails=self.max_fails_of_tx,
+                                           shard=self.shard, shards=self.shards)
 
     async def run_one_job(self, txs: List[ThorTx]):
         name = names.get_full_name()
@@ -128,39 +301,86 @@ class ValueFiller:
             n_done, total, percent = await self.get_progress()
 
             dt = time.monotonic() - self._last_time
-            time_per_tx = dt / self.progress_every_n_iter
-            time_estimation = time_per_tx * (total - n_done)
-            tdelta = datetime.timedelta(seconds=time_estimation)
+            tx_per_sec = self._n_processed / dt if dt > 0 else 0.0
+            time_estimation = (total - n_done) / tx_per_sec if tx_per_sec > 0 else 0.0
+            tdelta = datetime.timedelta(seconds=int(time_estimation))
 
             pb = progressbar(n_done, total, symbol_width=30)
 
-            self.logger.info(f'{pb}: {n_done} / {total} ({percent:.3f}%) {tdelta}')
+            self.logger.info(f'{pb}: {n_done} / {total} ({percent:.3f}%) {tdelta}; {tx_per_sec:.2f} tx/sec')
             self._last_time = time.monotonic()
+            self._n_processed = 0
 
     async def run_job(self, shift=0):
         name = names.get_full_name()
         self.logger.info(f'"{name}" job started with shift = {shift}.')
-        while True:
+        while shift < self.concurrency.level:
             try:
-                tx = await self.get_one_unfilled()
-                if tx:
-                    await self.fill_one_tx(tx, name)
-                else:
+                txs = await self.claim_unfilled(name, self.batch_size)
+                if len(txs) > 1:
+                    await self.fill_batch(txs, name)
+                elif txs:
+                    await self.fill_one_tx(txs[0], name)
+
+                if not txs:
                     await asyncio.sleep(self.sleep_on_error)
+                self._n_processed += len(txs)
+                self._n_total_processed += len(txs)
                 await self.print_progress()
             except Exception:
                 self.logger.exception(f'"{name}" job iteration failed.')
                 await asyncio.sleep(self.sleep_on_error)
+        self.logger.info(f'"{name}" job with shift = {shift} has stopped (concurrency is {self.concurrency.level}).')
+
+    async def adjust_concurrency(self):
+        counter = await TxCounter.get_for_network(self.network_id)
+        old_level = self.concurrency.level
+        new_level = self.concurrency.adjust(backlog=counter.total - counter.done)
+        if new_level != old_level:
+            self.logger.info(f'Concurrency: {old_level} -> {new_level} ({self.concurrency.reason}).')
+
+    async def report_shard(self):
+        now = time.monotonic()
+        last_time, last_n = self._last_report
+        dt = now - last_time
+        tx_per_sec = (self._n_total_processed - last_n) / dt if last_time and dt > 0 else 0.0
+        self._last_report = now, self._n_total_processed
+        await FillerShard.report(self.network_id, self.shard,
+                                 shards=self.shards,
+                                 owner=self.lease_owner('')[:64].rstrip('/'),
+                                 level=self.concurrency.level,
+                                 processed=self._n_total_processed,
+                                 tx_per_sec=tx_per_sec)
+        await FillerShard.remove_stale(self.network_id, FillerShard.STALE_PERIODS * self.adjust_period)
 
     async def run_concurrent_jobs(self):
-        jobs = [self.run_job(shift) for shift in range(self.concurrent_jobs)]
-        await asyncio.gather(*jobs)
+        self.rune_prices = await RunePriceIndex.load(self.network_id)
+        self.logger.info(f'{len(self.rune_prices)} Rune prices are loaded.')
+
+        n = await ThorTx.settle_leases(self.network_id, self.max_fails_of_tx)
+        if n:
+            self.logger.info(f'{n} leases of failed txs are settled.')
+
+        if self.prefetcher is not None:
+            asyncio.create_task(self.prefetcher.run())
+
+        # a job stops by itself when its shift is out of the level, the missing ones are started here
+        jobs = {}
+        while True:
+            for shift in range(self.concurrency.level):
+                if shift not in jobs or jobs[shift].done():
+                    jobs[shift] = asyncio.create_task(self.run_job(shift))
+            await asyncio.sleep(self.adjust_period)
+            try:
+                await self.adjust_concurrency()
+                await self.report_shard()
+            except Exception:
+                self.logger.exception('failed to adjust concurrency or report progress')
 
     async def get_progress(self):
-        total = await ThorTx.count_of_transactions_for_network(self.network_id)
-        n_to_go = await ThorTx.count_without_volume(self.network_id, self.max_fails_of_tx)
+        counter = await TxCounter.get_for_network(self.network_id)
 
-        total = max(1, total)
-        n_done = total - n_to_go
+        total = max(1, counter.total)
+        n_done = counter.done
         percent = 100 * n_done / total
         return n_done, total, percent
@@ -1,43 +1,248 @@
+import asyncio
+import base64
+import json
+from decimal import Decimal, InvalidOperation
+from typing import Optional, Tuple, List
+
 from tortoise import Tortoise
 from tortoise.functions import Max
 
 from helpers.constants import NetworkIdents
+from helpers.datetime import DAY
 from models.tx import ThorTx, ThorTxType
+from models.user_volume import UserVolumeDay
+
+
+# a keyset cursor: (volume_key, user_address) of the last row of the previous page
+Cursor = Tuple[Decimal, str]
+
+# volumes are ranked and compared rounded: float sums of the same swaps may differ in the last bits
+# from query to query (the order of summation, the rollup), that must not move a user across a cursor
+KEY_DIGITS = 8
+
+
+def ranking_key(row: dict) -> Decimal:
+    """
+    The rounded volume of the row as the DB has computed it (the volume_key column).
+    It's never computed here: the DB may round differently (Postgres casts a float to NUMERIC with 15 digits).
+    """
+    return Decimal(str(row['volume_key']))
+
+
+def public_row(row: dict) -> dict:
+    return {k: v for k, v in row.items() if k != 'volume_key'}
+
+
+def encode_cursor(row: dict) -> str:
+    key = json.dumps([str(ranking_key(row)), row['user_address']])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    try:
+        volume_key, user_address = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        volume_key = Decimal(str(volume_key))
+    except (ValueError, TypeError, InvalidOperation) as e:
+        raise ValueError('invalid cursor') from e
+    if not volume_key.is_finite() or not isinstance(user_address, str):
+        raise ValueError('invalid cursor')
+    return volume_key, user_address
+
+
+def _page_sql(offset, limit):
+    return f'LIMIT {int(limit)} OFFSET {int(offset)}' if limit is not None else ''
 
 
-async def leaderboard_raw(network_id, from_date=0, to_date=0, offset=0, limit=10, currency='rune'):
+def _key_sql(volume_sql):
+    # the rounded volume the rows are ranked by, selected as the volume_key column
+    return f'ROUND(CAST(COALESCE({volume_sql}, 0) AS NUMERIC), {KEY_DIGITS})'
+
+
+# addresses are compared byte by byte, the way Python compares str (RankedWindow.page_after),
+# not by the collation of the DB; the default BINARY collation of SQLite already does that
+ADDRESS_COLLATIONS = {'postgres': ' COLLATE "C"'}
+
+
+def _address_sql(user_sql='user_address'):
+    dialect = Tortoise.get_connection('default').capabilities.dialect
+    return f'{user_sql}{ADDRESS_COLLATIONS.get(dialect, "")}'
+
+
+def _order_sql(volume_sql, user_sql='user_address'):
+    # unfilled (NULL) volumes go last on any DB, the address makes the order total for the keyset pages
+    return f'{_key_sql(volume_sql)} DESC, {_address_sql(user_sql)}'
+
+
+def _seek_sql(volume_sql, after: Cursor):
+    """
+    Condition of the rows after the cursor in the _order_sql order.
+    """
+    volume_key, user_address = after
+    # the key of the cursor came from the DB as it is, so it equals the key of the same row in this query
+    key, volume = _key_sql(volume_sql), f'CAST({ThorTx._sql_literal(str(volume_key))} AS NUMERIC)'
+    user_address = ThorTx._sql_literal(user_address)
+    return f'({key} < {volume} OR ({key} = {volume} AND {_address_sql()} > {user_address}))'
+
+
+async def leaderboard_raw(network_id, from_date=0, to_date=0, offset=0, limit=10, currency='rune',
+                          after: Optional[Cursor] = None):
     if currency == 'rune':
         sum_variable = "rune_volume"
     else:
         sum_variable = "usd_volume"
 
     end_date_cond = f' AND date <= {int(to_date)} ' if to_date else ''
+    volume_sql = f'SUM({sum_variable})'
+    having = f' HAVING {_seek_sql(volume_sql, after)}' if after else ''
 
     q = (f"SELECT "
          f" user_address,"
          f" SUM({sum_variable}) total_volume, MAX(date) as date, "
-         f" COUNT(id) n "
+         f" COUNT(id) n, {_key_sql(volume_sql)} volume_key "
          f" FROM thortx "
          f" WHERE network = '{network_id}' "
          f" AND type = '{ThorTxType.TYPE_SWAP}' "
          f' AND date >= {int(from_date)} {end_date_cond}'
-         f" GROUP BY user_address "
-         f" ORDER BY SUM({sum_variable}) "
-         f" DESC LIMIT {int(limit)} OFFSET {int(offset)}")
+         f" GROUP BY user_address {having}"
+         f" ORDER BY {_order_sql(volume_sql)} "
+         f" {_page_sql(offset, limit)}")
+
+    conn = Tortoise.get_connection("default")
+    return await conn.execute_query_dict(q)
+
+
+def full_days(from_date, to_date) -> Optional[Tuple[int, Optional[int]]]:
+    """
+    :return: [first, end) of the whole days within [from_date, to_date] (end is None if to_date is not set),
+        None if there are none of them
+    """
+    first = -(-int(from_date) // DAY) * DAY
+    end = (int(to_date) + 1) // DAY * DAY if to_date else None
+    if end is not None and end <= first:
+        return None
+    return first, end
+
+
+def _swap_parts_sql(network_id, from_date, to_date, days, volume_column):
+    """
+    Swaps of [from_date, to_date] as rows of (user_address, v, n, date): the whole days from the rollup,
+    the rest of the interval at its edges from thortx.
+    """
+    first, end = days
+    network = ThorTx._sql_literal(network_id)
+    swap = ThorTx._sql_literal(ThorTxType.TYPE_SWAP)
+
+    rollup_end = f' AND "day" < {end}' if end is not None else ''
+    edges = f'("date" >= {int(from_date)} AND "date" < {first})'
+    if end is not None:
+        edges += f' OR ("date" >= {end} AND "date" <= {int(to_date)})'
+
+    return (f'SELECT "user_address", "{volume_column}" AS v, "n", "last_date" AS date '
+            f'FROM "{UserVolumeDay._meta.db_table}" '
+            f'WHERE "network" = {network} AND "day" >= {first}{rollup_end} '
+            f'UNION ALL '
+            f'SELECT "user_address", "{volume_column}" AS v, 1 AS n, "date" '
+            f'FROM "{ThorTx._meta.db_table}" '
+            f'WHERE "network" = {network} AND "type" = {swap} AND ({edges})')
+
+
+async def leaderboard_rollup(network_id, from_date=0, to_date=0, offset=0, limit=10, currency='rune',
+                             after: Optional[Cursor] = None):
+    """
+    Same as leaderboard_raw, but sums the daily rollup (UserVolumeDay) for the whole days of the interval.
+    """
+    days = full_days(from_date, to_date)
+    if days is None:
+        return await leaderboard_raw(network_id, from_date, to_date, offset, limit, currency, after)
+
+    volume_column = 'rune_volume' if currency == 'rune' else 'usd_volume'
+    having = f' HAVING {_seek_sql("SUM(v)", after)}' if after else ''
+    q = (f"SELECT "
+         f" user_address,"
+         f" SUM(v) total_volume, MAX(date) as date, "
+         f" CAST(SUM(n) AS BIGINT) n, {_key_sql('SUM(v)')} volume_key "
+         f" FROM ({_swap_parts_sql(network_id, from_date, to_date, days, volume_column)}) parts "
+         f" GROUP BY user_address {having}"
+         f" ORDER BY {_order_sql('SUM(v)')} "
+         f" {_page_sql(offset, limit)}")
 
     conn = Tortoise.get_connection("default")
     return await conn.execute_query_dict(q)
 
 
-async def leaderboard(network_id, from_date=0, to_date=0, offset=0, limit=10, currency='rune'):
-    results = await leaderboard_raw(network_id, from_date, to_date, offset, limit, currency)
+def _swaps_since_sql(network_id, from_date, users_cond='', use_rollup=False):
+    """
+    Swaps since from_date as rows of (user_address, date); only the last one of a day from the rollup.
+    """
+    network = ThorTx._sql_literal(network_id)
+    swap = ThorTx._sql_literal(ThorTxType.TYPE_SWAP)
+    if not use_rollup:
+        return (f'SELECT "user_address", "date" FROM "{ThorTx._meta.db_table}" '
+                f'WHERE "network" = {network} AND "type" = {swap} AND "date" >= {int(from_date)}{users_cond}')
+
+    first, _ = full_days(from_date, 0)
+    return (f'SELECT "user_address", "last_date" AS date FROM "{UserVolumeDay._meta.db_table}" '
+            f'WHERE "network" = {network} AND "day" >= {first}{users_cond} '
+            f'UNION ALL '
+            f'SELECT "user_address", "date" FROM "{ThorTx._meta.db_table}" '
+            f'WHERE "network" = {network} AND "type" = {swap} '
+            f'AND "date" >= {int(from_date)} AND "date" < {first}{users_cond}')
+
+
+def _window_swaps_sql(network_id, from_date, to_date, volume_column, use_rollup=False):
+    """
+    Swaps of [from_date, to_date] as rows of (user_address, v, n, date) from thortx or the rollup.
+    """
+    days = full_days(from_date, to_date) if use_rollup else None
+    if days is not None:
+        return _swap_parts_sql(network_id, from_date, to_date, days, volume_column)
+
+    end_date_cond = f' AND "date" <= {int(to_date)}' if to_date else ''
+    return (f'SELECT "user_address", "{volume_column}" AS v, 1 AS n, "date" '
+            f'FROM "{ThorTx._meta.db_table}" '
+            f'WHERE "network" = {ThorTx._sql_literal(network_id)} '
+            f'AND "type" = {ThorTx._sql_literal(ThorTxType.TYPE_SWAP)} '
+            f'AND "date" >= {int(from_date)}{end_date_cond}')
+
+
+async def last_swap_dates(network_id, from_date, user_addresses: Optional[List[str]] = None):
+    """
+    :return: {user_address: date of the last swap since from_date} of the given users (all if None)
+        from the rollup
+    """
+    if user_addresses is not None and not user_addresses:
+        return {}
+    if user_addresses is None:
+        users_cond = ''
+    else:
+        users_cond = f' AND "user_address" IN ({", ".join(ThorTx._sql_literal(a) for a in user_addresses)})'
+    q = (f'SELECT user_address, MAX(date) last_date '
+         f'FROM ({_swaps_since_sql(network_id, from_date, users_cond, use_rollup=True)}) parts '
+         f'GROUP BY user_address')
+
+    conn = Tortoise.get_connection("default")
+    return {e['user_address']: e['last_date'] for e in await conn.execute_query_dict(q)}
+
 
-    last_dates = await ThorTx \
-        .annotate(last_date=Max('date')) \
-        .filter(network=network_id, type=ThorTxType.TYPE_SWAP, date__gte=from_date) \
-        .group_by('user_address') \
-        .values('user_address', 'last_date')
-    last_dates_cache = {e['user_address']: e['last_date'] for e in last_dates}
+async def leaderboard(network_id, from_date=0, to_date=0, offset=0, limit=10, currency='rune', use_rollup=False,
+                      after: Optional[Cursor] = None):
+    """
+    :param limit: None for the whole ranking
+    :param after: the page starts after this row (keyset pagination, the offset is counted from it)
+    """
+    if use_rollup:
+        results = await leaderboard_rollup(network_id, from_date, to_date, offset, limit, currency, after)
+        users = [item['user_address'] for item in results] if limit is not None else None
+        last_dates_cache = await last_swap_dates(network_id, from_date, users)
+    else:
+        results = await leaderboard_raw(network_id, from_date, to_date, offset, limit, currency, after)
+
+        last_dates = await ThorTx \
+            .annotate(last_date=Max('date')) \
+            .filter(network=network_id, type=ThorTxType.TYPE_SWAP, date__gte=from_date) \
+            .group_by('user_address') \
+            .values('user_address', 'last_date')
+        last_dates_cache = {e['user_address']: e['last_date'] for e in last_dates}
 
     for item in results:
         item['date'] = last_dates_cache.get(item['user_address'], item['date'])
@@ -45,18 +250,22 @@ async def leaderboard(network_id, from_date=0, to_date=0, offset=0, limit=10, cu
     return results
 
 
-async def total_volume(network_id, from_date=0, to_date=0, currency='rune'):
+async def total_volume(network_id, from_date=0, to_date=0, currency='rune', use_rollup=False):
     try:
         if currency == 'rune':
             sum_variable = "rune_volume"
         else:
             sum_variable = "usd_volume"
 
-        sql = (f"SELECT SUM({sum_variable}) v FROM thortx "
-               f"WHERE network = '{network_id}' AND type = '{ThorTxType.TYPE_SWAP}' AND "
-               f"date >= {int(from_date)} ")
-        if to_date:
-            sql += f" AND date <= {int(to_date)} "
+        days = full_days(from_date, to_date) if use_rollup else None
+        if days is not None:
+            sql = f"SELECT SUM(v) v FROM ({_swap_parts_sql(network_id, from_date, to_date, days, sum_variable)}) parts"
+        else:
+            sql = (f"SELECT SUM({sum_variable}) v FROM thortx "
+                   f"WHERE network = '{network_id}' AND type = '{ThorTxType.TYPE_SWAP}' AND "
+                   f"date >= {int(from_date)} ")
+            if to_date:
+                sql += f" AND date <= {int(to_date)} "
 
         conn = Tortoise.get_connection("default")
         result = await conn.execute_query_dict(sql)
@@ -70,3 +279,63 @@ async def dbg_print_leaderboard():
     results = await leaderboard(NetworkIdents.CHAOSNET_BEP2CHAIN)
     for place, result in enumerate(results, start=1):
         print(f"#{place}: {result}")
+
+
+BUNDLE_DIALECTS = ('postgres', 'sqlite')  # CTEs are needed
+
+
+def leaderboard_bundle_sql(network_id, from_date, to_date, offset, limit, currency, use_rollup=False,
+                           after: Optional[Cursor] = None):
+    volume_column = 'rune_volume' if currency == 'rune' else 'usd_volume'
+    page_users = ' AND "user_address" IN (SELECT user_address FROM page)'
+    seek = f' WHERE {_seek_sql("total_volume", after)}' if after else ''
+    return (f"WITH swaps AS ({_window_swaps_sql(network_id, from_date, to_date, volume_column, use_rollup)}), "
+            f"ranked AS ("
+            f" SELECT user_address, SUM(v) AS total_volume, MAX(date) AS date, CAST(SUM(n) AS BIGINT) AS n"
+            f" FROM swaps GROUP BY user_address), "
+            f"page AS (SELECT ranked.*, {_key_sql('total_volume')} AS volume_key FROM ranked{seek}"
+            f" ORDER BY {_order_sql('total_volume')} {_page_sql(offset, limit)}), "
+            f"last_dates AS ("
+            f" SELECT user_address, MAX(date) AS last_date"
+            f" FROM ({_swaps_since_sql(network_id, from_date, page_users, use_rollup)}) since"
+            f" GROUP BY user_address), "
+            f"totals AS (SELECT SUM(v) AS chaosnet_volume FROM swaps), "
+            f"participants AS ("
+            f" SELECT COUNT(DISTINCT user_address) AS participants FROM \"{ThorTx._meta.db_table}\""
+            f" WHERE network = {ThorTx._sql_literal(network_id)}"
+            f" AND date >= {int(from_date)} AND date <= {int(to_date)}) "
+            f"SELECT page.user_address, page.total_volume, COALESCE(last_dates.last_date, page.date) AS date, page.n,"
+            f" page.volume_key, totals.chaosnet_volume, participants.participants "
+            f"FROM totals CROSS JOIN participants "
+            f"LEFT JOIN page ON 1 = 1 "
+            f"LEFT JOIN last_dates ON last_dates.user_address = page.user_address "
+            f"ORDER BY page.volume_key DESC, {_address_sql('page.user_address')}")
+
+
+async def leaderboard_bundle(network_id, from_date=0, to_date=0, offset=0, limit=10, currency='rune',
+                             use_rollup=False, after: Optional[Cursor] = None):
+    """
+    Page of the leaderboard, total volume of the window and number of participants with one round-trip.
+    Same results as leaderboard, total_volume and ThorTx.total_distinct_users_count
+    (concurrently run if the DB can't do it with one statement).
+    :return: leaderboard page, total volume, number of participants
+    """
+    conn = Tortoise.get_connection("default")
+    if conn.capabilities.dialect not in BUNDLE_DIALECTS:
+        return await asyncio.gather(
+            leaderboard(network_id, from_date, to_date, offset, limit, currency, use_rollup, after),
+            total_volume(network_id, from_date, to_date, currency, use_rollup),
+            ThorTx.total_distinct_users_count(network_id, from_date, to_date))
+
+    rows = await conn.execute_query_dict(
+        leaderboard_bundle_sql(network_id, from_date, to_date, offset, limit, currency, use_rollup, after))
+    results = [{
+        'user_address': row['user_address'],
+        'total_volume': row['total_volume'],
+        'date': row['date'],
+        'n': row['n'],
+        'volume_key': row['volume_key'],
+    } for row in rows if row['user_address'] is not None]
+    tv = rows[0]['chaosnet_volume'] if rows else None
+    pt = rows[0]['participants'] if rows else 0
+    return results, (float(tv) if tv is not None else 0), pt
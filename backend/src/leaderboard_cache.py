@@ -0,0 +1,173 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Callable, Awaitable, Tuple, Optional, Dict
+
+from helpers.utils import SingleFlight
+from leaderboard import ranking_key, Cursor
+from models.counters import TxCounter
+
+# (network_id, since, to, currency) -> (whole ranking, total volume, participants)
+RankingLoader = Callable[[str, int, int, str], Awaitable[Tuple[List[dict], float, int]]]
+
+
+async def tx_counters_version(network_id: str) -> tuple:
+    counter = await TxCounter.get_for_network(network_id)
+    return counter.total, counter.filled, counter.failed
+
+
+@dataclass
+class RankedWindow:
+    since: int
+    to: int
+    currency: str
+    rows: List[dict]  # the whole ranking
+    total_volume: float
+    participants: int
+    version: tuple
+    created: float
+
+    _positions: Optional[Dict[str, int]] = field(default=None, repr=False, compare=False)  # user -> row
+
+    def page(self, offset: int, limit: int) -> List[dict]:
+        return self.rows[max(0, offset):max(0, offset) + max(0, limit)]
+
+    def page_after(self, after: Cursor, limit: int) -> List[dict]:
+        """
+        Keyset page: the rows after (volume_key, user_address) of the cursor.
+        The rows are ranked by the DB with the addresses compared byte by byte (see leaderboard._address_sql),
+        which is how str are compared here.
+        """
+        if self._positions is None:
+            self._positions = {row['user_address']: i for i, row in enumerate(self.rows)}
+        volume_key, user_address = after
+        i = self._positions.get(user_address)
+        if i is None or ranking_key(self.rows[i]) != volume_key:
+            # not the ranking the cursor came from: the first row after its key
+            key, lo, hi = (-volume_key, user_address), 0, len(self.rows)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                row = self.rows[mid]
+                if (-ranking_key(row), row['user_address']) <= key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            i = lo - 1
+        return self.rows[i + 1:i + 1 + max(0, limit)]
+
+
+class RankingCache:
+    """
+    Complete rankings of (network, since, to, currency) windows: every page of the leaderboard is a slice of one.
+    since and to are rounded outwards to granularity, so the windows of clients a few seconds apart share an entry.
+    An entry lives no longer than ttl and is dropped as soon as the tx counters of the network change
+    (new or filled txs), they are read at most once per version_period.
+    The cache is bounded by the total number of rows, the least recently used rankings go first.
+    Concurrent misses of the same window share one load.
+    """
+
+    def __init__(self, loader: RankingLoader, ttl=600.0, max_rows=1_000_000, granularity=0, version_period=5.0,
+                 version_loader: Callable[[str], Awaitable[tuple]] = tx_counters_version, max_ts: Optional[int] = None):
+        self.loader = loader
+        self.version_loader = version_loader
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.granularity = int(granularity)
+        self.version_period = version_period
+        self.max_ts = max_ts  # "no upper bound" value of to, it's never rounded
+
+        self._entries: 'OrderedDict[tuple, RankedWindow]' = OrderedDict()
+        self._n_rows = 0
+        self._versions: Dict[str, Tuple[float, tuple]] = {}
+        self._loads = SingleFlight()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+        self.evictions = 0
+        self.too_big = 0
+
+    def quantize(self, since: int, to: int) -> Tuple[int, int]:
+        g = self.granularity
+        if g <= 0:
+            return since, to
+        since = since - since % g
+        if to != self.max_ts:
+            to = to - to % g + g - 1
+            if self.max_ts is not None:
+                to = min(to, self.max_ts)
+        return since, to
+
+    async def _version(self, network_id: str) -> tuple:
+        now = time.monotonic()
+        checked = self._versions.get(network_id)
+        if checked is None or now - checked[0] >= self.version_period:
+            checked = self._versions[network_id] = now, await self.version_loader(network_id)
+        return checked[1]
+
+    def _pop(self, key):
+        entry = self._entries.pop(key)
+        self._n_rows -= len(entry.rows)
+
+    def _put(self, key, entry: RankedWindow):
+        if key in self._entries:
+            self._pop(key)
+        if len(entry.rows) > self.max_rows:
+            self.too_big += 1
+            return
+        self._entries[key] = entry
+        self._n_rows += len(entry.rows)
+        while self._n_rows > self.max_rows:
+            self._pop(next(iter(self._entries)))
+            self.evictions += 1
+
+    async def get(self, network_id: str, since: int, to: int, currency: str) -> RankedWindow:
+        since, to = self.quantize(since, to)
+        key = (network_id, since, to, currency)
+        version = await self._version(network_id)
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.monotonic() - entry.created >= self.ttl:
+                self.expired += 1
+            elif entry.version != version:
+                self.invalidated += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry
+        self.misses += 1
+        return await self._loads.run(key, self._load, key, version)
+
+    async def _load(self, key, version) -> RankedWindow:
+        network_id, since, to, currency = key
+        rows, total_volume, participants = await self.loader(network_id, since, to, currency)
+        entry = RankedWindow(since, to, currency, rows, total_volume, participants, version, time.monotonic())
+        self._put(key, entry)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+        self._n_rows = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        n = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'rows': self._n_rows,
+            'max_rows': self.max_rows,
+            'granularity': self.granularity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'invalidated': self.invalidated,
+            'evictions': self.evictions,
+            'too_big': self.too_big,
+            'shared_loads': self._loads.n_shared,
+            'hit_rate': self.hits / n if n else 0.0,
+        }
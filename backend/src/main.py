@@ -5,16 +5,27 @@ from typing import Optional
 import aiohttp
 from aiohttp import web, ClientTimeout
 from aiothornode.connector import ThorConnector
+from tortoise import Tortoise
 
-from api import API
+from api import API, MAX_TS
+from helpers.coingecko import CoinGeckoPriceProvider
 from helpers.config import Config
 from helpers.datetime import parse_timespan_to_seconds
 from helpers.db import DB
 from helpers.utils import schedule_task_periodically
+from jobs.tx.ingest import TxIngestQueue
 from jobs.tx.parser import get_parser_by_network_id
 from jobs.tx.scanner import NetworkIdents, TxScanner, get_url_gen_by_network_id
-from jobs.tx.storage import TxStorage, TxStorageMock
+from jobs.tx.storage import TxStorage, TxStorageMock, TxBackfillStorage
+from jobs.concurrency import AIMDController
+from jobs.pool_cache import PoolSnapshotCache
+from jobs.prefetch import PoolPrefetcher
+from jobs.thor_verify import PoolVerifier
 from jobs.value_filler import ValueFiller, get_thor_env_by_network_id
+from leaderboard_cache import RankingCache
+from models.coingecko import CoinGeckoPriceStore
+from models.counters import TxCounter, FillerShard
+from models.scan import ScanCheckpoint
 
 logging.basicConfig(level=logging.INFO)
 
@@ -26,13 +37,18 @@ class App:
         self.cfg = Config()
         self.db = DB()
 
-        self.tx_storage = TxStorage()
+        self.tx_ingest = TxIngestQueue(
+            max_pages=self.cfg.as_int('thorchain.scanner.tx.ingest.max_pages', 16),
+            max_pages_per_write=self.cfg.as_int('thorchain.scanner.tx.ingest.max_pages_per_write', 8))
+        self.tx_storage = TxStorage(ingest=self.tx_ingest)
+        self.tx_backfill = TxBackfillStorage(ingest=self.tx_ingest)
         # self.tx_storage = TxStorageMock()
 
         self.network_id = self.cfg.as_str('thorchain.network_id', NetworkIdents.TESTNET_MULTICHAIN)
         logging.info(f'Starting Chaosnetleaders backend for network {self.network_id!r}')
 
         self.scanner: Optional[TxScanner] = None
+        self.backfill_scanner: Optional[TxScanner] = None
         self.thor: Optional[ThorConnector] = None
         self.value_filler: Optional[ValueFiller] = None
         self.api: Optional[API] = None
@@ -40,19 +56,41 @@ class App:
     async def init_db(self, _):
         await self.db.start()
 
-    async def scanner_job(self, retries, batch_size, sleep_before_retry):
-        url_gen = get_url_gen_by_network_id(self.network_id)
-        parser = get_parser_by_network_id(self.network_id)
+    def _midgard_session(self):
         midgard_time_out = self.cfg.as_float('thorchain.midgard.timeout', 7.1)
 
         timeout = ClientTimeout(total=midgard_time_out)
         logging.info(f'Scanner timeout is set: {timeout}')
+        return aiohttp.ClientSession(timeout=timeout)
 
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            self.scanner = TxScanner(url_gen, session, parser, delegate=self.tx_storage,
-                                     retries=retries, sleep_before_retry=sleep_before_retry)
+    def _make_scanner(self, session, delegate, retries, sleep_before_retry, concurrent_pages):
+        url_gen = get_url_gen_by_network_id(self.network_id)
+        parser = get_parser_by_network_id(self.network_id)
+        return TxScanner(url_gen, session, parser, delegate=delegate,
+                         retries=retries, sleep_before_retry=sleep_before_retry,
+                         concurrent_pages=concurrent_pages)
+
+    async def scanner_job(self, retries, batch_size, sleep_before_retry, concurrent_pages):
+        async with self._midgard_session() as session:
+            self.scanner = self._make_scanner(session, self.tx_storage,
+                                              retries, sleep_before_retry, concurrent_pages)
             await self.scanner.run_scan(start=0, batch_size=batch_size)
 
+    async def backfill_job(self, retries, batch_size, sleep_before_retry, concurrent_pages):
+        checkpoint = await ScanCheckpoint.load(self.network_id)
+        if checkpoint and checkpoint.finished:
+            return
+
+        async with self._midgard_session() as session:
+            self.backfill_scanner = self._make_scanner(session, self.tx_backfill,
+                                                       retries, sleep_before_retry, concurrent_pages)
+            start = 0
+            if checkpoint:
+                head = await self.backfill_scanner.request_transaction_list(0, 1)
+                start = checkpoint.resume_offset(head.total_count, batch_size)
+            logging.info(f'back-fill starts from {start} offset; {checkpoint}')
+            await self.backfill_scanner.run_scan(start=start, batch_size=batch_size)
+
     async def run_scanner(self, _):
         cfg = self.cfg.get('thorchain.scanner.tx')
         period = parse_timespan_to_seconds(cfg.as_str('period', '66s'))
@@ -60,30 +98,113 @@ class App:
         retries = cfg.as_int('retries', 5)
         batch_size = cfg.as_int('batch', 49)
         overscan = self.tx_storage.overscan_pages = cfg.as_int('over_scan_pages', 9)
+        full_scan = self.tx_storage.full_scan = bool(cfg.get('full_scan', False))
+        backfill = self.tx_storage.has_backfill = bool(cfg.get('backfill', True))
         delay = parse_timespan_to_seconds(cfg.as_str('start_delay', '2s'))
         sleep_before_retry = parse_timespan_to_seconds(cfg.as_str('sleep_before_retry', '2s'))
-        logging.info(f'starting scanner with {period=} sec, {retries=}, {batch_size=}, {delay=} sec, {overscan=} pages')
-        schedule_task_periodically(period, self.scanner_job, delay, retries, batch_size, sleep_before_retry)
+        concurrent_pages = cfg.as_int('concurrent_pages', 4)
+        assert concurrent_pages >= 1
+        logging.info(f'starting scanner with {period=} sec, {retries=}, {batch_size=}, {delay=} sec, '
+                     f'{overscan=} pages, {concurrent_pages=}, {full_scan=}, {backfill=}')
+        scan_args = (retries, batch_size, sleep_before_retry, concurrent_pages)
+        if backfill:
+            schedule_task_periodically(period, self.backfill_job, 0, *scan_args)
+        schedule_task_periodically(period, self.scanner_job, delay, *scan_args)
 
-    async def fill_job(self):
+    async def fill_job(self, shard=0, shards=1):
         cfg = self.cfg.get('thorchain')
         thor_time_out = cfg.as_float('thornode.timeout', 4.2)
         timeout = ClientTimeout(total=thor_time_out)
         retires = cfg.as_int('value_filler.retries', 3)
         concurrent_jobs = cfg.as_int('value_filler.concurrent_jobs', 8)
+        batch_size = cfg.as_int('value_filler.batch', 1)
+        lease_sec = parse_timespan_to_seconds(cfg.as_str('value_filler.lease', '5m'))
+        retry_delay_sec = parse_timespan_to_seconds(cfg.as_str('value_filler.retry_delay', '1m'))
+        pool_cache_size = cfg.as_int('value_filler.pool_cache_size', 10_000)
+        price_height_tolerance = cfg.as_int('value_filler.price_height_tolerance', 0)
+        coingecko_span = parse_timespan_to_seconds(cfg.as_str('value_filler.coingecko_span', '30d'))
+        consensus_mode = cfg.as_str('value_filler.consensus.mode', 'always')
+        consensus_min = cfg.as_int('value_filler.consensus.min', 2)
+        consensus_total = cfg.as_int('value_filler.consensus.total', 3)
+
+        if bool(cfg.get('value_filler.adaptive.enabled', False)):
+            concurrency = AIMDController(concurrent_jobs,
+                                         min_level=cfg.as_int('value_filler.adaptive.min_jobs', 1),
+                                         max_level=cfg.as_int('value_filler.adaptive.max_jobs', concurrent_jobs),
+                                         target_latency=cfg.as_float('value_filler.adaptive.target_latency', 2.0),
+                                         max_error_rate=cfg.as_float('value_filler.adaptive.max_error_rate', 0.1),
+                                         work_per_worker=batch_size)
+        else:
+            concurrency = AIMDController.fixed(concurrent_jobs)
+        adjust_period = parse_timespan_to_seconds(cfg.as_str('value_filler.adaptive.period', '10s'))
 
         logging.info(f'Fill timeout is set: {timeout}')
 
         async with aiohttp.ClientSession(timeout=timeout) as session:
             thor_env = get_thor_env_by_network_id(self.network_id)
-            thor_env.set_consensus(2, 3)
+            thor_env.set_consensus(consensus_min, consensus_total)
             self.thor = ThorConnector(thor_env, session)
+
+            verifier = None
+            if consensus_mode == 'verify':
+                verifier = PoolVerifier(self.thor,
+                                        sample_rate=cfg.as_float('value_filler.consensus.sample_rate', 0.02),
+                                        max_price_deviation=cfg.as_float('value_filler.consensus.max_price_deviation',
+                                                                         0.25),
+                                        consensus_min=consensus_min, consensus_total=consensus_total)
+            elif consensus_mode != 'always':
+                raise ValueError(f'unknown value_filler.consensus.mode: {consensus_mode!r}')
+
+            price_provider = CoinGeckoPriceProvider(session, span=coingecko_span, store=CoinGeckoPriceStore())
+            await price_provider.load()
+
             self.value_filler = ValueFiller(self.thor, self.network_id,
                                             max_fails_of_tx=retires,
-                                            concurrent_jobs=concurrent_jobs)
-            self.api.value_filler = self.value_filler
+                                            concurrent_jobs=concurrent_jobs,
+                                            batch_size=batch_size,
+                                            lease_sec=lease_sec,
+                                            retry_delay_sec=retry_delay_sec,
+                                            pool_cache=PoolSnapshotCache(pool_cache_size),
+                                            price_height_tolerance=price_height_tolerance,
+                                            price_provider=price_provider,
+                                            concurrency=concurrency,
+                                            adjust_period=adjust_period,
+                                            shard=shard, shards=shards,
+                                            verifier=verifier)
+            if bool(cfg.get('value_filler.prefetch.enabled', False)):
+                self.value_filler.prefetcher = PoolPrefetcher(
+                    self.value_filler,
+                    lookahead=cfg.as_int('value_filler.prefetch.lookahead', 50),
+                    max_requests=cfg.as_int('value_filler.prefetch.max_requests', 4),
+                    period=parse_timespan_to_seconds(cfg.as_str('value_filler.prefetch.period', '1s')))
+            if self.api:
+                self.api.value_filler = self.value_filler
             await self.value_filler.run_concurrent_jobs()
 
+    def run_fill_shard(self, shard, shards):
+        """
+        Fills only a shard of blocks in this process without the API and the scanner (see filler.py).
+        """
+        async def main():
+            logging.info(f'Value filler of shard {shard} of {shards} is starting (network {self.network_id!r}).')
+            await self.db.start()
+            try:
+                await self.fill_job(shard, shards)
+            finally:
+                await Tortoise.close_connections()
+
+        asyncio.run(main())
+
+    async def reconcile_counters(self, max_fails):
+        counter = await TxCounter.reconcile(self.network_id, max_fails)
+        logging.info(f'Reconciled: {counter}')
+
+    async def run_counters_reconciliation(self, _):
+        cfg = self.cfg.get('thorchain')
+        period = parse_timespan_to_seconds(cfg.as_str('counters.reconcile_period', '10m'))
+        max_fails = cfg.as_int('value_filler.retries', 3)
+        schedule_task_periodically(period, self.reconcile_counters, 0, max_fails)
+
     async def run_fill_job(self, _):
         if FILL_JOB_ENABLED:
             asyncio.create_task(self.fill_job())
@@ -91,7 +212,20 @@ class App:
     def run_server(self):
         app = web.Application(middlewares=[])
 
-        self.api = API(self.network_id, self.tx_storage)
+        self.api = API(self.network_id, self.tx_storage,
+                       use_rollup=bool(self.cfg.get('thorchain.leaderboard.rollup', False)),
+                       # the fillers report every adaptive.period
+                       shard_max_age=FillerShard.STALE_PERIODS * parse_timespan_to_seconds(
+                           self.cfg.as_str('thorchain.value_filler.adaptive.period', '10s')))
+        if bool(self.cfg.get('api.leaderboard_cache.enabled', False)):
+            cfg = self.cfg.get('api.leaderboard_cache')
+            self.api.ranking_cache = RankingCache(
+                self.api.load_ranking,
+                ttl=parse_timespan_to_seconds(cfg.as_str('ttl', '10m')),
+                max_rows=cfg.as_int('max_rows', 1_000_000),
+                granularity=parse_timespan_to_seconds(cfg.as_str('granularity', '0s')),
+                version_period=parse_timespan_to_seconds(cfg.as_str('version_period', '5s')),
+                max_ts=MAX_TS)
 
         routes = {
             '/api/v1/leaderboard': self.api.handler_leaderboard,
@@ -105,6 +239,7 @@ class App:
         cfg = self.cfg.get('thorchain')
 
         app.on_startup.append(self.init_db)
+        app.on_startup.append(self.run_counters_reconciliation)
 
         if bool(cfg.get('scanner.tx.enabled', True)):
             app.on_startup.append(self.run_scanner)
@@ -0,0 +1,59 @@
+from typing import List, Tuple
+
+from pypika import PostgreSQLQuery
+from tortoise import fields, Model
+
+
+class CoinGeckoPricePoint(Model):
+    id = fields.BigIntField(pk=True)
+    coin = fields.CharField(40)
+    timestamp = fields.BigIntField()
+    price = fields.FloatField()
+
+    class Meta:
+        unique_together = (('coin', 'timestamp'),)
+
+
+class CoinGeckoRange(Model):
+    """
+    Time range which has been requested from CoinGecko: all its points are saved.
+    """
+    id = fields.BigIntField(pk=True)
+    coin = fields.CharField(40, index=True)
+    t_from = fields.BigIntField()
+    t_to = fields.BigIntField()
+
+    class Meta:
+        unique_together = (('coin', 't_from'),)
+
+
+class CoinGeckoPriceStore:
+    """
+    DB storage of helpers.coingecko.CoinGeckoPriceProvider.
+    """
+
+    @staticmethod
+    async def load(coin) -> Tuple[List[Tuple[int, int]], List[Tuple[int, float]]]:
+        """
+        :return: requested ranges, price points
+        """
+        ranges = await CoinGeckoRange.filter(coin=coin).values_list('t_from', 't_to')
+        points = await CoinGeckoPricePoint.filter(coin=coin).order_by('timestamp').values_list('timestamp', 'price')
+        return ranges, points
+
+    @staticmethod
+    async def save(coin, t_from, t_to, points: List[Tuple[int, float]]):
+        db = CoinGeckoPricePoint._meta.db
+        if points:
+            if db.capabilities.dialect in ('postgres', 'sqlite'):
+                query = PostgreSQLQuery \
+                    .into(CoinGeckoPricePoint._meta.db_table) \
+                    .columns('coin', 'timestamp', 'price') \
+                    .insert(*((coin, int(timestamp), float(price)) for timestamp, price in points)) \
+                    .on_conflict('coin', 'timestamp').do_nothing()
+                await db.execute_query(query.get_sql())
+            else:
+                for timestamp, price in points:
+                    await CoinGeckoPricePoint.get_or_create(defaults={'price': price}, coin=coin, timestamp=timestamp)
+        # the current span is requested again as it grows
+        await CoinGeckoRange.update_or_create(defaults={'t_to': t_to}, coin=coin, t_from=t_from)
@@ -0,0 +1,118 @@
+import time
+from typing import Optional
+
+from tortoise import fields, Model, BaseDBAsyncClient
+from tortoise.expressions import F
+from tortoise.transactions import in_transaction
+
+from models.tx import ThorTx
+
+
+class TxCounter(Model):
+    """
+    Per-network tx counters, so the progress is read without COUNT(*) over the whole table.
+    Updated along with the ingest and fill writes and reconciled with the real counts from time to time.
+    """
+    network = fields.CharField(80, pk=True)
+    total = fields.BigIntField(default=0)
+    filled = fields.BigIntField(default=0)
+    failed = fields.BigIntField(default=0)
+
+    def __str__(self) -> str:
+        return f'TxCounter({self.network}, total = {self.total}, filled = {self.filled}, failed = {self.failed})'
+
+    @property
+    def done(self):
+        return self.filled + self.failed
+
+    @classmethod
+    async def get_for_network(cls, network_id: str) -> 'TxCounter':
+        counter = await cls.filter(network=network_id).first()
+        return counter or TxCounter(network=network_id)
+
+    UPSERT_DIALECTS = ThorTx.BULK_INSERT_DIALECTS
+
+    @classmethod
+    async def add(cls, network_id: str, total=0, filled=0, failed=0,
+                  using_db: Optional[BaseDBAsyncClient] = None, force=False):
+        """
+        Increments the counters, the row of the network is created on the first use.
+        """
+        if not (total or filled or failed or force):
+            return
+
+        db = using_db or cls._meta.db
+        if db.capabilities.dialect not in cls.UPSERT_DIALECTS:
+            await cls.get_or_create(network=network_id, using_db=using_db)
+            await cls.filter(network=network_id).using_db(db).update(total=F('total') + total,
+                                                                     filled=F('filled') + filled,
+                                                                     failed=F('failed') + failed)
+            return
+
+        t = f'"{cls._meta.db_table}"'
+        await db.execute_query(
+            f'INSERT INTO {t} ("network", "total", "filled", "failed") '
+            f'VALUES ({ThorTx._sql_literal(network_id)}, {int(total)}, {int(filled)}, {int(failed)}) '
+            f'ON CONFLICT ("network") DO UPDATE SET '
+            f'"total" = {t}."total" + EXCLUDED."total", '
+            f'"filled" = {t}."filled" + EXCLUDED."filled", '
+            f'"failed" = {t}."failed" + EXCLUDED."failed"')
+
+    @classmethod
+    async def reconcile(cls, network_id: str, max_fails: int) -> 'TxCounter':
+        """
+        Sets the counters to the real counts.
+        The row is locked before counting: the writes committed before are counted,
+        the ones that come later wait and add their increments on top.
+        """
+        async with in_transaction() as conn:
+            await cls.add(network_id, using_db=conn, force=True)
+            counter = await cls.select_for_update().using_db(conn).get(network=network_id)
+            rows = await conn.execute_query_dict(
+                f'SELECT COUNT(*) AS "total", '
+                f'COALESCE(SUM(CASE WHEN "process_flags" > 0 THEN 1 ELSE 0 END), 0) AS "filled", '
+                f'COALESCE(SUM(CASE WHEN "process_flags" <= {-int(max_fails)} THEN 1 ELSE 0 END), 0) AS "failed" '
+                f'FROM "{ThorTx._meta.db_table}" WHERE "network" = {ThorTx._sql_literal(network_id)}')
+            counter.total, counter.filled, counter.failed = (int(rows[0][k]) for k in ('total', 'filled', 'failed'))
+            await counter.save(using_db=conn)
+        return counter
+
+
+class FillerShard(Model):
+    """
+    Heartbeat of a value filler process which fills its own shard of blocks (block_height % shards == shard).
+    """
+    STALE_PERIODS = 3  # a heartbeat is stale once that many report periods have passed
+    id = fields.BigIntField(pk=True)
+    network = fields.CharField(80, index=True)
+    shard = fields.IntField(default=0)
+    shards = fields.IntField(default=1)
+    owner = fields.CharField(64, default='')  # host/pid
+    level = fields.IntField(default=0)  # concurrent jobs
+    processed = fields.BigIntField(default=0)  # txs since the process start
+    tx_per_sec = fields.FloatField(default=0.0)
+    updated = fields.BigIntField(default=0)  # timestamp
+
+    class Meta:
+        unique_together = (('network', 'shard'),)
+
+    @classmethod
+    async def report(cls, network_id: str, shard: int, **kwargs) -> 'FillerShard':
+        kwargs['updated'] = int(time.time())
+        heartbeat, _ = await cls.update_or_create(defaults=kwargs, network=network_id, shard=shard)
+        return heartbeat
+
+    @classmethod
+    async def remove_stale(cls, network_id: str, max_age: float) -> int:
+        """
+        Deletes the heartbeats older than max_age sec: their processes are gone (or there are fewer shards now).
+        """
+        return await cls.filter(network=network_id, updated__lt=int(time.time() - max_age)).delete()
+
+    @classmethod
+    async def all_of_network(cls, network_id: str, max_age: Optional[float] = None):
+        q = cls.filter(network=network_id)
+        if max_age is not None:
+            q = q.filter(updated__gte=int(time.time() - max_age))
+        return await q.order_by('shard') \
+            .values('shard', 'shards', 'owner', 'level', 'processed', 'tx_per_sec', 'updated')
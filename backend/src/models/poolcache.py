@@ -1,5 +1,8 @@
+from typing import List, Optional, Set
+
 from aiothornode.types import ThorPool
-from tortoise import fields, Model
+from pypika import PostgreSQLQuery
+from tortoise import fields, Model, BaseDBAsyncClient
 
 
 class ThorPoolModel(Model):
@@ -13,6 +16,9 @@ class ThorPoolModel(Model):
     pool_units = fields.DecimalField(30, 0)
     status = fields.CharField(32, index=True)
 
+    class Meta:
+        unique_together = (('network', 'block_height', 'pool'),)
+
     def __str__(self) -> str:
         return f'ThorPoolModel(#{self.block_height}, ' \
                f'{int(self.balance_asset) / 1e8} {self.pool} vs {int(self.balance_rune) / 1e8} R, ' \
@@ -30,6 +36,33 @@ class ThorPoolModel(Model):
             status=p.status
         )
 
+    @classmethod
+    async def save_snapshot(cls, pools: List['ThorPoolModel'], using_db: Optional[BaseDBAsyncClient] = None):
+        """
+        Saves the pools of a block with one insert. Pools which are already there are skipped,
+        so concurrent saves of the same block are harmless.
+        """
+        if not pools:
+            return
+
+        db = using_db or cls._meta.db
+        if db.capabilities.dialect not in ('postgres', 'sqlite'):
+            for pool in pools:
+                if not await cls.find_one(pool.network, pool.block_height, pool.pool):
+                    await pool.save(using_db=db)
+            return
+
+        meta = cls._meta
+        fields_map = {name: meta.fields_map[name] for name in meta.fields_db_projection if name != meta.pk_attr}
+        rows = [[field.to_db_value(getattr(pool, name), pool) for name, field in fields_map.items()]
+                for pool in pools]
+        query = PostgreSQLQuery \
+            .into(meta.db_table) \
+            .columns(*(meta.fields_db_projection[name] for name in fields_map)) \
+            .insert(*rows) \
+            .on_conflict('network', 'block_height', 'pool').do_nothing()
+        await db.execute_query(query.get_sql())
+
     @classmethod
     async def find_one(cls, network_id: str, block_height: int, pool: str):
         return await cls.filter(network=network_id, block_height=block_height, pool=pool).first()
@@ -38,6 +71,28 @@ class ThorPoolModel(Model):
     async def find_pools(cls, network_id: str, block_height: int):
         return await cls.filter(network=network_id, block_height=block_height)
 
+    @classmethod
+    async def nearest_height(cls, network_id: str, block_height: int, tolerance: int) -> Optional[int]:
+        """
+        :return: the closest block within the tolerance which has pools in the DB (the lower one if equally close)
+        """
+        below = await cls.filter(network=network_id,
+                                 block_height__lte=block_height,
+                                 block_height__gte=block_height - tolerance) \
+            .order_by('-block_height').first().values_list('block_height', flat=True)
+        above = await cls.filter(network=network_id,
+                                 block_height__gt=block_height,
+                                 block_height__lte=block_height + tolerance) \
+            .order_by('block_height').first().values_list('block_height', flat=True)
+        candidates = [h for h in (below, above) if h is not None]
+        return min(candidates, key=lambda h: abs(h - block_height)) if candidates else None
+
+    @classmethod
+    async def heights_in_db(cls, network_id: str, heights: List[int]) -> Set[int]:
+        rows = await cls.filter(network=network_id, block_height__in=heights) \
+            .distinct().values_list('block_height', flat=True)
+        return set(rows)
+
     @property
     def assets_per_rune(self):
         return int(self.balance_asset) / int(self.balance_rune)
@@ -0,0 +1,101 @@
+import bisect
+from array import array
+from typing import Optional
+
+from pypika import PostgreSQLQuery
+from tortoise import fields, Model
+
+
+class RunePrice(Model):
+    """
+    USD price of Rune at a block. Saved as a side effect of pool loading by ValueFiller.
+    """
+    id = fields.BigIntField(pk=True)
+    network = fields.CharField(80, index=True)
+    height = fields.BigIntField(index=True)
+    timestamp = fields.BigIntField(index=True)
+    usd_per_rune = fields.FloatField()
+    source = fields.CharField(16)  # see SOURCE_*
+
+    SOURCE_POOLS = 'pools'  # stable coin pools of the block
+    SOURCE_COINGECKO = 'coingecko'
+
+    class Meta:
+        table = 'rune_price'
+        unique_together = (('network', 'height'),)
+
+    def __str__(self) -> str:
+        return f'RunePrice({self.network}, #{self.height}, {self.timestamp}: ${self.usd_per_rune}, {self.source})'
+
+    @classmethod
+    async def put(cls, network_id: str, height: int, timestamp: int, usd_per_rune: float, source: str):
+        """
+        Saves the price unless the block has it already.
+        """
+        db = cls._meta.db
+        if db.capabilities.dialect not in ('postgres', 'sqlite'):
+            await cls.get_or_create(defaults={
+                'timestamp': timestamp,
+                'usd_per_rune': usd_per_rune,
+                'source': source,
+            }, network=network_id, height=height)
+            return
+
+        query = PostgreSQLQuery \
+            .into(cls._meta.db_table) \
+            .columns('network', 'height', 'timestamp', 'usd_per_rune', 'source') \
+            .insert(network_id, int(height), int(timestamp), float(usd_per_rune), source) \
+            .on_conflict('network', 'height').do_nothing()
+        await db.execute_query(query.get_sql())
+
+
+class RunePriceIndex:
+    """
+    Rune price series of a network in memory: compact arrays sorted by height for binary search.
+    Block time grows with the height, so the same order serves the lookups by timestamp.
+    """
+
+    def __init__(self):
+        self.heights = array('q')
+        self.timestamps = array('q')
+        self.prices = array('d')
+
+    @classmethod
+    async def load(cls, network_id: str) -> 'RunePriceIndex':
+        index = cls()
+        rows = await RunePrice.filter(network=network_id) \
+            .order_by('height') \
+            .values_list('height', 'timestamp', 'usd_per_rune')
+        for height, timestamp, usd_per_rune in rows:
+            index.heights.append(height)
+            index.timestamps.append(timestamp)
+            index.prices.append(usd_per_rune)
+        return index
+
+    def __len__(self):
+        return len(self.heights)
+
+    def add(self, height: int, timestamp: int, usd_per_rune: float):
+        i = bisect.bisect_left(self.heights, height)
+        if i < len(self.heights) and self.heights[i] == height:
+            self.timestamps[i], self.prices[i] = timestamp, usd_per_rune
+        else:
+            self.heights.insert(i, height)
+            self.timestamps.insert(i, timestamp)
+            self.prices.insert(i, usd_per_rune)
+
+    def at_height(self, height: int, exact=False) -> Optional[float]:
+        """
+        :return: the price at the block or the last known one before it (if not exact)
+        """
+        i = bisect.bisect_right(self.heights, height) - 1
+        if i < 0 or (exact and self.heights[i] != height):
+            return None
+        return self.prices[i]
+
+    def at_time(self, timestamp: int) -> Optional[float]:
+        """
+        :return: the last known price at the moment
+        """
+        i = bisect.bisect_right(self.timestamps, timestamp) - 1
+        return self.prices[i] if i >= 0 else None
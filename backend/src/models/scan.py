@@ -0,0 +1,69 @@
+from typing import Optional
+
+from tortoise import fields, Model
+
+from models.tx import ThorTx
+
+
+class ScanWatermark(Model):
+    """
+    The newest transaction which is known to be stored along with everything below it.
+    The head scan goes down only to this mark.
+    """
+    network = fields.CharField(80, pk=True)
+    block_height = fields.BigIntField(default=0)
+    hash = fields.CharField(255, default='')
+
+    def __str__(self) -> str:
+        return f'ScanWatermark({self.network}, #{self.block_height}, {self.hash})'
+
+    def is_reached_by(self, tx: ThorTx):
+        # a block is indexed by Midgard as a whole, so nothing new can appear at or below the marked height
+        return tx.hash == self.hash or (tx.block_height or 0) <= self.block_height
+
+    @classmethod
+    async def load(cls, network_id: str) -> Optional['ScanWatermark']:
+        return await cls.filter(network=network_id).first()
+
+    @classmethod
+    async def put(cls, network_id: str, tx: ThorTx) -> 'ScanWatermark':
+        mark, _ = await cls.update_or_create(defaults={
+            'block_height': tx.block_height or 0,
+            'hash': tx.hash,
+        }, network=network_id)
+        return mark
+
+
+class ScanCheckpoint(Model):
+    """
+    Progress of the deep history walk (back-fill). Lets it resume after restart.
+    """
+    network = fields.CharField(80, pk=True)
+    offset = fields.BigIntField(default=0)
+    last_height = fields.BigIntField(default=0)
+    total_count = fields.BigIntField(default=0)
+    finished = fields.BooleanField(default=False)
+
+    def __str__(self) -> str:
+        return f'ScanCheckpoint({self.network}, offset = {self.offset}, #{self.last_height}, ' \
+               f'total = {self.total_count}{", finished" if self.finished else ""})'
+
+    def resume_offset(self, total_count_now: int, batch_size: int):
+        # new txs are added on top of the list and shift the old ones to the bigger offsets;
+        # one page is scanned again just in case
+        shift = max(0, total_count_now - self.total_count)
+        return max(0, self.offset + shift - batch_size)
+
+    @classmethod
+    async def load(cls, network_id: str) -> Optional['ScanCheckpoint']:
+        return await cls.filter(network=network_id).first()
+
+    @classmethod
+    async def put(cls, network_id: str, offset: int, last_height: int, total_count: int, finished=False):
+        checkpoint, _ = await cls.update_or_create(defaults={
+            'offset': offset,
+            'last_height': last_height,
+            'total_count': total_count,
+            'finished': finished,
+        }, network=network_id)
+        return checkpoint
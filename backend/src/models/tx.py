@@ -1,13 +1,14 @@
 import datetime
-import random
-from typing import Dict, Optional, Iterable
+import math
+import time
+from typing import Dict, Optional, Iterable, List, Set
 
 from aiothornode.types import ThorPool
+from pypika import PostgreSQLQuery
 from tortoise import fields, exceptions, Model, BaseDBAsyncClient
 from tortoise.functions import Max, Count
 
 from helpers.coins import is_rune
-from models.poolcache import ThorPoolModel
 
 
 class ThorTxType:
@@ -56,6 +57,11 @@ class ThorTx(Model):
     liq_units = fields.FloatField(default=0.0)
     process_flags = fields.IntField(default=0, index=True)
 
+    priced_height = fields.BigIntField(default=None, null=True)  # block of the pools used to fill the volumes
+
+    lease_until = fields.BigIntField(default=None, null=True)  # claimed by a filler till this timestamp
+    lease_owner = fields.CharField(64, default=None, null=True)
+
     def __str__(self):
         return f"{self.type}(@{datetime.datetime.fromtimestamp(float(self.date))}, {self.user_address}: " \
                f"{self.amount1} {self.asset1 or 'Rune'} -> {self.amount2} {self.asset2 or 'Rune'})"
@@ -82,6 +88,45 @@ class ThorTx(Model):
         except exceptions.IntegrityError:
             return False
 
+    BULK_INSERT_DIALECTS = ('postgres', 'sqlite')
+
+    @classmethod
+    async def save_many_unique(cls, txs: List['ThorTx'], using_db: Optional[BaseDBAsyncClient] = None) -> int:
+        """
+        Inserts the whole batch with one statement; the hashes which are already in the DB are skipped.
+        :return: number of really new rows
+        """
+        return len(await cls.insert_unique(txs, using_db))
+
+    @classmethod
+    async def insert_unique(cls, txs: List['ThorTx'], using_db: Optional[BaseDBAsyncClient] = None) -> Set[str]:
+        """
+        Same as save_many_unique. Falls back to save_unique one by one if the DB can't do "insert or ignore".
+        :return: hashes of really new rows
+        """
+        if not txs:
+            return set()
+
+        db = using_db or cls._meta.db
+        if db.capabilities.dialect not in cls.BULK_INSERT_DIALECTS:
+            return {tx.hash for tx in txs if await tx.save_unique()}
+
+        meta = cls._meta
+        fields_map = {name: meta.fields_map[name] for name in meta.fields_db_projection if name != meta.pk_attr}
+        rows = []
+        for tx in txs:
+            tx._fix_prices()
+            rows.append([field.to_db_value(getattr(tx, name), tx) for name, field in fields_map.items()])
+
+        query = PostgreSQLQuery \
+            .into(meta.db_table) \
+            .columns(*(meta.fields_db_projection[name] for name in fields_map)) \
+            .insert(*rows) \
+            .on_conflict('hash').do_nothing() \
+            .returning('hash')
+        inserted = await db.execute_query_dict(query.get_sql())
+        return {row['hash'] for row in inserted}
+
     @classmethod
     async def select_not_processed_transactions(cls, network_id, start=0, limit=10, max_fails=3, new_first=True):
         order = '-block_height' if new_first else 'block_height'
@@ -90,12 +135,87 @@ class ThorTx(Model):
             process_flags__lte=0,
             process_flags__gt=-max_fails).order_by(order).limit(limit).offset(start)
 
+    # Unfilled txs are claimed through two partial indices (see helpers.db), both hold only the txs to be claimed:
+    # the fresh ones by height and the leased ones by the lease end.
+    # The txs out of attempts have no lease, so they are in neither.
     @classmethod
-    async def select_random_unfilled_tx(cls, network_id, max_fails=3):
-        n = await cls.count_without_volume(network_id, max_fails)
-        random_shift = random.randint(0, n - 1) if n > 0 else 0
-        txs = await cls.select_not_processed_transactions(network_id, random_shift, 1, max_fails)
-        return txs[0] if txs else None
+    def _fresh_condition(cls, network_id, shard=0, shards=1):
+        shard_filter = f' AND "block_height" % {int(shards)} = {int(shard)}' if shards > 1 else ''
+        return (f'"network" = {cls._sql_literal(network_id)} '
+                f'AND "process_flags" = 0 AND "lease_until" IS NULL{shard_filter}')
+
+    @classmethod
+    def _expired_condition(cls, network_id, max_fails, now, shard=0, shards=1):
+        shard_filter = f' AND "block_height" % {int(shards)} = {int(shard)}' if shards > 1 else ''
+        return (f'"network" = {cls._sql_literal(network_id)} '
+                f'AND "process_flags" <= 0 AND "lease_until" IS NOT NULL AND "lease_until" < {int(now)} '
+                f'AND "process_flags" > {-int(max_fails)}{shard_filter}')
+
+    @classmethod
+    async def claim_unfilled(cls, network_id, limit, owner: str, lease_sec: int, max_fails=3,
+                             shard=0, shards=1) -> List['ThorTx']:
+        """
+        Leases up to "limit" unfilled txs to the owner: the expired leases first (failed txs whose pause is over,
+        txs of crashed owners), then the fresh txs of the lowest heights.
+        Concurrent callers get disjoint sets.
+        With shards > 1 only the blocks with block_height % shards == shard are taken.
+        """
+        now = int(time.time())
+        db = cls._meta.db
+        lock = ' FOR UPDATE SKIP LOCKED' if db.capabilities.dialect == 'postgres' else ''
+        table = cls._meta.db_table
+        ids = []
+        for condition, order in ((cls._expired_condition(network_id, max_fails, now, shard, shards), 'lease_until'),
+                                 (cls._fresh_condition(network_id, shard, shards), 'block_height')):
+            if len(ids) >= limit:
+                break
+            sql = (f'UPDATE "{table}" '
+                   f'SET "lease_until" = {now + int(lease_sec)}, "lease_owner" = {cls._sql_literal(owner[:64])} '
+                   f'WHERE "id" IN ('
+                   f' SELECT "id" FROM "{table}" WHERE {condition} '
+                   f' ORDER BY "{order}" LIMIT {int(limit) - len(ids)}{lock}'
+                   f') RETURNING "id"')
+            ids += [row['id'] for row in await db.execute_query_dict(sql)]
+        if not ids:
+            return []
+        return await cls.filter(id__in=ids).order_by('block_height')
+
+    @classmethod
+    async def next_unclaimed_heights(cls, network_id, limit, max_fails=3, shard=0, shards=1) -> List[int]:
+        """
+        :return: the lowest heights of the unfilled txs which will be claimed next
+        """
+        table = cls._meta.db_table
+        expired = cls._expired_condition(network_id, max_fails, time.time(), shard, shards)
+        sql = (f'SELECT "block_height" FROM ('
+               f' SELECT "block_height" FROM "{table}" WHERE {expired} ORDER BY "lease_until" LIMIT {int(limit)}'
+               f') AS e UNION SELECT "block_height" FROM ('
+               f' SELECT "block_height" FROM "{table}" WHERE {cls._fresh_condition(network_id, shard, shards)}'
+               f' ORDER BY "block_height" LIMIT {int(limit)}'
+               f') AS f ORDER BY "block_height" LIMIT {int(limit)}')
+        rows = await cls._meta.db.execute_query_dict(sql)
+        return [row['block_height'] for row in rows]
+
+    @classmethod
+    async def settle_leases(cls, network_id, max_fails=3):
+        """
+        Brings the leases in line with max_fails, which may have changed since the txs failed (or they failed
+        before there were leases): the txs out of attempts lose their leases, the others are leased till 0,
+        so they are claimed again.
+        :return: number of changed txs
+        """
+        network = cls._sql_literal(network_id)
+        table = cls._meta.db_table
+        db = cls._meta.db
+        dead = await db.execute_query_dict(
+            f'UPDATE "{table}" SET "lease_until" = NULL, "lease_owner" = NULL '
+            f'WHERE "network" = {network} AND "process_flags" <= {-int(max_fails)} AND "lease_until" IS NOT NULL '
+            f'RETURNING "id"')
+        alive = await db.execute_query_dict(
+            f'UPDATE "{table}" SET "lease_until" = 0 '
+            f'WHERE "network" = {network} AND "process_flags" < 0 AND "process_flags" > {-int(max_fails)} '
+            f'AND "lease_until" IS NULL RETURNING "id"')
+        return len(dead) + len(alive)
 
     def increase_fail_count(self):
         self.process_flags -= 1
@@ -104,31 +224,30 @@ class ThorTx(Model):
         self.process_flags = 1
 
     @staticmethod
-    def _usd_price_and_volume(asset, amount, pools: Dict[str, ThorPoolModel], usd_per_rune: float):
+    def _usd_price_and_volume(asset, amount, runes_per_asset: Dict[str, float], usd_per_rune: float):
         if asset is None or is_rune(asset):
             return usd_per_rune, amount * usd_per_rune, amount
         else:
-            pool = pools.get(asset, None)
-            if not pool or int(pool.balance_rune) == 0 or int(pool.balance_asset) == 0:
+            pool_runes_per_asset = runes_per_asset.get(asset)
+            if not pool_runes_per_asset:
                 return None, 0.0, 0.0
-            usd_price = usd_per_rune if asset is None else pool.runes_per_asset * usd_per_rune
+            usd_price = pool_runes_per_asset * usd_per_rune
             usd_volume = usd_price * amount
             rune_volume = usd_volume / usd_per_rune
             return usd_price, usd_volume, rune_volume
 
-    def fill_volumes(self, pools: Dict[str, ThorPoolModel], usd_per_rune: float):
-        # # fdixme: debug!
-        # print(self.type)
-        # if self.type == ThorTxType.TYPE_SWITCH:
-        #     print('boo!')
-
-        if not usd_per_rune:
+    def fill_volumes(self, runes_per_asset: Dict[str, float], usd_per_rune: float):
+        """
+        :param runes_per_asset: pool price of each asset in Rune (pools with zero depth must be left out)
+        :param usd_per_rune: Rune price
+        """
+        if not usd_per_rune or not math.isfinite(usd_per_rune):
             return self.increase_fail_count()
 
-        self.usd_price1, usd_volume1, rune_volume1 = self._usd_price_and_volume(self.asset1, self.amount1, pools,
-                                                                                usd_per_rune)
-        self.usd_price2, usd_volume2, rune_volume2 = self._usd_price_and_volume(self.asset2, self.amount2, pools,
-                                                                                usd_per_rune)
+        self.usd_price1, usd_volume1, rune_volume1 = self._usd_price_and_volume(self.asset1, self.amount1,
+                                                                                runes_per_asset, usd_per_rune)
+        self.usd_price2, usd_volume2, rune_volume2 = self._usd_price_and_volume(self.asset2, self.amount2,
+                                                                                runes_per_asset, usd_per_rune)
 
         if self.asset1 and not self.usd_price1:
             return self.increase_fail_count()
@@ -138,21 +257,82 @@ class ThorTx(Model):
 
         if self.type in (ThorTxType.TYPE_SWAP, ThorTxType.TYPE_REFUND, ThorTxType.TYPE_SWITCH):
             # 1. swap, refund, switch: volume = input asset
-            self.rune_volume = rune_volume1
-            self.usd_volume = usd_volume1
+            rune_volume, usd_volume = rune_volume1, usd_volume1
         else:
             # 2. donate, withdraw, addLiquidity = sum of input and output
-            self.rune_volume = rune_volume1 + rune_volume2
-            self.usd_volume = usd_volume1 + usd_volume2
+            rune_volume, usd_volume = rune_volume1 + rune_volume2, usd_volume1 + usd_volume2
 
+        if not (math.isfinite(rune_volume) and math.isfinite(usd_volume)):
+            return self.increase_fail_count()  # broken pool data
+
+        self.rune_volume = rune_volume
+        self.usd_volume = usd_volume
         self.set_processed()
 
+    FILL_FIELDS = {
+        'usd_price1': 'DOUBLE PRECISION',
+        'usd_price2': 'DOUBLE PRECISION',
+        'rune_volume': 'DOUBLE PRECISION',
+        'usd_volume': 'DOUBLE PRECISION',
+        'process_flags': 'INT',
+        'priced_height': 'BIGINT',
+        'lease_until': 'BIGINT',
+    }
+
+    @staticmethod
+    def _sql_literal(value):
+        if value is None:
+            return 'NULL'
+        elif isinstance(value, str):
+            return "'" + value.replace("'", "''") + "'"
+        elif isinstance(value, int):
+            return str(int(value))
+        value = float(value)
+        return repr(value) if math.isfinite(value) else 'NULL'  # there are no literals for NaN and infinity
+
+    @classmethod
+    async def save_filled_many(cls, txs: List['ThorTx'], using_db: Optional[BaseDBAsyncClient] = None) -> Set[int]:
+        """
+        Writes the results of filling (prices, volumes and flags) of many txs with one UPDATE.
+        The txs which have been filled meanwhile (by another job after the lease expired) are left as they are.
+        :return: ids of the updated txs
+        """
+        txs = [tx for tx in txs if tx.id is not None]
+        if not txs:
+            return set()
+
+        for tx in txs:
+            tx._fix_prices()
+
+        assignments = []
+        for name, sql_type in cls.FILL_FIELDS.items():
+            column = cls._meta.fields_db_projection[name]
+            cases = ' '.join(f'WHEN {int(tx.id)} THEN {cls._sql_literal(getattr(tx, name))}' for tx in txs)
+            assignments.append(f'"{column}" = CAST(CASE "id" {cases} END AS {sql_type})')
+
+        ids = ', '.join(str(int(tx.id)) for tx in txs)
+        sql = (f'UPDATE "{cls._meta.db_table}" SET {", ".join(assignments)} '
+               f'WHERE "id" IN ({ids}) AND "process_flags" <= 0')
+
+        db = using_db or cls._meta.db
+        if db.capabilities.dialect not in cls.BULK_INSERT_DIALECTS:
+            # no RETURNING: the rows still unfilled are locked (in a transaction) and then updated
+            updated = await cls.filter(id__in=[tx.id for tx in txs], process_flags__lte=0) \
+                .select_for_update().using_db(db).values_list('id', flat=True)
+            await db.execute_query(sql)
+            return set(updated)
+        rows = await db.execute_query_dict(sql + ' RETURNING "id"')
+        return {row['id'] for row in rows}
+
     async def _pre_save(self, using_db: Optional[BaseDBAsyncClient] = None,
                         update_fields: Optional[Iterable[str]] = None) -> None:
-        self.usd_price1 = self.usd_price1 or 0.0
-        self.usd_price2 = self.usd_price2 or 0.0
+        self._fix_prices()
         return await super()._pre_save(using_db, update_fields)
 
+    def _fix_prices(self):
+        self.usd_price1 = self.usd_price1 if self.usd_price1 and math.isfinite(self.usd_price1) else 0.0
+        self.usd_price2 = self.usd_price2 if self.usd_price2 and math.isfinite(self.usd_price2) else 0.0
+
     @classmethod
     async def last_date(cls):
         try:
@@ -191,6 +371,27 @@ class ThorTx(Model):
     async def clear_rune_volume(cls, network):
         await cls.filter(network=network).all().update(rune_volume=None, usd_volume=None, process_flags=0)
 
+    @classmethod
+    def priced_elsewhere_condition(cls, network, min_distance=1) -> str:
+        """
+        SQL condition of the filled txs which were priced with pools of another block (at least min_distance away).
+        """
+        return (f'"network" = {cls._sql_literal(network)} AND "process_flags" > 0 '
+                f'AND ABS("priced_height" - "block_height") >= {int(min_distance)}')
+
+    @classmethod
+    async def reset_priced_from_other_blocks(cls, network, min_distance=1) -> int:
+        """
+        Marks the filled txs which were priced with pools of another block (at least min_distance away)
+        to be filled again. priced_height is kept: it tells the filler not to take a nearby block again.
+        :return: number of such txs
+        """
+        table = cls._meta.db_table
+        sql = (f'UPDATE "{table}" SET "process_flags" = 0, "rune_volume" = NULL, "usd_volume" = NULL '
+               f'WHERE {cls.priced_elsewhere_condition(network, min_distance)}')
+        n, _ = await cls._meta.db.execute_query(sql)
+        return n
+
     @classmethod
     async def all_for_address(cls, user_address):
         return await cls.filter(user_address=user_address)
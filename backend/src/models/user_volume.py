@@ -0,0 +1,177 @@
+from collections import defaultdict
+from typing import List, Optional, Dict, Tuple
+
+from tortoise import fields, Model, BaseDBAsyncClient
+from tortoise.transactions import in_transaction
+
+from helpers.datetime import DAY
+from models.tx import ThorTx, ThorTxType
+
+
+def day_of(timestamp: int) -> int:
+    return int(timestamp) - int(timestamp) % DAY
+
+
+class UserVolumeDay(Model):
+    """
+    Swap volume of a user per day: the rollup of thortx which the leaderboard sums instead of the raw txs.
+    The swaps are counted when they are stored, their volumes are added when they are filled (in the same
+    transactions). Like SUM over thortx, the volumes are NULL while none of the swaps of the day has one
+    (the parser stores 0.0 for the unfilled swaps, refine_prices resets them to NULL).
+    rebuild() makes it from scratch.
+    """
+    id = fields.BigIntField(pk=True)
+    network = fields.CharField(80)
+    user_address = fields.CharField(255)
+    day = fields.BigIntField()  # timestamp of the day start (UTC)
+
+    rune_volume = fields.FloatField(default=None, null=True)
+    usd_volume = fields.FloatField(default=None, null=True)
+    n = fields.BigIntField(default=0)  # all swaps, filled or not
+    n_filled = fields.BigIntField(default=0)  # process_flags > 0
+    last_date = fields.BigIntField(default=0)
+
+    class Meta:
+        table = 'user_volume_day'
+        unique_together = (('network', 'user_address', 'day'),)
+        indexes = (('network', 'day'),)
+
+    def __str__(self) -> str:
+        return f'UserVolumeDay({self.network}, {self.user_address}, day = {self.day}, n = {self.n}, ' \
+               f'rune = {self.rune_volume}, usd = {self.usd_volume})'
+
+    UPSERT_DIALECTS = ThorTx.BULK_INSERT_DIALECTS
+    COLUMNS = ('network', 'user_address', 'day', 'rune_volume', 'usd_volume', 'n', 'n_filled', 'last_date')
+
+    @classmethod
+    async def _add(cls, network_id: str, buckets: Dict[Tuple[str, int], list],
+                   using_db: Optional[BaseDBAsyncClient] = None):
+        """
+        Adds [rune_volume, usd_volume, n, n_filled, last_date] to the buckets of (user_address, day).
+        """
+        if not buckets:
+            return
+
+        db = using_db or cls._meta.db
+        if db.capabilities.dialect not in cls.UPSERT_DIALECTS:
+            for (user_address, day), (rune_volume, usd_volume, n, n_filled, last_date) in sorted(buckets.items()):
+                bucket, _ = await cls.get_or_create(network=network_id, user_address=user_address, day=day,
+                                                    using_db=using_db)
+                if rune_volume is not None:
+                    bucket.rune_volume = (bucket.rune_volume or 0.0) + rune_volume
+                    bucket.usd_volume = (bucket.usd_volume or 0.0) + usd_volume
+                bucket.n += n
+                bucket.n_filled += n_filled
+                bucket.last_date = max(bucket.last_date, last_date)
+                await bucket.save(using_db=using_db)
+            return
+
+        literal = ThorTx._sql_literal
+        rows = ', '.join(
+            f'({literal(network_id)}, {literal(user_address)}, {int(day)}, {literal(rune_volume)}, '
+            f'{literal(usd_volume)}, {int(n)}, {int(n_filled)}, {int(last_date)})'
+            for (user_address, day), (rune_volume, usd_volume, n, n_filled, last_date) in sorted(buckets.items())
+        )  # sorted: concurrent writers lock the rows in the same order
+        t = f'"{cls._meta.db_table}"'
+        columns = ', '.join(f'"{c}"' for c in cls.COLUMNS)
+        sql = (f'INSERT INTO {t} ({columns}) VALUES {rows} '
+               f'ON CONFLICT ("network", "user_address", "day") DO UPDATE SET '
+               f'"rune_volume" = COALESCE({t}."rune_volume" + EXCLUDED."rune_volume", '
+               f'{t}."rune_volume", EXCLUDED."rune_volume"), '
+               f'"usd_volume" = COALESCE({t}."usd_volume" + EXCLUDED."usd_volume", '
+               f'{t}."usd_volume", EXCLUDED."usd_volume"), '
+               f'"n" = {t}."n" + EXCLUDED."n", '
+               f'"n_filled" = {t}."n_filled" + EXCLUDED."n_filled", '
+               f'"last_date" = CASE WHEN EXCLUDED."last_date" > {t}."last_date" '
+               f'THEN EXCLUDED."last_date" ELSE {t}."last_date" END')
+        await db.execute_query(sql)
+
+    @classmethod
+    async def add_new_swaps(cls, txs: List[ThorTx], using_db: Optional[BaseDBAsyncClient] = None):
+        """
+        Counts the swaps just stored (volumes of the filled ones are added as well).
+        """
+        per_network = defaultdict(dict)
+        for tx in txs:
+            if tx.type != ThorTxType.TYPE_SWAP:
+                continue
+            key = (tx.user_address, day_of(tx.date))
+            bucket = per_network[tx.network].setdefault(key, [None, None, 0, 0, 0])
+            bucket[2] += 1
+            bucket[4] = max(bucket[4], int(tx.date))
+            if tx.rune_volume is not None:
+                bucket[0] = (bucket[0] or 0.0) + tx.rune_volume
+                bucket[1] = (bucket[1] or 0.0) + (tx.usd_volume or 0.0)
+            if tx.process_flags > 0:
+                bucket[3] += 1  # add_filled counts the others once they are filled
+
+        for network_id, buckets in per_network.items():
+            await cls._add(network_id, buckets, using_db)
+
+    @classmethod
+    async def add_filled(cls, network_id: str, txs: List[ThorTx], using_db: Optional[BaseDBAsyncClient] = None):
+        """
+        Adds the volumes of the swaps just filled (they were counted when stored).
+        """
+        buckets = {}
+        for tx in txs:
+            if tx.type != ThorTxType.TYPE_SWAP or tx.process_flags <= 0 or tx.rune_volume is None:
+                continue
+            bucket = buckets.setdefault((tx.user_address, day_of(tx.date)), [0.0, 0.0, 0, 0, 0])
+            bucket[0] += tx.rune_volume
+            bucket[1] += tx.usd_volume or 0.0
+            bucket[3] += 1
+        await cls._add(network_id, buckets, using_db)
+
+    @classmethod
+    async def subtract_filled(cls, network_id: str, tx_condition: str,
+                              using_db: Optional[BaseDBAsyncClient] = None):
+        """
+        Takes away the volumes of the filled swaps matching the SQL condition over thortx,
+        which are about to lose their volumes (to NULL) and become unfilled.
+        """
+        t = f'"{cls._meta.db_table}"'
+        swap = ThorTx._sql_literal(ThorTxType.TYPE_SWAP)
+        network = ThorTx._sql_literal(network_id)
+        # the volumes stay if any other swap of the day has one, even an unfilled swap with 0.0 (as in SUM)
+        others_have_volume = (f'EXISTS (SELECT 1 FROM "{ThorTx._meta.db_table}" '
+                              f'WHERE "network" = {network} AND "type" = {swap} '
+                              f'AND "user_address" = {t}."user_address" '
+                              f'AND "date" >= {t}."day" AND "date" < {t}."day" + {DAY} '
+                              f'AND "rune_volume" IS NOT NULL AND NOT COALESCE(({tx_condition}), FALSE))')
+        sql = (f'UPDATE {t} SET '
+               f'"rune_volume" = CASE WHEN {others_have_volume} THEN {t}."rune_volume" - s."rv" END, '
+               f'"usd_volume" = CASE WHEN {others_have_volume} THEN {t}."usd_volume" - s."uv" END, '
+               f'"n_filled" = {t}."n_filled" - s."k" '
+               f'FROM (SELECT "user_address", "date" - "date" % {DAY} AS "day", SUM("rune_volume") AS "rv", '
+               f'SUM("usd_volume") AS "uv", SUM(CASE WHEN "process_flags" > 0 THEN 1 ELSE 0 END) AS "k" '
+               f'FROM "{ThorTx._meta.db_table}" WHERE ({tx_condition}) '
+               f'AND "type" = {swap} AND "rune_volume" IS NOT NULL '
+               f'GROUP BY "user_address", "date" - "date" % {DAY}) AS s '
+               f'WHERE {t}."network" = {network} '
+               f'AND {t}."user_address" = s."user_address" AND {t}."day" = s."day"')
+        db = using_db or cls._meta.db
+        await db.execute_query(sql)
+
+    @classmethod
+    async def rebuild(cls, network_id: str) -> int:
+        """
+        Makes the rollup of the network from thortx anew.
+        The fill and ingest writes wait for it (Postgres), so none of them is lost or counted twice.
+        :return: number of buckets
+        """
+        t = f'"{cls._meta.db_table}"'
+        network = ThorTx._sql_literal(network_id)
+        columns = ', '.join(f'"{c}"' for c in cls.COLUMNS)
+        async with in_transaction() as conn:
+            if conn.capabilities.dialect == 'postgres':
+                await conn.execute_query(f'LOCK TABLE {t} IN EXCLUSIVE MODE')
+            await conn.execute_query(f'DELETE FROM {t} WHERE "network" = {network}')
+            await conn.execute_query(
+                f'INSERT INTO {t} ({columns}) '
+                f'SELECT "network", "user_address", "date" - "date" % {DAY}, SUM("rune_volume"), SUM("usd_volume"), '
+                f'COUNT("id"), SUM(CASE WHEN "process_flags" > 0 THEN 1 ELSE 0 END), MAX("date") '
+                f'FROM "{ThorTx._meta.db_table}" '
+                f'WHERE "network" = {network} AND "type" = {ThorTx._sql_literal(ThorTxType.TYPE_SWAP)} '
+                f'GROUP BY "network", "user_address", "date" - "date" % {DAY}')
+            return await cls.filter(network=network_id).using_db(conn).count()
@@ -0,0 +1,34 @@
+import asyncio
+
+from tortoise import Tortoise
+
+from helpers.db import MODELS
+from models.tx import ThorTx, ThorTxType
+
+NET = 'test'
+
+
+def make_tx(height=100, i=0, **kwargs) -> ThorTx:
+    """
+    The i-th swap of the block, any field may be overridden.
+    """
+    fields = dict(hash=f'h{height}-{i}', block_height=height, network=NET, type=ThorTxType.TYPE_SWAP,
+                  date=height * 10, user_address=f'u{i}', amount1=1.0, amount2=2.0)
+    fields.update(kwargs)
+    return ThorTx(**fields)
+
+
+def run_with_db(main, *args):
+    """
+    Runs the coroutine function with a fresh in-memory SQLite DB of all the models.
+    """
+
+    async def run():
+        await Tortoise.init(db_url='sqlite://:memory:', modules={'models': MODELS})
+        await Tortoise.generate_schemas()
+        try:
+            return await main(*args)
+        finally:
+            await Tortoise.close_connections()
+
+    return asyncio.run(run())
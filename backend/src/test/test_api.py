@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+from api import API, MAX_TS
+from leaderboard_cache import RankingCache
+
+
+class FakeRequest:
+    def __init__(self, **query):
+        self.rel_url = type('URL', (), {'query': query})()
+
+
+class SlowRanking:
+    def __init__(self, error=None):
+        self.error = error
+        self.loads = 0
+
+    async def load(self, network_id, since, to, currency):
+        self.loads += 1
+        await asyncio.sleep(0.01)
+        if self.error:
+            raise self.error
+        rows = [{'user_address': f'u{i}', 'total_volume': 10.0 - i, 'volume_key': 10.0 - i} for i in range(10)]
+        return rows, 45.0, 10
+
+    async def version(self, network_id):
+        return 1, 1, 0
+
+
+def make_api(ranking: SlowRanking):
+    api = API('net')
+    api.ranking_cache = RankingCache(ranking.load, version_loader=ranking.version, max_ts=MAX_TS, granularity=60)
+    return api
+
+
+async def get_many(api, requests):
+    responses = await asyncio.gather(*(api.handler_leaderboard(r) for r in requests))
+    return [json.loads(r.text) for r in responses]
+
+
+def test_identical_requests_are_coalesced():
+    ranking = SlowRanking()
+    api = make_api(ranking)
+    # since is within the same minute, so the parameters are the same after rounding
+    requests = [FakeRequest(since=str(6000 + i), offset='0', limit='5') for i in range(10)] + \
+               [FakeRequest(since='6000', offset='5', limit='5', currency='rune')]
+    results = asyncio.run(get_many(api, requests))
+
+    assert all(r == results[0] for r in results[:10])
+    assert [e['user_address'] for e in results[0]['leaderboard']] == ['u0', 'u1', 'u2', 'u3', 'u4']
+    assert [e['user_address'] for e in results[-1]['leaderboard']] == ['u5', 'u6', 'u7', 'u8', 'u9']
+    assert all('volume_key' not in e for e in results[0]['leaderboard'])
+    assert results[0]['since'] == 6000 and results[0]['to'] == MAX_TS and results[0]['participants'] == 10
+
+    assert ranking.loads == 1
+    assert api.leaderboard_requests.stats['shared'] == 9
+    assert api.ranking_cache.stats['shared_loads'] == 1  # the other page waited for the same ranking
+    assert api.ranking_cache.stats['misses'] == 2
+
+
+def test_shared_error():
+    ranking = SlowRanking(error=ValueError('db is down'))
+    api = make_api(ranking)
+    results = asyncio.run(get_many(api, [FakeRequest(offset='0') for _ in range(5)]))
+    assert results == [{'result': 'error', 'error': 'db is down'}] * 5
+    assert ranking.loads == 1
+
+    ranking.error = None  # errors are not remembered
+    assert 'leaderboard' in asyncio.run(get_many(api, [FakeRequest(offset='0')]))[0]
+
+
+def test_keyset_pages():
+    api = make_api(SlowRanking())
+
+    async def walk():
+        users, cursor = [], None
+        while True:
+            query = {'limit': '4'}
+            if cursor:
+                query['cursor'] = cursor
+            data = json.loads((await api.handler_leaderboard(FakeRequest(**query))).text)
+            users += [e['user_address'] for e in data['leaderboard']]
+            cursor = data['next_cursor']
+            if not cursor:
+                return users
+
+    assert asyncio.run(walk()) == [f'u{i}' for i in range(10)]
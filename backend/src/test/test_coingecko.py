@@ -0,0 +1,128 @@
+import asyncio
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from helpers.coingecko import CoinGeckoPriceProvider
+from helpers.datetime import HOUR, DAY
+from models.coingecko import CoinGeckoPriceStore
+from sqlite_db import run_with_db
+
+LISTED_AT = 100 * DAY  # no prices before
+
+
+def price_at(timestamp):
+    return 1.0 + timestamp / DAY
+
+
+class FakeResponse:
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+    async def json(self):
+        return self.data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeCoinGeckoSession:
+    """
+    Stands for aiohttp.ClientSession: hourly prices of market_chart/range.
+    """
+
+    def __init__(self, status=200):
+        self.status = status
+        self.requests = []
+
+    def get(self, url):
+        query = parse_qs(urlparse(url).query)
+        t_from, t_to = int(query['from'][0]), int(query['to'][0])
+        self.requests.append((t_from, t_to))
+        first_hour = max(LISTED_AT, t_from - t_from % HOUR + HOUR)
+        prices = [[t * 1000, price_at(t)] for t in range(first_hour, t_to + 1, HOUR)]
+        return FakeResponse(self.status, {'prices': prices})
+
+
+class MemoryStore:
+    def __init__(self):
+        self.ranges, self.points = [], []
+
+    async def load(self, coin):
+        return list(self.ranges), sorted(self.points)
+
+    async def save(self, coin, t_from, t_to, points):
+        self.ranges.append((t_from, t_to))
+        self.points += points
+
+
+def test_one_request_per_span_and_interpolation():
+    session = FakeCoinGeckoSession()
+    provider = CoinGeckoPriceProvider(session, span=10 * DAY)
+
+    async def main():
+        t = 123 * DAY + 1800  # between two hourly points
+        prices = await asyncio.gather(*(provider.get_historical_rune_price(t + i * HOUR) for i in range(20)))
+        assert prices[0] == pytest.approx(price_at(t))
+        assert prices == pytest.approx([price_at(t + i * HOUR) for i in range(20)])
+        assert len(session.requests) == 1
+
+        await provider.get_historical_rune_price(125 * DAY)  # the same span
+        assert len(session.requests) == 1
+        await provider.get_historical_rune_price(135 * DAY)  # the next one
+        assert len(session.requests) == 2
+
+    asyncio.run(main())
+    assert provider.stats['lookups'] == 22
+
+
+def test_no_price_before_listing():
+    session = FakeCoinGeckoSession()
+    provider = CoinGeckoPriceProvider(session, span=10 * DAY)
+    assert asyncio.run(provider.get_historical_rune_price(LISTED_AT - 5 * HOUR)) == 0.0
+    assert asyncio.run(provider.get_historical_rune_price(LISTED_AT - 1 * HOUR)) == price_at(LISTED_AT)
+    assert len(session.requests) == 1
+
+
+def test_http_error_is_not_cached():
+    session = FakeCoinGeckoSession(status=429)
+    provider = CoinGeckoPriceProvider(session, span=10 * DAY)
+    with pytest.raises(ConnectionError):
+        asyncio.run(provider.get_historical_rune_price(123 * DAY))
+
+    session.status = 200
+    assert asyncio.run(provider.get_historical_rune_price(123 * DAY)) == price_at(123 * DAY)
+    assert len(session.requests) == 2
+
+
+def test_persisted_spans_are_not_requested_again():
+    store = MemoryStore()
+    session = FakeCoinGeckoSession()
+    t = 123 * DAY + 600
+
+    provider = CoinGeckoPriceProvider(session, span=10 * DAY, store=store)
+    price = asyncio.run(provider.get_historical_rune_price(t))
+
+    restarted = CoinGeckoPriceProvider(session, span=10 * DAY, store=store)
+    asyncio.run(restarted.load())
+    assert asyncio.run(restarted.get_historical_rune_price(t)) == price
+    assert len(session.requests) == 1
+
+
+def test_db_store_keeps_one_range_per_span():
+    store = CoinGeckoPriceStore()
+
+    async def main():
+        await store.save('rune', 0, 5, [(1, 1.0), (4, 4.0)])
+        await store.save('rune', 0, 8, [(4, 4.0), (7, 7.0)])  # the current span is requested again
+        await store.save('rune', 10, 12, [])
+        await store.save('btc', 0, 3, [(1, 100.0)])
+        return await store.load('rune')
+
+    ranges, points = run_with_db(main)
+    assert sorted(ranges) == [(0, 8), (10, 12)]
+    assert points == [(1, 1.0), (4, 4.0), (7, 7.0)]
@@ -0,0 +1,44 @@
+from jobs.concurrency import AIMDController
+
+
+def observe(controller, n, latency, ok=True):
+    for _ in range(n):
+        controller.observe(latency, ok)
+
+
+def test_aimd():
+    c = AIMDController(4, min_level=1, max_level=6, target_latency=1.0, max_error_rate=0.1, work_per_worker=10)
+
+    observe(c, 10, 0.5)
+    assert c.adjust(backlog=1000) == 5  # additive increase
+    observe(c, 10, 0.5)
+    assert c.adjust(backlog=1000) == 6
+    observe(c, 10, 0.5)
+    assert c.adjust(backlog=1000) == 6  # max
+    assert c.adjust(backlog=1000) == 6  # no requests at all (e.g. everything is cached) is fine too
+
+    observe(c, 10, 3.0)
+    assert c.adjust(backlog=1000) == 3  # too slow: halved
+    assert c.reason.startswith('latency')
+
+    observe(c, 8, 0.5)
+    observe(c, 2, 0.5, ok=False)
+    assert c.adjust(backlog=1000) == 1  # errors: halved, but not below min
+    assert c.reason.startswith('error rate')
+
+    observe(c, 10, 0.5)
+    assert c.adjust(backlog=25) == 2
+    assert c.adjust(backlog=25) == 3
+    assert c.adjust(backlog=15) == 2  # no more workers than the work for them
+    assert c.adjust(backlog=0) == 1
+    assert c.reason == 'no backlog'
+
+    assert [(h['from'], h['to']) for h in c.stats['history']] == [(4, 5), (5, 6), (6, 3), (3, 1), (1, 2), (2, 3),
+                                                                   (3, 2), (2, 1)]
+
+
+def test_fixed():
+    c = AIMDController.fixed(5)
+    observe(c, 10, 100.0, ok=False)
+    assert c.adjust(backlog=0) == 5
+    assert c.stats['reason'] == 'fixed'
@@ -0,0 +1,45 @@
+import pytest
+
+from models.counters import TxCounter
+from models.tx import ThorTx
+from sqlite_db import run_with_db, make_tx, NET
+
+
+@pytest.mark.parametrize('upsert', [True, False])
+def test_add_creates_the_counter(monkeypatch, upsert):
+    if not upsert:
+        monkeypatch.setattr(TxCounter, 'UPSERT_DIALECTS', ())
+
+    async def main():
+        await TxCounter.add(NET, total=3)
+        await TxCounter.add(NET, total=2, filled=1, failed=1)
+        await TxCounter.add('other', filled=5)
+        await TxCounter.add('none')  # nothing to add
+
+        counter = await TxCounter.get(network=NET)
+        assert (counter.total, counter.filled, counter.failed) == (5, 1, 1)
+        assert (await TxCounter.get(network='other')).filled == 5
+        assert not await TxCounter.filter(network='none').exists()
+
+    run_with_db(main)
+
+
+def test_reconcile():
+    async def main():
+        await ThorTx.bulk_create([
+            make_tx(i, network=network, process_flags=flags)
+            for i, (network, flags) in enumerate([(NET, 0), (NET, 1), (NET, 1), (NET, -1), (NET, -3), (NET, -4),
+                                                  ('other', 1)])
+        ])
+        counter = await TxCounter.reconcile(NET, max_fails=3)
+        assert (counter.total, counter.filled, counter.failed) == (6, 2, 2)
+
+        await TxCounter.add(NET, total=1, filled=1)
+        counter = await TxCounter.get(network=NET)
+        assert (counter.total, counter.filled, counter.failed) == (7, 3, 2)
+
+        await TxCounter.reconcile(NET, max_fails=3)  # the real counts again
+        assert (await TxCounter.get(network=NET)).total == 6
+        assert (await TxCounter.reconcile('empty', max_fails=3)).total == 0
+
+    run_with_db(main)
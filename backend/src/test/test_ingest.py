@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+import jobs.tx.ingest
+from jobs.tx.ingest import TxIngestQueue, IngestPage, write_pages
+from models.counters import TxCounter
+from models.tx import ThorTx
+from sqlite_db import run_with_db, make_tx, NET
+
+
+def make_txs(*hashes):
+    return [make_tx(hash=h) for h in hashes]
+
+
+def test_write_pages_counts_each_new_tx_once():
+    async def main():
+        counts = await write_pages([IngestPage(NET, make_txs('a', 'b', 'c')),
+                                    IngestPage(NET, make_txs('c', 'd')),  # the same tx in adjacent pages
+                                    IngestPage(NET, [])])
+        assert counts == [3, 1, 0]
+        assert await write_pages([IngestPage(NET, make_txs('d', 'e'))]) == [1]
+        assert (await TxCounter.get_for_network(NET)).total == 5
+        assert await ThorTx.all().count() == 5
+
+    run_with_db(main)
+
+
+def test_queue_commits_pages_in_order(monkeypatch):
+    writes = []
+
+    async def slow_write_pages(pages):
+        writes.append(len(pages))
+        await asyncio.sleep(0.01)
+        return await write_pages(pages)
+
+    monkeypatch.setattr(jobs.tx.ingest, 'write_pages', slow_write_pages)
+
+    async def main():
+        queue = TxIngestQueue(max_pages=4, max_pages_per_write=3)
+        committed = []
+
+        async def on_committed(i, new_count):
+            committed.append((i, new_count))
+
+        futures = []
+        for i in range(7):
+            txs = make_txs(f'h{i}', f'h{i + 1}')  # the second tx comes again on the next page
+            futures.append(await queue.put(NET, txs, lambda n, i=i: on_committed(i, n)))
+        assert await asyncio.gather(*futures) == [2, 1, 1, 1, 1, 1, 1]
+        await queue.join()
+
+        assert committed == [(i, 2 if i == 0 else 1) for i in range(7)]
+        assert sum(writes) == 7 and max(writes) <= 3 and len(writes) < 7  # some pages were merged
+        assert queue.stats['pages'] == 7 and queue.stats['errors'] == 0 and queue.depth == 0
+        assert (await TxCounter.get_for_network(NET)).total == 8
+
+    run_with_db(main)
+
+
+def test_failed_write_is_reported(monkeypatch):
+    async def broken_write_pages(pages):
+        raise ConnectionError('db is down')
+
+    async def main():
+        queue = TxIngestQueue()
+        callbacks = []
+        with monkeypatch.context() as m:
+            m.setattr(jobs.tx.ingest, 'write_pages', broken_write_pages)
+            future = await queue.put(NET, make_txs('a'), callbacks.append)
+            with pytest.raises(ConnectionError):
+                await future
+        assert callbacks == [] and queue.stats['errors'] == 1
+
+        # the writer keeps working
+        assert await (await queue.put(NET, make_txs('a'))) == 1
+
+    run_with_db(main)
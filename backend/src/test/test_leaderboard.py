@@ -0,0 +1,242 @@
+import base64
+import json
+import random
+from decimal import Decimal
+
+import pytest
+from tortoise import Tortoise
+
+from helpers.datetime import DAY
+from jobs.tx.ingest import write_pages, IngestPage
+from jobs.value_filler import ValueFiller
+from leaderboard import full_days, leaderboard, total_volume, leaderboard_bundle_sql, encode_cursor, decode_cursor, \
+    ranking_key
+from leaderboard_cache import RankedWindow
+from models.tx import ThorTx, ThorTxType
+from models.user_volume import day_of, UserVolumeDay
+from sqlite_db import run_with_db, make_tx, NET
+
+
+def test_day_of():
+    assert day_of(0) == 0
+    assert day_of(DAY - 1) == 0
+    assert day_of(3 * DAY + 5) == 3 * DAY
+
+
+def test_full_days():
+    assert full_days(0, 0) == (0, None)
+    assert full_days(DAY + 1, 0) == (2 * DAY, None)
+    assert full_days(DAY, 3 * DAY - 1) == (DAY, 3 * DAY)  # the last day ends exactly at to_date
+    assert full_days(DAY, 3 * DAY - 2) == (DAY, 2 * DAY)
+    assert full_days(DAY + 10, 2 * DAY + 10) is None  # parts of two days
+    assert full_days(DAY + 10, DAY + 20) is None
+
+
+def random_tx(i):
+    # as the parser makes them: the volumes are 0.0 until filled
+    return make_tx(100 + i, i, date=5 * DAY + i * 3000 + random.randrange(1000),
+                   type=random.choice([ThorTxType.TYPE_SWAP, ThorTxType.TYPE_SWAP, ThorTxType.TYPE_ADD_LIQUIDITY]),
+                   user_address=f'u{i % 13}', asset1=random.choice([None, 'BTC.BTC']), amount1=random.uniform(0, 10),
+                   asset2=random.choice([None, 'BTC.BTC']), amount2=random.uniform(0, 10),
+                   rune_volume=0.0, usd_volume=0.0, process_flags=0)
+
+
+def test_rollup_is_kept_up_to_date():
+    random.seed(7)
+    windows = [(0, 0), (5 * DAY + 100, 8 * DAY + 5), (6 * DAY, 7 * DAY - 1), (6 * DAY, 7 * DAY),
+               (6 * DAY + 10, 6 * DAY + 5000), (7 * DAY, 0), (5 * DAY + 777, 9 * DAY + 1), (20 * DAY, 0)]
+
+    def rounded(rows):
+        return [{k: round(v, 6) if isinstance(v, float) else v for k, v in row.items()} for row in rows]
+
+    async def check():
+        for since, to in windows:
+            for currency in ('rune', 'usd'):
+                raw = await leaderboard(NET, since, to, 0, None, currency)
+                assert rounded(raw) == rounded(await leaderboard(NET, since, to, 0, None, currency, use_rollup=True))
+                assert await total_volume(NET, since, to, currency) == \
+                       pytest.approx(await total_volume(NET, since, to, currency, use_rollup=True))
+
+    async def rollup_rows():
+        rows = await UserVolumeDay.filter(network=NET).order_by('user_address', 'day') \
+            .values_list('user_address', 'day', 'rune_volume', 'usd_volume', 'n', 'n_filled', 'last_date')
+        return [tuple(round(x, 6) if isinstance(x, float) else x for x in row) for row in rows]
+
+    async def check_rollup():
+        await check()
+        rollup = await rollup_rows()
+        assert await UserVolumeDay.rebuild(NET) == len(rollup)
+        assert await rollup_rows() == rollup
+
+    async def main():
+        txs = [random_tx(i) for i in range(120)]
+        for k in range(0, 120, 20):  # the pages overlap
+            await write_pages([IngestPage(NET, txs[k:k + 20]), IngestPage(NET, txs[k + 10:k + 30])])
+        await check()
+
+        filler = ValueFiller(None, NET, max_fails_of_tx=2)
+        for _ in range(3):
+            batch = await filler.claim_unfilled('job', 50)
+            for tx in batch:
+                if tx.block_height % 5:
+                    tx.fill_volumes({'BTC.BTC': 1000.0 + tx.block_height}, 2.0 + tx.block_height / 100)
+                    tx.priced_height = tx.block_height - tx.block_height % 3  # some with pools of a nearby block
+                else:
+                    tx.increase_fail_count()
+            await filler.save_filled(batch)
+            await filler.save_filled(batch)  # the second time nothing is added
+            await check()
+        assert await total_volume(NET, 0, 0) > 0
+        await check_rollup()
+
+        assert await filler.refine_prices(1) > 0
+        await check_rollup()
+        assert await UserVolumeDay.filter(network=NET, rune_volume=None).exists()  # no swaps with volumes left
+
+        batch = await filler.claim_unfilled('job', 100)
+        assert batch
+        for tx in batch:
+            tx.fill_volumes({'BTC.BTC': 1000.0}, 3.0)
+        await filler.save_filled(batch)
+        await check_rollup()
+
+    run_with_db(main)
+
+
+async def insert_swaps(network, txs):
+    await ThorTx.bulk_create([
+        make_tx(i, network=network, type=t, date=d, user_address=u, rune_volume=v, usd_volume=v)
+        for i, (t, d, u, v) in enumerate(txs)
+    ])
+
+
+async def query_bundle(*args, **kwargs):
+    return await Tortoise.get_connection('default').execute_query_dict(leaderboard_bundle_sql(*args, **kwargs))
+
+
+def test_bundle_sql():
+    txs = [
+        ('swap', 100, 'a', 10.0), ('swap', 200, 'a', 5.0), ('swap', 150, 'b', 20.0), ('swap', 300, 'c', None),
+        ('addLiquidity', 160, 'd', 99.0), ('swap', 500, 'a', 1.0),  # after the window, but the last date of "a"
+        ('swap', 50, 'b', 7.0),  # before the window
+    ]
+
+    async def main():
+        await insert_swaps('net', txs)
+
+        rows = await query_bundle('net', 100, 400, 0, 10, 'rune')
+        assert [(r['user_address'], r['total_volume'], r['date'], r['n']) for r in rows] == [
+            ('b', 20.0, 150, 1), ('a', 15.0, 500, 2), ('c', None, 300, 1),
+        ]
+        assert rows[0]['chaosnet_volume'] == 35.0
+        assert rows[0]['participants'] == 4  # all types of txs
+
+        assert [r['user_address'] for r in await query_bundle('net', 100, 400, 1, 1, 'rune')] == ['a']
+        empty = await query_bundle('net', 100, 400, 10, 10, 'rune')
+        assert len(empty) == 1 and empty[0]['user_address'] is None and empty[0]['participants'] == 4
+
+    run_with_db(main)
+
+
+def test_cursor():
+    assert decode_cursor(encode_cursor({'volume_key': 12.5, 'user_address': 'thor1abc'})) == \
+           (Decimal('12.5'), 'thor1abc')
+    # the key is carried as the DB has given it, every digit of it
+    assert decode_cursor(encode_cursor({'volume_key': Decimal('12345678901.12345679'), 'user_address': 'bnb1'})) == \
+           (Decimal('12345678901.12345679'), 'bnb1')
+    bad_keys = [base64.urlsafe_b64encode(json.dumps([key, 'a']).encode()).decode() for key in ('NaN', 'Infinity', 'x')]
+    for bad in ['', 'garbage!', encode_cursor({'volume_key': 1.0, 'user_address': 5}), 'WzEsMiwzXQ=='] + bad_keys:
+        with pytest.raises(ValueError):
+            decode_cursor(bad)
+
+
+def test_bundle_keyset_pages():
+    volumes = [5.0, 3.0, 5.0, None, 1.0, 3.0, 5.0, None, 0.0, 2.0]  # ties are ordered by the address
+
+    async def users(offset, limit, after=None):
+        rows = await query_bundle('net', 0, 100, offset, limit, 'rune', after=after)
+        return [r for r in rows if r['user_address'] is not None]
+
+    async def main():
+        await insert_swaps('net', [('swap', 10, f'u{i}', v) for i, v in enumerate(volumes)])
+
+        everyone = [r['user_address'] for r in await users(0, None)]
+        assert everyone == ['u0', 'u2', 'u6', 'u1', 'u5', 'u9', 'u4', 'u3', 'u7', 'u8']
+
+        pages, after = [], None
+        while True:
+            page = await users(0, 3, after=after)
+            if not page:
+                break
+            pages.append([r['user_address'] for r in page])
+            after = decode_cursor(encode_cursor(page[-1]))
+        assert pages == [everyone[i:i + 3] for i in range(0, 10, 3)]
+        assert pages[1] == [r['user_address'] for r in await users(3, 3)]
+
+    run_with_db(main)
+
+
+def test_bundle_keys_are_rounded():
+    async def main():
+        # 0.1 + 0.2 != 0.3 as floats, yet both users have the same volume
+        await insert_swaps('net', [('swap', 10, 'z', 0.1), ('swap', 10, 'z', 0.2), ('swap', 10, 'a', 0.3)])
+
+        rows = await query_bundle('net', 0, 100, 0, None, 'rune')
+        assert [r['user_address'] for r in rows] == ['a', 'z']
+        assert ranking_key(rows[0]) == ranking_key(rows[1]) == Decimal('0.3')
+
+        # the cursor of "a" seeks past it, wherever in its last bits the volume has come from
+        page = await query_bundle('net', 0, 100, 0, 10, 'rune', after=decode_cursor(encode_cursor(rows[0])))
+        assert [r['user_address'] for r in page] == ['z']
+
+    run_with_db(main)
+
+
+def test_cached_and_db_cursor_pages_agree():
+    addresses = ['bob', 'Bob', 'alice', 'Zed', 'zed', '_x', 'ábc', 'B']
+    volumes = [2.0, 2.0, 2.0, 1.0, 1.0, 2.0, 1.0, None]
+
+    async def main():
+        await insert_swaps('net', [('swap', 10, u, v) for u, v in zip(addresses, volumes)])
+        rows = [r for r in await query_bundle('net', 0, 100, 0, None, 'rune') if r['user_address'] is not None]
+        # addresses are compared as str in Python, whatever the collation of the DB
+        assert rows == sorted(rows, key=lambda r: (-ranking_key(r), r['user_address']))
+
+        window = RankedWindow(0, 100, 'rune', rows, 0.0, len(rows), (), 0.0)
+        for volume, user_address in [(2, 'C'), (2, 'a'), (1, 'Zz'), (1, 'b'), (0, 'A'), (3, 'x')]:
+            after = (Decimal(volume), user_address)
+            db_page = await query_bundle('net', 0, 100, 0, 3, 'rune', after=after)
+            assert [r['user_address'] for r in window.page_after(after, 3)] == \
+                   [r['user_address'] for r in db_page if r['user_address'] is not None]
+
+    run_with_db(main)
+
+
+def test_large_near_tie_keys():
+    # keys with more digits than a float8 has: the cursor must carry the key of the DB, not a float of it
+    volumes = {'a': 12345678.123456789, 'b': 12345678.123456791, 'c': 12345678.12345679, 'd': 98765432109.87654,
+               'e': 98765432109.87654, 'f': 12345678.12345678}
+
+    async def main():
+        await insert_swaps('net', [('swap', 10, u, v) for u, v in volumes.items()])
+        everyone = [r for r in await query_bundle('net', 0, 100, 0, None, 'rune') if r['user_address'] is not None]
+        assert everyone == sorted(everyone, key=lambda r: (-ranking_key(r), r['user_address']))
+        assert [r['user_address'] for r in everyone][:2] == ['d', 'e']
+
+        window = RankedWindow(0, 100, 'rune', everyone, 0.0, len(everyone), (), 0.0)
+        for limit in (1, 2, 4):
+            db_pages, cached_pages, after = [], [], None
+            while True:
+                page = [r for r in await query_bundle('net', 0, 100, 0, limit, 'rune', after=after)
+                        if r['user_address'] is not None]
+                if not page:
+                    break
+                db_pages.append([r['user_address'] for r in page])
+                if after is not None:
+                    cached_pages.append([r['user_address'] for r in window.page_after(after, limit)])
+                after = decode_cursor(encode_cursor(page[-1]))
+            names = [r['user_address'] for r in everyone]
+            assert db_pages == [names[i:i + limit] for i in range(0, len(names), limit)]
+            assert cached_pages == db_pages[1:]
+
+    run_with_db(main)
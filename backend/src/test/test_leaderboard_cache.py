@@ -0,0 +1,93 @@
+import asyncio
+from decimal import Decimal
+
+from leaderboard_cache import RankingCache
+
+MAX_TS = 2_147_483_647
+
+
+class FakeDB:
+    def __init__(self, n_users=10):
+        self.n_users = n_users
+        self.version = (1, 0, 0)
+        self.loads = []
+
+    async def load(self, network_id, since, to, currency):
+        self.loads.append((since, to, currency))
+        volumes = [float(self.n_users - i) for i in range(self.n_users)]
+        rows = [{'user_address': f'u{i}', 'total_volume': v, 'volume_key': v} for i, v in enumerate(volumes)]
+        return rows, sum(r['total_volume'] for r in rows), self.n_users
+
+    async def get_version(self, network_id):
+        return self.version
+
+
+def make_cache(db, **kwargs):
+    return RankingCache(db.load, version_loader=db.get_version, version_period=0.0, max_ts=MAX_TS, **kwargs)
+
+
+def test_pages_are_slices_of_one_ranking():
+    db = FakeDB()
+    cache = make_cache(db)
+
+    async def main():
+        pages = [(await cache.get('net', 0, MAX_TS, 'rune')).page(offset, 3) for offset in range(0, 12, 3)]
+        assert [r['user_address'] for page in pages for r in page] == [f'u{i}' for i in range(10)]
+        assert len(pages[-1]) == 1
+        assert (await cache.get('net', 0, MAX_TS, 'rune')).page(12, 3) == []
+        await cache.get('net', 0, MAX_TS, 'usd')
+
+    asyncio.run(main())
+    assert len(db.loads) == 2
+    assert cache.stats['hits'] == 4
+
+
+def test_quantization():
+    db = FakeDB()
+    cache = make_cache(db, granularity=600)
+    assert cache.quantize(1000, 2000) == (600, 2399)
+    assert cache.quantize(1200, MAX_TS) == (1200, MAX_TS)
+    assert cache.quantize(0, MAX_TS - 5) == (0, MAX_TS)
+
+    async def main():
+        for since in range(1000, 1100, 10):
+            window = await cache.get('net', since, MAX_TS, 'rune')
+            assert window.since == 600
+
+    asyncio.run(main())
+    assert db.loads == [(600, MAX_TS, 'rune')]
+
+
+def test_invalidation_ttl_and_memory_bound():
+    db = FakeDB(n_users=10)
+    cache = make_cache(db, max_rows=25)
+
+    async def main():
+        await cache.get('net', 0, 100, 'rune')
+        db.version = (2, 1, 0)  # a tx has been filled
+        await cache.get('net', 0, 100, 'rune')
+        assert cache.stats['invalidated'] == 1
+
+        await cache.get('net', 0, 200, 'rune')
+        await cache.get('net', 0, 300, 'rune')  # 30 rows: the first ranking is evicted
+        assert len(cache) == 2 and cache.stats['rows'] == 20 and cache.stats['evictions'] == 1
+
+        cache.ttl = 0.0
+        await cache.get('net', 0, 300, 'rune')
+        assert cache.stats['expired'] == 1
+
+    asyncio.run(main())
+    assert len(db.loads) == 5
+
+
+def test_page_after():
+    db = FakeDB()
+    cache = make_cache(db)
+    window = asyncio.run(cache.get('net', 0, MAX_TS, 'rune'))  # u0: 10.0, u1: 9.0, ...
+    assert [r['user_address'] for r in window.page_after((Decimal('8'), 'u2'), 3)] == ['u3', 'u4', 'u5']
+    assert [r['user_address'] for r in window.page_after((Decimal('1'), 'u9'), 3)] == []
+    # the cursor from an older ranking: the rows after its key
+    assert [r['user_address'] for r in window.page_after((Decimal('8.5'), 'u7'), 2)] == ['u2', 'u3']
+    assert [r['user_address'] for r in window.page_after((Decimal('8'), 'u0'), 2)] == ['u2', 'u3']
+    # the key from the DB is compared as it is, not as the float it's closest to
+    assert [r['user_address'] for r in window.page_after((Decimal('8.000000000000001'), 'u2'), 1)] == ['u2']
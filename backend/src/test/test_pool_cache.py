@@ -0,0 +1,56 @@
+from jobs.pool_cache import PoolSnapshotCache, PoolSnapshot
+from models.poolcache import ThorPoolModel
+
+
+def make_pool(asset, balance_asset, balance_rune):
+    return ThorPoolModel(block_height=1, network='test', pool=asset, status='Available',
+                         balance_asset=balance_asset, balance_rune=balance_rune, pool_units=1)
+
+
+def test_snapshot_from_pools():
+    pools = [
+        make_pool('BNB.BUSD-BD1', 3000, 1000),
+        make_pool('BNB.USDT-6D8', 1000, 1000),
+        make_pool('BNB.BNB', 10, 2000),
+        make_pool('BTC.BTC', 0, 0),
+    ]
+    snapshot = PoolSnapshot.from_pools(10, pools)
+    assert snapshot.block_height == 10
+    assert snapshot.usd_per_rune == 2.0
+    assert snapshot.runes_per_asset['BNB.BNB'] == 200.0
+    assert 'BTC.BTC' not in snapshot.runes_per_asset
+
+
+def test_lru_eviction_and_counters():
+    cache = PoolSnapshotCache(max_size=2)
+    for height in (1, 2):
+        cache.put('test', PoolSnapshot(height, {}, 1.0))
+
+    assert cache.get('test', 1).block_height == 1  # now 2 is the least recently used
+    cache.put('test', PoolSnapshot(3, {}, 1.0))
+
+    assert ('test', 2) not in cache
+    assert cache.get('test', 2) is None
+    assert cache.get('other', 1) is None
+    assert len(cache) == 2
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 2
+    assert cache.stats['evictions'] == 1
+
+
+def test_nearest():
+    cache = PoolSnapshotCache(max_size=3)
+    for height in (10, 20, 30):
+        cache.put('test', PoolSnapshot(height, {}, 1.0))
+
+    assert cache.nearest('test', 20, 0).block_height == 20
+    assert cache.nearest('test', 23, 5).block_height == 20
+    assert cache.nearest('test', 26, 5).block_height == 30
+    assert cache.nearest('test', 25, 5).block_height == 20  # the lower one of two equally close
+    assert cache.nearest('test', 36, 5) is None
+    assert cache.nearest('other', 20, 5) is None
+    assert cache.stats['near_hits'] == 4
+
+    cache.put('test', PoolSnapshot(40, {}, 1.0))  # 10 is evicted
+    assert cache.nearest('test', 12, 5) is None
+    assert cache.nearest('test', 39, 5).block_height == 40
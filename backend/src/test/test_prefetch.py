@@ -0,0 +1,35 @@
+from jobs.pool_cache import PoolSnapshotCache
+from jobs.prefetch import PoolPrefetcher
+from jobs.value_filler import ValueFiller
+from models.poolcache import ThorPoolModel
+from sqlite_db import run_with_db, NET
+from test_value_filler import FakeThor, fill_db
+
+
+def test_prefetch_once():
+    async def main():
+        await fill_db(range(100, 106))
+        thor = FakeThor()
+        await ThorPoolModel.save_snapshot([ThorPoolModel.from_thor_pool(pool, NET, 101)
+                                           for pool in await thor.query_pools(101)])
+        thor.requested = []
+
+        filler = ValueFiller(thor, NET, pool_cache=PoolSnapshotCache(max_size=3))
+        prefetcher = filler.prefetcher = PoolPrefetcher(filler, lookahead=4, max_requests=2)
+        await prefetcher.prefetch_once()
+        assert thor.requested == [100, 102]  # 101 is in the DB, 103 waits for the next round
+        stats = prefetcher.stats
+        assert (stats['fetched'], stats['loaded'], stats['pending']) == (2, 1, 3)
+
+        await filler.load_pool_snapshot(100, 'job')
+        assert prefetcher.stats['hits'] == 1 and thor.requested == [100, 102]
+
+        for height in (200, 201, 202):  # evict the rest before the jobs come for them
+            filler.cache_pool_snapshot(height, [])
+        await prefetcher.prefetch_once()
+        stats = prefetcher.stats
+        assert (stats['hits'], stats['wasted'], stats['hit_rate']) == (1, 2, 1 / 3)
+        # the pools fetched before are in the DB now
+        assert thor.requested == [100, 102, 103] and stats['loaded'] == 4
+
+    run_with_db(main)
@@ -0,0 +1,21 @@
+from models.rune_price import RunePriceIndex
+
+
+def test_rune_price_index():
+    index = RunePriceIndex()
+    assert index.at_height(100) is None
+    assert index.at_time(1000) is None
+
+    for height, timestamp, price in ((300, 3000, 3.0), (100, 1000, 1.0), (200, 2000, 2.0)):
+        index.add(height, timestamp, price)
+    index.add(200, 2000, 2.5)  # replaces
+
+    assert len(index) == 3
+    assert list(index.heights) == [100, 200, 300]
+    assert index.at_height(200) == 2.5
+    assert index.at_height(250) == 2.5
+    assert index.at_height(250, exact=True) is None
+    assert index.at_height(99) is None
+    assert index.at_height(1000) == 3.0
+    assert index.at_time(1999) == 1.0
+    assert index.at_time(2000) == 2.5
@@ -0,0 +1,84 @@
+import asyncio
+import random
+
+from jobs.tx.parser import TxParseResult
+from jobs.tx.scanner import TxScanner, ITxDelegate
+
+TOTAL = 230
+
+
+class FakeMidgardScanner(TxScanner):
+    def __init__(self, delegate, fail_once_at=(), fail_always_at=(), **kwargs):
+        super().__init__(None, None, None, delegate=delegate, sleep_before_retry=0.0, **kwargs)
+        self.requested = []
+        self._fail_once_at = set(fail_once_at)
+        self._fail_always_at = set(fail_always_at)
+
+    async def request_transaction_list(self, offset=0, limit=50):
+        self.requested.append(offset)
+        await asyncio.sleep(random.uniform(0.0, 0.01))
+        if offset in self._fail_always_at:
+            raise ConnectionError('midgard is down')
+        if offset in self._fail_once_at:
+            self._fail_once_at.remove(offset)
+            raise ConnectionError('midgard is down')
+        items = list(range(offset, min(TOTAL, offset + limit)))
+        return TxParseResult(TOTAL, items, len(items), 'test')
+
+
+class RecordingDelegate(ITxDelegate):
+    def __init__(self, stop_after=None, rewind_at=None):
+        self.offsets = []
+        self.stop_after = stop_after
+        self.rewind_at = rewind_at
+
+    async def on_scan_start(self, scanner):
+        self.offsets = []
+
+    async def on_transactions(self, tx_results, scanner) -> bool:
+        self.offsets.append(tx_results.txs[0])
+        if self.rewind_at is not None and tx_results.txs[0] == self.rewind_at:
+            self.rewind_at = None
+            scanner.rewind(0)
+        return self.stop_after is None or len(self.offsets) < self.stop_after
+
+
+def run_scan(scanner, batch_size=20):
+    asyncio.run(scanner.run_scan(start=0, batch_size=batch_size))
+
+
+def test_pages_are_delivered_in_order():
+    delegate = RecordingDelegate()
+    scanner = FakeMidgardScanner(delegate, concurrent_pages=5)
+    run_scan(scanner)
+    assert delegate.offsets == list(range(0, TOTAL, 20))
+    assert not scanner.working
+
+
+def test_page_retry_does_not_break_order():
+    delegate = RecordingDelegate()
+    scanner = FakeMidgardScanner(delegate, fail_once_at=(40, 100), concurrent_pages=4, retries=2)
+    run_scan(scanner)
+    assert delegate.offsets == list(range(0, TOTAL, 20))
+    assert scanner.requested.count(40) == 2
+
+
+def test_broken_page_stops_scan_after_retries():
+    delegate = RecordingDelegate()
+    scanner = FakeMidgardScanner(delegate, fail_always_at=(40,), concurrent_pages=4, retries=2)
+    run_scan(scanner)
+    assert delegate.offsets == [0, 20]
+    assert scanner.requested.count(40) == 3  # the first try and two retries, no more
+
+
+def test_stop_and_rewind():
+    delegate = RecordingDelegate(stop_after=3)
+    scanner = FakeMidgardScanner(delegate, concurrent_pages=8)
+    run_scan(scanner)
+    assert delegate.offsets == [0, 20, 40]
+
+    # rewind(0) is followed by the regular step forward, so the scan restarts from the second page
+    delegate = RecordingDelegate(rewind_at=60)
+    scanner = FakeMidgardScanner(delegate, concurrent_pages=3)
+    run_scan(scanner)
+    assert delegate.offsets == [0, 20, 40, 60] + list(range(20, TOTAL, 20))
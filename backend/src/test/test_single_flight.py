@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from helpers.utils import SingleFlight
+
+
+def test_concurrent_calls_share_one_run():
+    calls = []
+
+    async def fetch(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x * 2
+
+    async def main():
+        sf = SingleFlight()
+        results = await asyncio.gather(*(sf.run(('net', 1), fetch, 1) for _ in range(5)),
+                                       sf.run(('net', 2), fetch, 2))
+        assert results == [2] * 5 + [4]
+        assert sf.stats == {'in_flight': 0, 'calls': 6, 'shared': 4}
+
+        # the next call after completion is a new one
+        assert await sf.run(('net', 1), fetch, 1) == 2
+
+    asyncio.run(main())
+    assert calls == [1, 2, 1]
+
+
+def test_error_is_shared():
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ConnectionError('thornode is down')
+
+    async def main():
+        sf = SingleFlight()
+        results = await asyncio.gather(sf.run('k', fail), sf.run('k', fail), return_exceptions=True)
+        assert all(isinstance(r, ConnectionError) for r in results)
+        with pytest.raises(ConnectionError):
+            await sf.run('k', fail)
+
+    asyncio.run(main())
+    assert len(calls) == 2
@@ -0,0 +1,109 @@
+from types import SimpleNamespace
+
+import jobs.tx.ingest
+from jobs.tx.parser import TxParseResult
+from jobs.tx.scanner import TxScanner
+from jobs.tx.storage import TxStorage, TxBackfillStorage
+from models.scan import ScanWatermark, ScanCheckpoint
+from models.tx import ThorTx
+from sqlite_db import run_with_db, make_tx, NET
+
+
+class FakeMidgard(TxScanner):
+    def __init__(self, delegate, heights, **kwargs):
+        super().__init__(None, None, SimpleNamespace(network_id=NET), delegate=delegate,
+                         sleep_before_retry=0.0, **kwargs)
+        self.heights = list(heights)  # the newest first, two txs in each block
+        self.requested = []
+
+    async def request_transaction_list(self, offset=0, limit=50):
+        self.requested.append(offset)
+        keys = [(h, i) for h in self.heights for i in range(2)][offset:offset + limit]
+        return TxParseResult(len(self.heights) * 2, [make_tx(h, i) for h, i in keys], len(keys), NET)
+
+
+async def scan(storage, heights, batch_size=4):
+    scanner = FakeMidgard(storage, heights)
+    await scanner.run_scan(start=0, batch_size=batch_size)
+    return scanner
+
+
+def fail_writes_of(monkeypatch, bad_hash):
+    write_pages = jobs.tx.ingest.write_pages
+
+    async def failing_write_pages(pages):
+        if any(tx.hash == bad_hash for page in pages for tx in page.txs):
+            raise ConnectionError('db is down')
+        return await write_pages(pages)
+
+    monkeypatch.setattr(jobs.tx.ingest, 'write_pages', failing_write_pages)
+
+
+def test_head_scan_stops_at_watermark():
+    async def main():
+        storage = TxStorage(overscan_pages=1)
+        scanner = await scan(storage, range(110, 100, -1))
+        assert scanner.reached_end
+        assert await ThorTx.all().count() == 20
+        mark = await ScanWatermark.load(NET)
+        assert (mark.block_height, mark.hash) == (110, 'h110-0')
+
+        # two new blocks on top: the scan stops at the page with the marked block
+        scanner = await scan(storage, range(112, 100, -1))
+        assert not scanner.reached_end
+        assert scanner.requested == [0, 4]
+        assert await ThorTx.all().count() == 24
+        assert (await ScanWatermark.load(NET)).block_height == 112
+
+    run_with_db(main)
+
+
+def test_watermark_is_kept_if_a_page_is_lost(monkeypatch):
+    async def main():
+        storage = TxStorage(overscan_pages=1)
+        await scan(storage, range(110, 100, -1))
+
+        with monkeypatch.context() as m:
+            fail_writes_of(m, 'h111-0')
+            await scan(storage, range(112, 100, -1))
+        assert storage.ingest.stats['errors'] > 0
+        assert await ThorTx.filter(hash='h111-0').count() == 0
+        assert (await ScanWatermark.load(NET)).block_height == 110  # the next scan must walk down again
+
+        await scan(storage, range(112, 100, -1))
+        assert await ThorTx.filter(hash='h111-0').count() == 1
+        assert (await ScanWatermark.load(NET)).block_height == 112
+
+    run_with_db(main)
+
+
+def test_checkpoint_resume_offset():
+    checkpoint = ScanCheckpoint(network=NET, offset=40, last_height=5, total_count=100)
+    assert checkpoint.resume_offset(100, 10) == 30
+    assert checkpoint.resume_offset(125, 10) == 55  # new txs on top shifted the old ones
+    assert ScanCheckpoint(network=NET, offset=4).resume_offset(0, 10) == 0
+
+
+def test_backfill_resumes_from_checkpoint(monkeypatch):
+    heights = range(110, 100, -1)
+
+    async def main():
+        backfill = TxBackfillStorage()
+        with monkeypatch.context() as m:
+            fail_writes_of(m, 'h106-0')  # the 3rd page
+            await scan(backfill, heights)
+        checkpoint = await ScanCheckpoint.load(NET)
+        # the pages written after the lost one (if any) don't move it
+        assert checkpoint.offset <= 8 and checkpoint.last_height >= 107 and not checkpoint.finished
+
+        # restart
+        backfill = TxBackfillStorage()
+        start = checkpoint.resume_offset(20, 4)
+        scanner = FakeMidgard(backfill, heights)
+        await scanner.run_scan(start=start, batch_size=4)
+        assert scanner.requested[0] == start and scanner.reached_end
+        assert await ThorTx.all().count() == 20
+        checkpoint = await ScanCheckpoint.load(NET)
+        assert checkpoint.finished and checkpoint.last_height == 101
+
+    run_with_db(main)
@@ -0,0 +1,100 @@
+import asyncio
+from random import Random
+
+import pytest
+from aiothornode.types import ThorPool
+
+from helpers.coins import BUSD_SYMBOL
+from jobs.thor_verify import check_pools, PoolVerifier
+
+
+def pools(usd_per_rune=2.0, btc_depth=100):
+    return [
+        ThorPool(asset=BUSD_SYMBOL, balance_asset=str(int(usd_per_rune * 1000)), balance_rune='1000',
+                 status=ThorPool.STATUS_AVAILABLE),
+        ThorPool(asset='BTC.BTC', balance_asset='1', balance_rune=str(btc_depth), status=ThorPool.STATUS_AVAILABLE),
+    ]
+
+
+class FakeClient:
+    def __init__(self, node_ip, answer, latency=0.0):
+        self.node_ip = node_ip
+        self.answer = answer
+        self.latency = latency
+
+    def __repr__(self):
+        return self.node_ip
+
+
+class FakeConnector:
+    def __init__(self, clients):
+        self.clients = clients
+        self.requests = []
+
+    async def get_random_clients(self, n=0):
+        return self.clients
+
+    def client_list_except_banned(self):
+        return self.clients
+
+    async def query_pools(self, height=None, *, clients=None, consensus=True):
+        client = clients[0]
+        self.requests.append(client.node_ip)
+        await asyncio.sleep(client.latency)
+        return client.answer
+
+
+def test_check_pools():
+    assert check_pools(pools()) == []
+    assert check_pools(pools(), reference_usd_per_rune=2.2) == []
+    assert check_pools([]) == ['no pools']
+    assert check_pools(pools(btc_depth=0)) == ['zero depth of BTC.BTC']
+    assert check_pools(pools()[1:], reference_usd_per_rune=2.0) == ['no stable coin pools']
+    assert check_pools(pools()[1:]) == []  # no stable coins around either
+    assert check_pools(pools(usd_per_rune=3.0), reference_usd_per_rune=2.0) == \
+           ['price 3.0000 is 50% away from 2.0000']
+
+
+def test_single_node_when_answer_looks_fine():
+    connector = FakeConnector([FakeClient('a', pools()), FakeClient('b', pools()), FakeClient('c', pools())])
+    verifier = PoolVerifier(connector, sample_rate=0.0)
+    for height in range(10):
+        assert asyncio.run(verifier.query_pools(height, reference_usd_per_rune=2.0)) == pools()
+    assert len(connector.requests) == 10
+    assert verifier.stats['single'] == 10
+
+
+def test_escalation_and_disagreement():
+    liar = FakeClient('liar', pools(usd_per_rune=20.0))
+    connector = FakeConnector([liar, FakeClient('b', pools()), FakeClient('c', pools())])
+    verifier = PoolVerifier(connector, sample_rate=0.0)
+    assert asyncio.run(verifier.query_pools(1, reference_usd_per_rune=2.0)) == pools()
+    assert verifier.stats['escalated_sanity'] == 1
+    assert verifier.nodes['liar'].disagreements == 1
+    assert verifier.nodes['b'].agreements == 1
+
+    # the liar is not trusted any more
+    for height in range(2, 10):
+        asyncio.run(verifier.query_pools(height, reference_usd_per_rune=2.0))
+    assert verifier.rank_clients(connector.clients)[-1] is liar
+
+
+def test_no_consensus():
+    connector = FakeConnector([FakeClient('a', pools(btc_depth=0)), FakeClient('b', pools(btc_depth=1)),
+                               FakeClient('c', None)])
+    verifier = PoolVerifier(connector, sample_rate=0.0)
+    with pytest.raises(ConnectionError):
+        asyncio.run(verifier.query_pools(1))
+    assert verifier.stats['no_consensus'] == 1
+
+
+def test_random_sample_and_fastest_node():
+    connector = FakeConnector([FakeClient('slow', pools(), 0.02), FakeClient('fast', pools(), 0.0),
+                               FakeClient('c', pools(), 0.01)])
+    verifier = PoolVerifier(connector, sample_rate=0.5, min_requests=1, rng=Random(1))
+    for height in range(20):
+        asyncio.run(verifier.query_pools(height))
+    stats = verifier.stats
+    assert stats['single'] + stats['escalated_sample'] == 20
+    assert 0 < stats['escalated_sample'] < 20
+    assert verifier.rank_clients(connector.clients)[0].node_ip == 'fast'
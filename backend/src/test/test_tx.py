@@ -0,0 +1,69 @@
+import pytest
+
+from models.tx import ThorTx
+from sqlite_db import run_with_db, make_tx
+
+
+@pytest.mark.parametrize('bulk', [True, False])
+def test_insert_unique(monkeypatch, bulk):
+    if not bulk:
+        monkeypatch.setattr(ThorTx, 'BULK_INSERT_DIALECTS', ())  # one by one
+
+    async def main():
+        page = [make_tx(hash='a'), make_tx(hash='b'), make_tx(hash="it's")]
+        assert await ThorTx.insert_unique(page) == {'a', 'b', "it's"}
+
+        page = [make_tx(hash='b'), make_tx(hash="it's"), make_tx(hash='c')]
+        assert await ThorTx.insert_unique(page) == {'c'}
+        assert await ThorTx.save_many_unique([make_tx(hash='a'), make_tx(hash='d')]) == 1
+        assert await ThorTx.insert_unique([]) == set()
+
+        assert sorted(await ThorTx.all().values_list('hash', flat=True)) == ['a', 'b', 'c', 'd', "it's"]
+        tx = await ThorTx.get(hash="it's")
+        assert (tx.usd_price1, tx.rune_volume, tx.process_flags) == (0.0, None, 0)
+
+    run_with_db(main)
+
+
+def test_fill_volumes_with_broken_prices():
+    tx = make_tx(hash='a')
+    tx.asset1 = 'BTC.BTC'
+    tx.fill_volumes({'BTC.BTC': float('inf')}, 2.0)
+    assert tx.process_flags == -1 and tx.rune_volume is None
+
+    tx.fill_volumes({'BTC.BTC': 10.0}, float('nan'))
+    assert tx.process_flags == -2
+
+    tx.fill_volumes({'BTC.BTC': 10.0}, 2.0)
+    assert tx.process_flags == 1 and (tx.rune_volume, tx.usd_volume) == (10.0, 20.0)
+
+
+@pytest.mark.parametrize('bulk', [True, False])
+def test_save_filled_many(monkeypatch, bulk):
+    if not bulk:
+        monkeypatch.setattr(ThorTx, 'BULK_INSERT_DIALECTS', ())  # no RETURNING
+
+    async def main():
+        await ThorTx.insert_unique([make_tx(height, hash=h) for height, h in zip(range(100, 104), 'abcd')])
+        a, b, c, d = await ThorTx.all().order_by('id')
+        await ThorTx.filter(id=d.id).update(process_flags=1, rune_volume=5.0)  # filled by someone else meanwhile
+
+        a.fill_volumes({}, 2.0)
+        a.priced_height = 99
+        b.increase_fail_count()
+        b.lease_until = 12345
+        c.fill_volumes({}, 3.0)
+        c.usd_price2 = float('nan')  # not a valid literal, it must not break the others
+        d.fill_volumes({}, 4.0)
+        assert await ThorTx.save_filled_many([a, b, c, d]) == {a.id, b.id, c.id}
+
+        rows = await ThorTx.all().order_by('id').values_list('usd_price1', 'usd_price2', 'rune_volume', 'usd_volume',
+                                                             'process_flags', 'priced_height', 'lease_until')
+        assert rows == [
+            (2.0, 2.0, 1.0, 2.0, 1, 99, None),
+            (0.0, 0.0, None, None, -1, None, 12345),
+            (3.0, 0.0, 1.0, 3.0, 1, None, None),
+            (0.0, 0.0, 5.0, None, 1, None, None),
+        ]
+
+    run_with_db(main)
@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from helpers.coins import RUNE_SYMBOL_NATIVE
+from jobs.pool_cache import PoolSnapshot
+from models.tx import ThorTx, ThorTxType
+
+pytest.importorskip('numpy')
+from tools.valuation import fill_volumes_vectorized  # noqa: E402
+
+TYPES = [ThorTxType.TYPE_SWAP, ThorTxType.TYPE_REFUND, ThorTxType.TYPE_SWITCH, ThorTxType.TYPE_ADD_LIQUIDITY,
+         ThorTxType.TYPE_WITHDRAW, ThorTxType.TYPE_DONATE]
+
+ASSETS = [None, '', RUNE_SYMBOL_NATIVE, 'BTC.BTC', 'ETH.ETH', 'BNB.BNB', 'DOGE.DOGE']
+
+
+def make_snapshots(heights):
+    snapshots = []
+    for height in heights:
+        runes_per_asset = {'BTC.BTC': random.uniform(1e3, 1e5), 'ETH.ETH': random.uniform(10, 1e3)}
+        if height % 3:
+            runes_per_asset['BNB.BNB'] = random.uniform(1, 100)
+        usd_per_rune = None if height % 7 == 0 else random.uniform(0.1, 20.0)
+        snapshots.append(PoolSnapshot(height, runes_per_asset, usd_per_rune))
+    return snapshots
+
+
+def make_txs(n, heights):
+    return [ThorTx(id=i, hash=f'h{i}', block_height=random.choice(heights), type=random.choice(TYPES),
+                   date=0, user_address='u', process_flags=-random.randint(0, 2),
+                   asset1=random.choice(ASSETS), amount1=random.uniform(0, 1e4),
+                   asset2=random.choice(ASSETS), amount2=random.uniform(0, 1e4))
+            for i in range(n)]
+
+
+def copy_tx(tx: ThorTx):
+    return ThorTx(**{name: getattr(tx, name) for name in ('id', 'hash', 'block_height', 'type', 'date', 'user_address',
+                                                          'process_flags', 'asset1', 'amount1', 'asset2', 'amount2')})
+
+
+def tx_state(tx: ThorTx):
+    return tx.usd_price1, tx.usd_price2, tx.rune_volume, tx.usd_volume, tx.process_flags, tx.priced_height
+
+
+def test_vectorized_matches_scalar():
+    random.seed(42)
+    heights = list(range(100, 140))
+    snapshots = make_snapshots(heights[:-5])  # the last blocks have no pools at all
+    by_height = {s.block_height: s for s in snapshots}
+
+    scalar_txs = make_txs(3000, heights)
+    vector_txs = [copy_tx(tx) for tx in scalar_txs]
+
+    for tx in scalar_txs:
+        snapshot = by_height.get(tx.block_height)
+        if snapshot is None:
+            tx.increase_fail_count()
+        else:
+            tx.fill_volumes(snapshot.runes_per_asset, snapshot.usd_per_rune)
+            if tx.process_flags > 0:
+                tx.priced_height = snapshot.block_height
+
+    fill_volumes_vectorized(vector_txs, by_height)
+
+    for scalar_tx, vector_tx in zip(scalar_txs, vector_txs):
+        assert tx_state(scalar_tx) == tx_state(vector_tx), (scalar_tx.asset1, scalar_tx.asset2, scalar_tx.type)
+
+    flags = {tx.process_flags for tx in vector_txs}
+    assert 1 in flags and min(flags) < 0  # both outcomes are covered
+
+
+def test_no_snapshots():
+    txs = make_txs(3, [1])
+    fill_volumes_vectorized(txs, {})
+    assert all(tx.process_flags < 0 and tx.rune_volume is None for tx in txs)
+
+
+def test_priced_from_nearby_block():
+    snapshot = PoolSnapshot(100, {'BTC.BTC': 1000.0}, 2.0)
+    txs = [ThorTx(id=i, hash=str(i), block_height=height, type=ThorTxType.TYPE_SWAP, date=0, user_address='u',
+                  asset1='BTC.BTC', amount1=1.0, asset2=None, amount2=1000.0)
+           for i, height in enumerate((100, 102, 105))]
+
+    fill_volumes_vectorized(txs, {100: snapshot, 102: snapshot})
+
+    assert [tx.priced_height for tx in txs] == [100, 100, None]
+    assert [tx.usd_volume for tx in txs] == [2000.0, 2000.0, None]
+    assert [tx.process_flags for tx in txs] == [1, 1, -1]
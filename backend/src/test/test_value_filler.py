@@ -0,0 +1,173 @@
+import asyncio
+import time
+
+import pytest
+from aiothornode.types import ThorPool
+
+from helpers.coins import BUSD_SYMBOL
+from jobs.tx.ingest import write_pages, IngestPage
+from jobs.value_filler import ValueFiller
+from models.counters import TxCounter, FillerShard
+from models.tx import ThorTx
+from models.user_volume import UserVolumeDay
+from sqlite_db import run_with_db, make_tx, NET
+
+
+async def fill_db(heights):
+    await write_pages([IngestPage(NET, [make_tx(h) for h in heights])])
+
+
+class FakeThor:
+    session = None
+
+    def __init__(self):
+        self.requested = []
+
+    async def query_pools(self, height, consensus=True):
+        self.requested.append(height)
+        # Rune costs 2 + height / 1000 USD and 1/10 BTC
+        return [ThorPool(balance_asset=str(2_000_000 + height * 1000), balance_rune='1000000', asset=BUSD_SYMBOL,
+                         status=ThorPool.STATUS_AVAILABLE),
+                ThorPool(balance_asset='100000', balance_rune='1000000', asset='BTC.BTC',
+                         status=ThorPool.STATUS_AVAILABLE)]
+
+
+async def rollup_rows():
+    return sorted(await UserVolumeDay.filter(network=NET).values_list('user_address', 'day', 'rune_volume',
+                                                                       'usd_volume', 'n', 'n_filled'))
+
+
+def test_concurrent_claims_are_disjoint():
+    async def main():
+        await fill_db(range(100, 110))
+        a, b = await asyncio.gather(ThorTx.claim_unfilled(NET, 4, 'a', lease_sec=60),
+                                    ThorTx.claim_unfilled(NET, 4, 'b', lease_sec=60))
+        heights_a, heights_b = {tx.block_height for tx in a}, {tx.block_height for tx in b}
+        assert len(heights_a) == len(heights_b) == 4 and not heights_a & heights_b
+        assert heights_a | heights_b == set(range(100, 108))
+        assert {tx.lease_owner for tx in a} == {'a'}
+
+        rest = await ThorTx.claim_unfilled(NET, 4, 'c', lease_sec=60)
+        assert [tx.block_height for tx in rest] == [108, 109]
+        assert await ThorTx.claim_unfilled(NET, 4, 'c', lease_sec=60) == []
+
+    run_with_db(main)
+
+
+def test_failed_txs_wait_before_retry(monkeypatch):
+    async def main():
+        await fill_db(range(100, 104))
+        filler = ValueFiller(None, NET, max_fails_of_tx=3, lease_sec=300, retry_delay_sec=60)
+
+        txs = await filler.claim_unfilled('job', 10)
+        for tx in txs:
+            if tx.block_height % 2:
+                tx.increase_fail_count()  # no pools for the odd blocks
+            else:
+                tx.fill_volumes({}, 2.0)
+        now = time.time()
+        await filler.save_filled(txs)
+
+        # the failed txs are not taken at once again, so an outage doesn't burn all of their attempts
+        assert await filler.claim_unfilled('job', 10) == []
+        leases = dict(await ThorTx.all().values_list('block_height', 'lease_until'))
+        assert leases[100] is None and leases[102] is None
+        assert now + 59 <= leases[101] <= now + 61
+
+        monkeypatch.setattr(time, 'time', lambda: now + 61)
+        txs = await filler.claim_unfilled('job', 10)
+        assert [tx.block_height for tx in txs] == [101, 103]
+        for tx in txs:
+            tx.increase_fail_count()
+        await filler.save_filled(txs)
+        assert (await ThorTx.get(block_height=101)).lease_until >= now + 120  # twice as long after two fails
+
+        counter = await TxCounter.get_for_network(NET)
+        assert (counter.filled, counter.failed) == (2, 0)
+
+    run_with_db(main)
+
+
+def test_txs_out_of_attempts_are_not_claimed(monkeypatch):
+    async def main():
+        await fill_db(range(100, 104))
+        filler = ValueFiller(None, NET, max_fails_of_tx=2, lease_sec=300, retry_delay_sec=60)
+        now = time.time()
+        for attempt in range(2):
+            monkeypatch.setattr(time, 'time', lambda: now + 1000 * attempt)
+            txs = await filler.claim_unfilled('job', 2)  # the expired leases go first
+            assert [tx.block_height for tx in txs] == [100, 101]
+            for tx in txs:
+                tx.increase_fail_count()
+            await filler.save_filled(txs)
+
+        # 100 and 101 are given up on: they have no lease, so the claims don't see them anymore
+        assert await ThorTx.filter(block_height__in=[100, 101]).values_list('lease_until', flat=True) == [None, None]
+        monkeypatch.setattr(time, 'time', lambda: now + 5000)
+        assert await ThorTx.next_unclaimed_heights(NET, 10, max_fails=2) == [102, 103]
+        assert [tx.block_height for tx in await filler.claim_unfilled('job', 10)] == [102, 103]
+        assert (await TxCounter.get_for_network(NET)).failed == 2
+
+        # one more attempt is allowed now
+        assert await ThorTx.settle_leases(NET, max_fails=3) == 2
+        assert await ThorTx.next_unclaimed_heights(NET, 10, max_fails=3) == [100, 101]
+        assert await ThorTx.settle_leases(NET, max_fails=3) == 0
+        assert await ThorTx.settle_leases(NET, max_fails=2) == 2
+        assert await ThorTx.next_unclaimed_heights(NET, 10, max_fails=2) == []
+
+    run_with_db(main)
+
+
+def test_refine_prices_of_nearby_blocks():
+    async def main():
+        await fill_db([100, 103])
+        thor = FakeThor()
+        filler = ValueFiller(thor, NET, price_height_tolerance=5, batch_size=10)
+
+        await filler.fill_batch(await filler.claim_unfilled('job', 10), 'job')
+        assert thor.requested == [100]  # block 103 is priced with the pools of 100
+        assert await ThorTx.all().order_by('id').values_list('priced_height', 'usd_volume') == [(100, 2.1), (100, 2.1)]
+
+        assert await filler.refine_prices(1) == 1
+        assert (await TxCounter.get_for_network(NET)).filled == 1
+
+        # the tolerance is still on, yet the tx gets the pools of its own block
+        await filler.fill_batch(await filler.claim_unfilled('job', 10), 'job')
+        assert thor.requested == [100, 103]
+        tx = await ThorTx.get(block_height=103)
+        assert (tx.priced_height, tx.process_flags) == (103, 1) and tx.usd_volume == pytest.approx(2.103)
+        assert (await TxCounter.get_for_network(NET)).filled == 2
+
+        rollup = await rollup_rows()
+        await UserVolumeDay.rebuild(NET)
+        assert rollup == await rollup_rows()
+
+    run_with_db(main)
+
+
+def test_shards_claim_their_own_blocks():
+    async def main():
+        await fill_db(range(100, 112))
+        shards = [ValueFiller(None, NET, shard=shard, shards=3) for shard in range(3)]
+        claims = await asyncio.gather(*(filler.claim_unfilled('job', 10) for filler in shards))
+        for shard, txs in enumerate(claims):
+            assert [tx.block_height for tx in txs] == [h for h in range(100, 112) if h % 3 == shard]
+        assert await ThorTx.claim_unfilled(NET, 10, 'all', lease_sec=60) == []
+
+    run_with_db(main)
+
+
+def test_stale_shard_heartbeats_are_removed(monkeypatch):
+    async def main():
+        filler = ValueFiller(None, NET, shard=0, shards=2, adjust_period=10.0)
+        await FillerShard.report(NET, 1, shards=2, owner='gone')
+        await FillerShard.report(NET, 2, shards=3, owner='old config')
+        assert [s['shard'] for s in await FillerShard.all_of_network(NET, max_age=30)] == [1, 2]
+
+        now = time.time()
+        monkeypatch.setattr(time, 'time', lambda: now + 40)
+        assert await FillerShard.all_of_network(NET, max_age=30) == []
+        await filler.report_shard()
+        assert [s['shard'] for s in await FillerShard.all_of_network(NET)] == [0]
+
+    run_with_db(main)
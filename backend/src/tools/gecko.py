@@ -36,8 +36,8 @@ async def my_test_get_gecko_price(t_early=1598617260):
         cg.session = None  # make sure it won't try to use HTTP again
         result2 = await cg.get_historical_rune_price(t_early)
         print(f'Rune price cached? is ${result2:0.3f}.')
-        result55 = await cg.get_historical_rune_price(t_early + 10 * MINUTE)
-        assert result55 == result2
+        result55 = await cg.get_historical_rune_price(t_early + 10 * MINUTE)  # interpolated, no request
+        print(f'Rune price 10 min later is ${result55:0.3f}; {cg.stats}')
 
 
 def load_early_tx(network_id) -> List[ThorTx]:
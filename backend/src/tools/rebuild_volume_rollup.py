@@ -0,0 +1,31 @@
+import asyncio
+import logging
+
+from tortoise import Tortoise
+
+from helpers.config import Config
+from helpers.constants import NetworkIdents
+from helpers.db import DB
+from models.user_volume import UserVolumeDay
+
+# Makes the daily volume rollup of users (UserVolumeDay) from all stored txs anew.
+# Run once before turning on thorchain.leaderboard.rollup, and any time the rollup is in doubt.
+# The scanner and the fillers may keep running meanwhile.
+# Run from backend/src: PYTHONPATH=. python tools/rebuild_volume_rollup.py [config.yaml]
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def main():
+    cfg = Config()
+    network_id = cfg.as_str('thorchain.network_id', NetworkIdents.TESTNET_MULTICHAIN)
+    await DB().start()
+    try:
+        n = await UserVolumeDay.rebuild(network_id)
+        logging.info(f'The volume rollup of {network_id!r} has {n} user-days.')
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,33 @@
+import asyncio
+import logging
+import sys
+
+from tortoise import Tortoise
+
+from helpers.config import Config
+from helpers.constants import NetworkIdents
+from helpers.db import DB
+from jobs.value_filler import ValueFiller
+
+# The txs which were priced with pools of a nearby block (value_filler.price_height_tolerance > 0)
+# are filled again by the running fillers, this time with the pools of their own block.
+# Run from backend/src: PYTHONPATH=. python tools/refine_prices.py [config.yaml] [min_distance]
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def main():
+    cfg = Config()
+    network_id = cfg.as_str('thorchain.network_id', NetworkIdents.TESTNET_MULTICHAIN)
+    min_distance = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    await DB().start()
+    try:
+        filler = ValueFiller(None, network_id)
+        n = await filler.refine_prices(min_distance)
+        logging.info(f'{n} txs of {network_id!r} priced {min_distance}+ blocks away will be filled again.')
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,179 @@
+from dataclasses import dataclass
+from typing import List, Dict, Optional
+
+import numpy as np  # not in requirements.txt: only tools/valuation_benchmark.py uses this module
+
+from helpers.coins import is_rune
+from jobs.pool_cache import PoolSnapshot
+from models.tx import ThorTx, ThorTxType
+
+# the volume of these is the input side only (see ThorTx.fill_volumes)
+SINGLE_SIDE_VOLUME_TYPES = (ThorTxType.TYPE_SWAP, ThorTxType.TYPE_REFUND, ThorTxType.TYPE_SWITCH)
+
+RUNE_CODE = -1  # no asset or Rune itself; any other unknown asset points to the empty last column
+
+
+@dataclass
+class PoolPriceMatrix:
+    """
+    Runes per asset of many blocks: a row per block height, a column per asset (NaN if there is no such pool).
+    A row may come from a snapshot of a nearby block (see ValueFiller.price_height_tolerance).
+    """
+    heights: np.ndarray  # sorted
+    priced_heights: np.ndarray  # height of the snapshot of each row
+    asset_index: Dict[str, int]
+    runes_per_asset: np.ndarray  # shape = (len(heights), len(asset_index) + 1), the last column is all NaN
+    usd_per_rune: np.ndarray  # NaN if unknown
+
+    @classmethod
+    def from_snapshots(cls, snapshots: Dict[int, PoolSnapshot]):
+        """
+        :param snapshots: block height of txs => snapshot to price them with
+        """
+        heights = sorted(snapshots)
+        snapshots = [snapshots[h] for h in heights]
+        asset_index = {}
+        for snapshot in snapshots:
+            for asset in snapshot.runes_per_asset:
+                asset_index.setdefault(asset, len(asset_index))
+
+        nan_row = [np.nan] * (len(asset_index) + 1)
+        rows = []
+        for snapshot in snapshots:
+            row = list(nan_row)
+            for asset, runes_per_asset in snapshot.runes_per_asset.items():
+                row[asset_index[asset]] = runes_per_asset
+            rows.append(row)
+        matrix = np.array(rows, dtype=float).reshape((len(snapshots), len(asset_index) + 1))
+
+        priced_heights = np.array([s.block_height for s in snapshots], dtype=np.int64)
+        usd_per_rune = np.array([s.usd_per_rune if s.usd_per_rune else np.nan for s in snapshots], dtype=float)
+        return cls(np.array(heights, dtype=np.int64), priced_heights, asset_index, matrix, usd_per_rune)
+
+    def asset_codes(self, assets: List[Optional[str]]) -> np.ndarray:
+        unknown = len(self.asset_index)
+        codes = {}
+        for asset in set(assets):
+            codes[asset] = RUNE_CODE if asset is None or is_rune(asset) else self.asset_index.get(asset, unknown)
+        return np.array([codes[asset] for asset in assets], dtype=np.int64)
+
+    def rows_of(self, heights: np.ndarray):
+        """
+        :return: row of each height and a mask of the heights which have a row
+        """
+        rows = np.minimum(np.searchsorted(self.heights, heights), len(self.heights) - 1)
+        return rows, self.heights[rows] == heights
+
+
+@dataclass
+class TxColumns:
+    asset1: List[Optional[str]]
+    amount1: np.ndarray
+    asset2: List[Optional[str]]
+    amount2: np.ndarray
+    heights: np.ndarray
+    single_side: np.ndarray  # volume type, see SINGLE_SIDE_VOLUME_TYPES
+
+    @classmethod
+    def from_txs(cls, txs: List[ThorTx]):
+        return cls(
+            asset1=[tx.asset1 for tx in txs],
+            amount1=np.array([tx.amount1 for tx in txs], dtype=float),
+            asset2=[tx.asset2 for tx in txs],
+            amount2=np.array([tx.amount2 for tx in txs], dtype=float),
+            heights=np.array([tx.block_height for tx in txs], dtype=np.int64),
+            single_side=np.array([tx.type in SINGLE_SIDE_VOLUME_TYPES for tx in txs], dtype=bool),
+        )
+
+    def __len__(self):
+        return len(self.heights)
+
+
+@dataclass
+class Valuation:
+    usd_price1: np.ndarray  # NaN = None
+    usd_price2: np.ndarray
+    rune_volume: np.ndarray
+    usd_volume: np.ndarray
+    priced_height: np.ndarray
+    has_rune_price: np.ndarray  # False: nothing is filled, only the fail count goes up
+    ok: np.ndarray  # False: the fail count goes up (the prices are filled if there's Rune price)
+
+    def apply(self, txs: List[ThorTx]):
+        """
+        Writes the results to the txs exactly the way ValueFiller.fill_block_txs does.
+        """
+        columns = zip(txs, self.has_rune_price.tolist(), self.ok.tolist(), self.priced_height.tolist(),
+                      self.usd_price1.tolist(), self.usd_price2.tolist(),
+                      self.rune_volume.tolist(), self.usd_volume.tolist())
+        for tx, has_rune_price, ok, priced_height, usd_price1, usd_price2, rune_volume, usd_volume in columns:
+            if not has_rune_price:
+                tx.increase_fail_count()
+                continue
+
+            tx.usd_price1 = None if usd_price1 != usd_price1 else usd_price1  # NaN != NaN
+            tx.usd_price2 = None if usd_price2 != usd_price2 else usd_price2
+            if not ok:
+                tx.increase_fail_count()
+                continue
+
+            tx.priced_height = priced_height  # only on success, as ValueFiller does
+            tx.rune_volume = rune_volume
+            tx.usd_volume = usd_volume
+            tx.set_processed()
+
+
+def _side(assets, codes, amounts, pool_rows, prices: PoolPriceMatrix, usd_per_rune):
+    """
+    Vector version of ThorTx._usd_price_and_volume
+    :return: usd_price (NaN = None), usd_volume, rune_volume, fail mask
+    """
+    rune = codes == RUNE_CODE
+    runes_per_asset = prices.runes_per_asset[pool_rows, np.where(rune, 0, codes)]
+    no_pool = ~rune & (np.isnan(runes_per_asset) | (runes_per_asset == 0.0))
+
+    usd_price = np.where(rune, usd_per_rune, runes_per_asset * usd_per_rune)
+    usd_price = np.where(no_pool, np.nan, usd_price)
+    usd_volume = np.where(rune, amounts * usd_per_rune, usd_price * amounts)
+    rune_volume = np.where(rune, amounts, usd_volume / usd_per_rune)
+    usd_volume = np.where(no_pool, 0.0, usd_volume)
+    rune_volume = np.where(no_pool, 0.0, rune_volume)
+
+    has_asset = np.array([bool(asset) for asset in assets], dtype=bool)
+    fail = has_asset & (np.isnan(usd_price) | (usd_price == 0.0))
+    return usd_price, usd_volume, rune_volume, fail
+
+
+def valuate(columns: TxColumns, prices: PoolPriceMatrix) -> Valuation:
+    n = len(columns)
+    if n == 0 or len(prices.heights) == 0:
+        nothing, no = np.full(n, np.nan), np.zeros(n, dtype=bool)
+        return Valuation(nothing, nothing, nothing, nothing, np.zeros(n, dtype=np.int64), no, no)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rows, found = prices.rows_of(columns.heights)
+        usd_per_rune = np.where(found, prices.usd_per_rune[rows], np.nan)
+        has_rune_price = np.isfinite(usd_per_rune)
+
+        codes1 = prices.asset_codes(columns.asset1)
+        codes2 = prices.asset_codes(columns.asset2)
+        usd_price1, usd_volume1, rune_volume1, fail1 = _side(columns.asset1, codes1, columns.amount1,
+                                                             rows, prices, usd_per_rune)
+        usd_price2, usd_volume2, rune_volume2, fail2 = _side(columns.asset2, codes2, columns.amount2,
+                                                             rows, prices, usd_per_rune)
+
+        rune_volume = np.where(columns.single_side, rune_volume1, rune_volume1 + rune_volume2)
+        usd_volume = np.where(columns.single_side, usd_volume1, usd_volume1 + usd_volume2)
+
+    ok = has_rune_price & ~fail1 & ~fail2 & np.isfinite(rune_volume) & np.isfinite(usd_volume)
+    return Valuation(usd_price1, usd_price2, rune_volume, usd_volume, prices.priced_heights[rows], has_rune_price, ok)
+
+
+def fill_volumes_vectorized(txs: List[ThorTx], snapshots: Dict[int, PoolSnapshot]):
+    """
+    Same as tx.fill_volumes(...) of each tx with the snapshot for its block (no snapshot = no Rune price).
+    """
+    if not txs:
+        return
+    valuation = valuate(TxColumns.from_txs(txs), PoolPriceMatrix.from_snapshots(snapshots))
+    valuation.apply(txs)
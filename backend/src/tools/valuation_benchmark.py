@@ -0,0 +1,64 @@
+import random
+import sys
+import time
+
+from jobs.pool_cache import PoolSnapshot
+from tools.valuation import fill_volumes_vectorized, TxColumns, PoolPriceMatrix, valuate
+from models.tx import ThorTx, ThorTxType
+
+# Synthetic comparison of ThorTx.fill_volumes (one by one) and tools.valuation (NumPy).
+# With ORM objects on both ends it's on par with the loop, so ValueFiller doesn't use it.
+# NumPy is not a dependency of the app: pip install numpy first.
+# Run from backend/src: PYTHONPATH=. python tools/valuation_benchmark.py [n_txs] [n_blocks]
+
+ASSETS = [None, 'THOR.RUNE'] + [f'CHAIN.ASSET{i}' for i in range(40)]
+TYPES = [ThorTxType.TYPE_SWAP, ThorTxType.TYPE_ADD_LIQUIDITY, ThorTxType.TYPE_WITHDRAW, ThorTxType.TYPE_REFUND]
+
+
+def make_data(n_txs, n_blocks):
+    random.seed(1)
+    snapshots = [PoolSnapshot(h, {a: random.uniform(0.01, 1e4) for a in ASSETS[2:]}, random.uniform(0.5, 15.0))
+                 for h in range(n_blocks)]
+    txs = [ThorTx(id=i, hash=str(i), block_height=random.randrange(n_blocks), type=random.choice(TYPES), date=0,
+                  user_address='u', asset1=random.choice(ASSETS), amount1=random.uniform(0, 1e4),
+                  asset2=random.choice(ASSETS), amount2=random.uniform(0, 1e4))
+           for i in range(n_txs)]
+    return txs, snapshots
+
+
+def timed(title, f):
+    t0 = time.perf_counter()
+    f()
+    dt = time.perf_counter() - t0
+    print(f'{title:>40}: {dt:.3f} sec')
+    return dt
+
+
+def main():
+    n_txs = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    n_blocks = int(sys.argv[2]) if len(sys.argv) > 2 else 20_000
+    print(f'{n_txs} txs in {n_blocks} blocks')
+
+    scalar_txs, snapshots = make_data(n_txs, n_blocks)
+    vector_txs, _ = make_data(n_txs, n_blocks)
+    by_height = {s.block_height: s for s in snapshots}
+
+    def scalar():
+        for tx in scalar_txs:
+            snapshot = by_height[tx.block_height]
+            tx.fill_volumes(snapshot.runes_per_asset, snapshot.usd_per_rune)
+
+    t_scalar = timed('scalar fill_volumes', scalar)
+    t_vector = timed('vectorized (incl. columns and apply)', lambda: fill_volumes_vectorized(vector_txs, by_height))
+
+    columns, prices = TxColumns.from_txs(vector_txs), PoolPriceMatrix.from_snapshots(by_height)
+    timed('vectorized (math only)', lambda: valuate(columns, prices))
+
+    same = all((a.usd_price1, a.usd_price2, a.rune_volume, a.usd_volume, a.process_flags) ==
+               (b.usd_price1, b.usd_price2, b.rune_volume, b.usd_volume, b.process_flags)
+               for a, b in zip(scalar_txs, vector_txs))
+    print(f'speed up: x{t_scalar / t_vector:.1f}; results are the same: {same}')
+
+
+if __name__ == '__main__':
+    main()